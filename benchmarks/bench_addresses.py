@@ -0,0 +1,71 @@
+"""Address rewriting:  the previous split("<") transform_address against
+addresses.transform, uncached and with its LRU cache, on header values drawn
+from a skewed sender population like real traffic (a few senders send most
+messages).
+
+Run with:  python -m benchmarks.bench_addresses [values [senders]]
+"""
+import sys
+import time
+import random
+
+from handle_email import addresses
+
+DOMAIN = "example.net"
+NAMES = ["", "John Doe", '"Doe, John"', "=?utf-8?q?Ren=C3=A9_Dupont?=", '"O\'Brien (Sales)"', "Support Team"]
+
+
+def legacy_transform_address(addr, domain=DOMAIN, user_only=False):
+    """The previous implementation of app.transform_address."""
+    addr = addr.strip()
+    addr = addr.rstrip(">")
+    addr_split = addr.split("<")
+    if len(addr_split) > 1:
+        display_name = addr_split[0].strip()
+        user_part = addr_split[1].replace("@", "_")
+    else:
+        display_name = ""
+        user_part = addr_split[0].replace("@", "_")
+    if user_only:
+        return user_part
+    elif len(display_name) > 0:
+        return f"{display_name} <{user_part}@{domain}>"
+    else:
+        return f"{user_part}@{domain}"
+
+
+def sender_values(count, senders=1000, seed=0):
+    """`count` From values of `senders` distinct senders, with Zipf-like frequencies."""
+    rng = random.Random(seed)
+    population = []
+    for i in range(senders):
+        name = rng.choice(NAMES)
+        addr = "user%d@domain%d.example.com" % (i, i % 50)
+        population.append("%s <%s>" % (name, addr) if name else addr)
+    weights = [1 / (i + 1) for i in range(senders)]
+    return rng.choices(population, weights, k=count)
+
+
+def measure(func, values):
+    start = time.perf_counter()
+    for value in values:
+        func(value)
+    return len(values) / (time.perf_counter() - start)
+
+
+def main(count=100000, senders=1000):
+    values = sender_values(count, senders)
+    results = {
+        "legacy split": measure(legacy_transform_address, values),
+        "parsed, uncached": measure(lambda v: addresses.transform.__wrapped__(v, DOMAIN), values),
+    }
+    addresses.transform.cache_clear()
+    results["parsed, LRU cache"] = measure(lambda v: addresses.transform(v, DOMAIN), values)
+    for name, rate in results.items():
+        print("%-20s %12.0f values/sec" % (name, rate))
+    info = addresses.cache_info()
+    print("cache: %d hits, %d misses, %d entries (max %d)" % (info.hits, info.misses, info.currsize, info.maxsize))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,112 @@
+"""Per-message latency with a new boto3 client per call versus the shared
+client registry.
+
+Each "message" runs the S3 index put, S3 get and SES send done by
+handle_ses_notice.  Calls are answered by botocore Stubbers, so no network
+is used and the numbers show client setup overhead only; the TLS handshake
+saved by connection reuse comes on top of this in Lambda.
+
+Run with:  python -m benchmarks.bench_clients [iterations]
+"""
+import io
+import os
+import sys
+import json
+import time
+import statistics
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import boto3
+from botocore.stub import Stubber
+from botocore.response import StreamingBody
+from handle_email import app, clients
+
+EVENT_FILE = os.path.join(os.path.dirname(__file__), os.pardir, 'events', 'ses_event.json')
+RAW_MESSAGE = (
+    b"From: Sender <sender@example.com>\r\n"
+    b"To: recipient@example.com\r\n"
+    b"Subject: Benchmark\r\n"
+    b"\r\n"
+    b"Hello\r\n"
+)
+
+
+def stubbed_client(service, calls=1):
+    """Create a client with responses queued for the given number of messages."""
+    client = boto3.client(service, config=clients.client_config())
+    stubber = Stubber(client)
+    for _ in range(calls):
+        if service == 's3':
+            stubber.add_response('put_object', {})
+            stubber.add_response('get_object', {
+                'Body': StreamingBody(io.BytesIO(RAW_MESSAGE), len(RAW_MESSAGE)),
+            })
+        elif service == 'sesv2':
+            stubber.add_response('send_email', {'MessageId': 'bench'})
+    stubber.activate()
+    return client
+
+
+def fresh_client_factory(shared):
+    """Mimic the old behavior:  create a new client on every call.
+
+    The new client is built (which is where the cost lies) and then the
+    call is answered by the shared stubbed client.
+    """
+    def get_client(service):
+        boto3.client(service)
+        return shared[service]
+    return get_client
+
+
+def run_message(notification):
+    app.save_message_index(notification)
+    app.forward_message(notification['mail']['messageId'], ['recipient@example.org'])
+
+
+def measure(iterations, notification):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        run_message(notification)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(label, samples):
+    samples = sorted(samples)
+    print("%-16s mean %7.2f ms   p50 %7.2f ms   p99 %7.2f ms" % (
+        label, statistics.mean(samples), samples[len(samples) // 2],
+        samples[min(len(samples) - 1, int(len(samples) * 0.99))]))
+
+
+def main(iterations=200):
+    with open(EVENT_FILE) as f:
+        notification = json.load(f)['Records'][0]['ses']
+    app.S3_BUCKET = "bench-bucket"
+    app.EMAIL_DOM = "example.net"
+
+    registry_get_client = clients.get_client
+    clients.get_client = fresh_client_factory({
+        's3': stubbed_client('s3', iterations),
+        'sesv2': stubbed_client('sesv2', iterations),
+    })
+    try:
+        before = measure(iterations, notification)
+    finally:
+        clients.get_client = registry_get_client
+
+    clients.set_client('s3', stubbed_client('s3', iterations))
+    clients.set_client('sesv2', stubbed_client('sesv2', iterations))
+    try:
+        after = measure(iterations, notification)
+    finally:
+        clients.reset_clients()
+
+    report("client per call", before)
+    report("shared clients", after)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,48 @@
+"""Objects per second of the index compaction against the in-memory S3
+stand-in, by number of concurrent downloads.
+
+Each run loads one day of per-message index objects, as written by
+save_message_index, and compacts it into one gzip NDJSON object.  The
+simulated latency per S3 call is what concurrent downloads hide.
+
+Run with:  python -m benchmarks.bench_compact [objects] [latency_ms]
+"""
+import sys
+import time
+from datetime import datetime
+
+from handle_email import app, clients, compact
+from benchmarks import corpus, standins
+
+BUCKET = "benchmark-bucket"
+DAY = datetime(2021, 9, 13)
+WORKERS = [1, 4, 16, 64]
+
+
+def load(notifications):
+    app.S3_BUCKET = BUCKET
+    for notification in notifications:
+        app.save_message_index(notification)
+
+
+def main(objects=2000, latency_ms=2.0):
+    notifications = [n for n, _ in corpus.generate(objects, "small", start=DAY)]
+    print("%d objects, %.1f ms per S3 call" % (objects, latency_ms))
+    for workers in WORKERS:
+        s3 = standins.InMemoryS3()
+        clients.set_client('s3', s3)
+        load(notifications)
+        s3.latency = latency_ms / 1000
+        try:
+            start = time.perf_counter()
+            manifest = compact.compact_day(DAY, BUCKET, workers=workers)
+            elapsed = time.perf_counter() - start
+        finally:
+            clients.reset_clients()
+        size = sum(o['Size'] for o in manifest['sources'])
+        print("%3d workers: %8.1f objects/sec   %6.2f s   %d records   %d -> %d bytes" % (
+            workers, len(manifest['sources']) / elapsed, elapsed, manifest['records'], size, manifest['bytes']))
+
+
+if __name__ == '__main__':
+    main(*[convert(a) for convert, a in zip((int, float), sys.argv[1:3])])
@@ -0,0 +1,77 @@
+"""Memory and CPU of the header-only rewrite versus a full MIME parse and
+re-serialization, across message sizes.
+
+Run with:  python -m benchmarks.bench_rewrite [size_kib ...]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+from handle_email import app, rewrite
+
+DEFAULT_SIZES_KIB = [10, 100, 1024, 10 * 1024, 30 * 1024]
+RECIPIENTS = ["recipient@example.org"]
+
+
+def build_message(size):
+    """Build a multipart message with an attachment of roughly `size` bytes."""
+    msg = EmailMessage()
+    msg['From'] = '"Doe, John" <sender@example.com>'
+    msg['To'] = 'recipient@example.com'
+    msg['Cc'] = 'other@example.com'
+    msg['Subject'] = 'Benchmark message'
+    msg.set_content("Hello,\n\nPlease see the attachment.\n")
+    # base64 expands by 4/3
+    msg.add_attachment(os.urandom(size * 3 // 4), maintype='application',
+                       subtype='octet-stream', filename='data.bin')
+    return msg.as_bytes().replace(b"\n", b"\r\n")
+
+
+def full_parse(raw):
+    """The previous implementation of forward_message."""
+    msg = BytesParser().parsebytes(raw)
+    for src_header in app.SOURCE_HEADERS:
+        if src_header in msg.keys():
+            msg.replace_header(src_header, app.transform_address(msg.get(src_header)))
+    msg.replace_header("To", ",".join(RECIPIENTS))
+    del msg["CC"]
+    del msg["BCC"]
+    return msg.as_string()
+
+
+def header_only(raw):
+    return rewrite.rewrite_message(
+        raw,
+        transform={src_header: app.transform_address for src_header in app.SOURCE_HEADERS},
+        replace={"To": ",".join(RECIPIENTS)},
+        delete=["CC", "BCC"],
+    )
+
+
+def measure(func, raw):
+    tracemalloc.start()
+    start = time.process_time()
+    func(raw)
+    cpu = time.process_time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def main(sizes_kib=None):
+    app.EMAIL_DOM = "example.net"
+    print("%10s  %22s  %22s" % ("size", "full parse cpu / peak", "header-only cpu / peak"))
+    for size_kib in sizes_kib or DEFAULT_SIZES_KIB:
+        raw = build_message(size_kib * 1024)
+        results = [measure(func, raw) for func in (full_parse, header_only)]
+        print("%8.1fMB  %9.1fms / %7.1fMB  %9.1fms / %7.1fMB" % (
+            len(raw) / 2**20,
+            results[0][0] * 1000, results[0][1] / 2**20,
+            results[1][0] * 1000, results[1][1] / 2**20))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]])
@@ -0,0 +1,143 @@
+"""Cold start of the Lambda handlers: import time of handle_email.app, by
+package with `-X importtime`, and time to the first processed record.
+
+Each run starts a new interpreter.  After the import, the boto3 clients
+each handler uses are created for real (without network access), as their
+import and setup is part of a cold start, and are then replaced by the
+in-memory stand-ins to process one record:
+
+* handle_ses_notice:  one SES event, forwarded (S3 and SES)
+* handle_dead_letter:  one Dead Letter Queue record, reported (S3 and SNS)
+
+Modules imported while processing the record (lazily) are reported in the
+first record phase.
+
+Run with:  python -m benchmarks.bench_startup [runs]
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+from collections import Counter
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+HANDLERS = ["handle_ses_notice", "handle_dead_letter"]
+PHASES = ["import", "clients", "first_record"]
+MARKER = "### phase "
+TOP_MODULES = 6
+
+# Runs in the new interpreter; phases are marked on stderr between the -X importtime lines
+CHILD = r'''
+import sys, time
+start = time.perf_counter()
+def mark(phase):
+    sys.stderr.write("%s%s\n" % (MARKER, phase))
+    sys.stderr.flush()
+mark("import")
+from handle_email import app
+imported = time.perf_counter()
+mark("clients")
+from handle_email import clients
+for service in SERVICES[HANDLER]:
+    clients.get_client(service)
+created = time.perf_counter()
+mark("prepare")
+import json
+from benchmarks import corpus, standins
+notification, raw = corpus.generate(1, "small", email_dom="example.com")[0]
+services = standins.install()
+services['s3'].put_object(Bucket=app.S3_BUCKET, Key=app.S3_PREFIX_MSG + notification['mail']['messageId'], Body=raw)
+event = corpus.ses_event([notification])
+if HANDLER == "handle_dead_letter":
+    event = {"Records": [{"eventSource": "aws:sqs", "messageId": "q1", "body": json.dumps(event),
+                          "messageAttributes": {"ErrorCode": {"stringValue": "200"},
+                                                "ErrorMessage": {"stringValue": "Task timed out"}}}]}
+mark("first_record")
+ready = time.perf_counter()
+getattr(app, HANDLER)(event, None)
+done = time.perf_counter()
+mark("end")
+print(json.dumps({"import": imported - start, "clients": created - imported, "first_record": done - ready}))
+'''
+
+SERVICES = {
+    "handle_ses_notice": ["s3", "sesv2"],
+    "handle_dead_letter": ["s3", "sns"],
+}
+
+
+def child_env():
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT,
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "AWS_EC2_METADATA_DISABLED": "true",
+        "S3_BUCKET": "benchmark-bucket",
+        "EMAIL_DOM": "example.com",
+        "DEST_DOM": "example.net",
+        "NOTICE_TOPIC": "arn:aws:sns:us-east-1:123456789012:notice",
+        "METRICS_ENABLED": "false",
+        "LOGLEVEL": "WARNING",
+    })
+    return env
+
+
+def run_child(handler, importtime=False):
+    """Start an interpreter that imports the app and processes one record.
+
+    Returns
+    -------
+    Tuple of (dictionary of phase to seconds, stderr lines)
+
+    """
+    code = "MARKER = %r\nSERVICES = %r\nHANDLER = %r\n" % (MARKER, SERVICES, handler) + CHILD
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    result = subprocess.run(command, cwd=ROOT, env=child_env(), capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1]), result.stderr.splitlines()
+
+
+def import_breakdown(lines):
+    """Self import time in ms per package (handle_email per module), for each phase.
+
+    Returns
+    -------
+    Dictionary of phase to (number of modules imported, Counter of ms per package)
+
+    """
+    phases = {}
+    phase = None
+    for line in lines:
+        if line.startswith(MARKER):
+            phase = line[len(MARKER):]
+            continue
+        if not line.startswith("import time:") or "|" not in line or phase not in PHASES:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # Header line
+        name = name.strip()
+        package = name if name.startswith("handle_email") else name.split(".")[0]
+        count, packages = phases.setdefault(phase, [0, Counter()])
+        packages[package] += int(self_us) / 1000
+        phases[phase][0] = count + 1
+    return {phase: tuple(value) for phase, value in phases.items()}
+
+
+def main(runs=5):
+    print("median of %d runs, in ms" % (runs,))
+    for handler in HANDLERS:
+        timings = [run_child(handler)[0] for _ in range(runs)]
+        medians = {phase: statistics.median(t[phase] for t in timings) * 1000 for phase in PHASES}
+        print("%-20s import %7.1f   clients %7.1f   first record %7.1f   total %7.1f" % (
+            handler, medians["import"], medians["clients"], medians["first_record"], sum(medians.values())))
+        _, lines = run_child(handler, importtime=True)
+        for phase, (count, packages) in sorted(import_breakdown(lines).items(), key=lambda p: PHASES.index(p[0])):
+            top = ", ".join("%s %.1f" % item for item in packages.most_common(TOP_MODULES))
+            print("  %-13s %4d modules %7.1f   %s" % (phase, count, sum(packages.values()), top))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,70 @@
+"""Memory and CPU of forward_message in each forwarding mode, across message
+sizes: "inline" (header-only rewrite), "rfc822" and "attachment" (wrap.py),
+and the previous MIME implementation of forwarding as an attachment
+(MIMEApplication of the whole message serialized with as_string) for
+reference.
+
+Each message is read from the in-memory S3 stand-in and sent to the SES
+stand-in, so the spool, rewrite or wrap, and send are all included.
+
+Run with:  python -m benchmarks.bench_wrap [size_kib ...]
+"""
+import sys
+import time
+import tracemalloc
+
+from handle_email import app, sender
+from benchmarks import standins
+from benchmarks.bench_rewrite import build_message
+
+DEFAULT_SIZES_KIB = [10, 100, 1024, 10 * 1024, 25 * 1024]
+MODES = ["inline", "rfc822", "attachment"]
+RECIPIENTS = ["recipient@example.org"]
+MESSAGE_ID = "benchmark-message"
+
+
+def mime_attachment(raw):
+    """The previous implementation of forward_message_att, without the send."""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.application import MIMEApplication
+    msg = MIMEMultipart('mixed')
+    msg['Subject'] = "[FWD] Benchmark message"
+    msg['To'] = ", ".join(RECIPIENTS)
+    msg['From'] = app.transform_address('"Doe, John" <sender@example.com>')
+    msg.attach(MIMEText("Please see the attached file for the forwarded message.", 'plain', 'utf-8'))
+    att = MIMEApplication(raw)
+    att.add_header('Content-Disposition', 'attachment', filename="orig.eml")
+    msg.attach(att)
+    return msg.as_string()
+
+
+def measure(func):
+    """CPU time, and peak memory traced in a second run (tracing slows allocations)."""
+    start = time.process_time()
+    func()
+    cpu = time.process_time() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def main(sizes_kib=None):
+    app.EMAIL_DOM = "example.net"
+    app.S3_BUCKET = "benchmark-bucket"
+    services = standins.install(keep_content=False)
+    sender.reset_scheduler()
+    print("%10s" % ("size",) + "".join("  %22s" % (name + " cpu / peak",) for name in MODES + ["MIME"]))
+    for size_kib in sizes_kib or DEFAULT_SIZES_KIB:
+        raw = build_message(size_kib * 1024)
+        services['s3'].put_object(Bucket=app.S3_BUCKET, Key=app.S3_PREFIX_MSG + MESSAGE_ID, Body=raw)
+        results = [measure(lambda: app.forward_message(MESSAGE_ID, RECIPIENTS, mode=mode)) for mode in MODES]
+        results.append(measure(lambda: mime_attachment(raw)))
+        print("%8.1fMB" % (len(raw) / 2**20,) + "".join(
+            "  %9.1fms / %7.1fMB" % (cpu * 1000, peak / 2**20) for cpu, peak in results))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]])
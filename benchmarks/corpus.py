@@ -0,0 +1,156 @@
+"""Synthetic email corpus and SES event builder.
+
+Messages vary in size, MIME structure and recipient count.  Each message is
+paired with an SES notification built from events/ses_event.json, and can be
+wrapped as a direct SES event, an SNS event like events/sns_ses_event.json,
+or an SQS event of the batch ingest queue.
+"""
+import os
+import copy
+import json
+import random
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+EVENTS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'events')
+
+STRUCTURES = ["plain", "alternative", "mixed", "nested"]
+
+# Scenarios are weighted choices of (structure, size in bytes, recipient count)
+SCENARIOS = {
+    "small": {
+        "structures": {"plain": 3, "alternative": 1},
+        "sizes": {2 * 1024: 3, 20 * 1024: 1},
+        "recipients": {1: 1},
+    },
+    "mixed": {
+        "structures": {"plain": 4, "alternative": 4, "mixed": 2, "nested": 1},
+        "sizes": {2 * 1024: 40, 20 * 1024: 40, 200 * 1024: 15, 2 * 1024 * 1024: 5},
+        "recipients": {1: 80, 2: 15, 5: 4, 20: 1},
+    },
+    "large": {
+        "structures": {"mixed": 2, "nested": 1},
+        "sizes": {1024 * 1024: 1, 5 * 1024 * 1024: 2, 20 * 1024 * 1024: 1},
+        "recipients": {1: 3, 3: 1},
+    },
+}
+
+
+def load_template(name='ses_event.json'):
+    with open(os.path.join(EVENTS_DIR, name)) as f:
+        return json.load(f)
+
+
+def weighted(rng, choices):
+    return rng.choices(list(choices), weights=list(choices.values()))[0]
+
+
+def build_raw_message(rng, structure, size, sender, recipients, subject):
+    """Build a raw message of roughly `size` bytes with the given MIME structure."""
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['To'] = ", ".join(recipients)
+    if len(recipients) > 1:
+        msg['Cc'] = recipients[-1]
+    msg['Subject'] = subject
+    msg['Message-ID'] = "<%032x@example.com>" % rng.getrandbits(128)
+    words = [w * rng.randint(1, 3) for w in ["lorem", "ipsum", "dolor", "sit", "amet"]]
+    text_size = size if structure in ("plain", "alternative") else min(size, 4096)
+    text = []
+    length = 0
+    while length < text_size:
+        line = " ".join(rng.choice(words) for _ in range(12))
+        text.append(line)
+        length += len(line) + 1
+    text = "\n".join(text) + "\n"
+    msg.set_content(text)
+    if structure in ("alternative", "nested"):
+        msg.add_alternative("<html><body><pre>%s</pre></body></html>" % text[:4096], subtype='html')
+    if structure in ("mixed", "nested"):
+        # base64 expands by 4/3
+        attachment = rng.randbytes(max(1, (size - text_size) * 3 // 4))
+        msg.add_attachment(attachment, maintype='application', subtype='octet-stream', filename='data.bin')
+    return msg.as_bytes().replace(b"\n", b"\r\n")
+
+
+def build_notification(template, message_id, timestamp, sender, recipients, subject):
+    """Build an SES notification ("ses" member of an event record)."""
+    notification = copy.deepcopy(template['Records'][0]['ses'])
+    mail = notification['mail']
+    receipt = notification['receipt']
+    ts = timestamp.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (timestamp.microsecond // 1000)
+    mail['timestamp'] = receipt['timestamp'] = ts
+    mail['messageId'] = message_id
+    mail['source'] = sender.split("<")[-1].rstrip(">")
+    mail['destination'] = list(recipients)
+    mail['commonHeaders']['from'] = [sender]
+    mail['commonHeaders']['to'] = list(recipients)
+    mail['commonHeaders']['subject'] = subject
+    receipt['recipients'] = list(recipients)
+    for verdict in ['spamVerdict', 'virusVerdict', 'spfVerdict', 'dkimVerdict', 'dmarcVerdict']:
+        receipt[verdict] = {"status": "PASS"}
+    return notification
+
+
+def ses_event(notifications):
+    """Wrap notifications as a direct SES event, like events/ses_event.json."""
+    return {"Records": [
+        {"eventSource": "aws:ses", "eventVersion": "1.0", "ses": n} for n in notifications
+    ]}
+
+
+def sns_event(notifications):
+    """Wrap notifications as an SNS event, like events/sns_ses_event.json."""
+    template = load_template('sns_ses_event.json')['Records'][0]
+    records = []
+    for n in notifications:
+        record = copy.deepcopy(template)
+        record['Sns']['MessageId'] = n['mail']['messageId']
+        record['Sns']['Message'] = json.dumps(dict(n, notificationType="Received"))
+        records.append(record)
+    return {"Records": records}
+
+
+def sqs_event(notifications):
+    """Wrap notifications as an SQS event of the batch ingest queue (SNS raw message delivery)."""
+    return {"Records": [
+        {"eventSource": "aws:sqs", "messageId": "sqs-" + n['mail']['messageId'],
+         "body": json.dumps(dict(n, notificationType="Received"))} for n in notifications
+    ]}
+
+
+def generate(count, scenario="mixed", seed=0, email_dom="example.com", start=None):
+    """Generate (notification, raw_message) pairs.
+
+    Parameters
+    ----------
+    count: int, required
+        Number of messages
+
+    scenario: str, optional
+        Name of a scenario in SCENARIOS
+
+    Returns
+    -------
+    List of (notification, raw_message) tuples
+
+    """
+    rng = random.Random(seed)
+    config = SCENARIOS[scenario]
+    template = load_template()
+    start = start or datetime(2021, 9, 13, 12, 0, 0)
+    senders = ["Sender %d <sender%d@sender%d.example.org>" % (i, i, i % 7) for i in range(50)]
+    corpus = []
+    for i in range(count):
+        structure = weighted(rng, config["structures"])
+        size = weighted(rng, config["sizes"])
+        n_recipients = weighted(rng, config["recipients"])
+        sender = rng.choice(senders)
+        recipients = ["user%d@%s" % (rng.randrange(100), email_dom) for _ in range(n_recipients)]
+        subject = "Synthetic %s message %d" % (structure, i)
+        message_id = "%s%06d" % (scenario, i)
+        timestamp = start + timedelta(seconds=i)
+        raw = build_raw_message(rng, structure, size, sender, recipients, subject)
+        notification = build_notification(template, message_id, timestamp, sender, recipients, subject)
+        corpus.append((notification, raw))
+    return corpus
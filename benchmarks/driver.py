@@ -0,0 +1,197 @@
+"""Replay synthetic SES events through handle_ses_notice against in-memory
+stand-ins and report throughput, latency and memory.
+
+With `--source sns` the events are SNS events, and with `--source sqs` they
+are SQS batches of `--records-per-event` notifications, replayed through
+handle_ses_batch.
+
+Results can be compared with a stored baseline to catch regressions:
+
+    python -m benchmarks.driver --scenario mixed --latency-ms 2 --concurrency 4 --check
+    python -m benchmarks.driver --scenario mixed --latency-ms 2 --concurrency 4 --update-baseline
+    python -m benchmarks.driver --scenario mixed --latency-ms 2 --source sqs --records-per-event 50 --repeat 1
+
+Baseline numbers depend on the machine; update them when moving to a new one.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from handle_email import app, clients, index, ledger, metrics, sender, spool
+from benchmarks import corpus, standins
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+BUCKET = "benchmark-bucket"
+EMAIL_DOM = "example.com"
+STAGES = ["Ledger", "IndexPut", "S3Get", "Rewrite", "Transform", "Send"]
+EVENTS = {"ses": corpus.ses_event, "sns": corpus.sns_event, "sqs": corpus.sqs_event}
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def prepare(scenario, count, records_per_event, seed, latency, max_send_rate, source="ses"):
+    """Install stand-ins, load the corpus into S3 and build the events."""
+    app.S3_BUCKET = BUCKET
+    app.EMAIL_DOM = EMAIL_DOM
+    app.DEST_DOM = "example.net"
+    services = standins.install(latency=latency, keep_content=False, max_send_rate=max_send_rate)
+    sender.reset_scheduler()
+    ledger.set_ledger(None)
+    notifications = []
+    for notification, raw in corpus.generate(count * records_per_event, scenario, seed, EMAIL_DOM):
+        services['s3'].put_object(Bucket=BUCKET, Key=app.S3_PREFIX_MSG + notification['mail']['messageId'], Body=raw)
+        notifications.append(notification)
+    events = [EVENTS[source](notifications[i:i + records_per_event])
+              for i in range(0, len(notifications), records_per_event)]
+    return services, events
+
+
+def replay(events, rate=0, concurrency=1, handler=None):
+    """Invoke handle_ses_notice (or `handler`) for each event, at most `rate` events per second.
+
+    Batch item failures returned by the handler are counted as errors.
+
+    Returns
+    -------
+    Tuple of (elapsed seconds, list of per-event latencies in ms, list of errors)
+
+    """
+    latencies = []
+    errors = []
+    handler = handler or app.handle_ses_notice
+
+    def invoke(event):
+        start = time.perf_counter()
+        try:
+            response = handler(event, None)
+            errors.extend((response or {}).get("batchItemFailures", []))
+        except Exception as e:
+            errors.append(e)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for i, event in enumerate(events):
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(invoke, event)
+    return time.perf_counter() - start, latencies, errors
+
+
+def run(scenario="mixed", count=200, rate=0, concurrency=1, latency_ms=0, records_per_event=1, seed=0,
+        max_send_rate=1000, throttle=0, index_format="json", source="ses"):
+    services, events = prepare(scenario, count, records_per_event, seed, latency_ms / 1000, max_send_rate, source)
+    services['sesv2'].throttle = throttle
+    saved_format, index.INDEX_FORMAT = index.INDEX_FORMAT, index_format
+    records = []
+    metrics_enabled = metrics.METRICS_ENABLED
+    metrics.METRICS_ENABLED = False
+    metrics.add_hook(records.append)
+    rss_before = spool.peak_rss_kib()
+    try:
+        handler = app.handle_ses_batch if source == "sqs" else app.handle_ses_notice
+        elapsed, latencies, errors = replay(events, rate, concurrency, handler)
+    finally:
+        metrics.remove_hook(records.append)
+        metrics.METRICS_ENABLED = metrics_enabled
+        index.INDEX_FORMAT = saved_format
+        clients.reset_clients()
+        sender.reset_scheduler()
+        ledger.set_ledger(None)
+    messages = count * records_per_event
+    result = {
+        "messages": messages,
+        "errors": len(errors),
+        "sent": len(services['sesv2'].sent),
+        "s3_puts": services['s3'].calls.get('PutObject', 0) - messages,
+        "messages_per_sec": round(messages / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "peak_rss_kib": spool.peak_rss_kib(),
+        "peak_rss_growth_kib": spool.peak_rss_kib() - rss_before,
+    }
+    for stage in STAGES:
+        values = [r[stage + "Time"] for r in records if stage + "Time" in r]
+        if values:
+            result[stage + "_mean_ms"] = round(statistics.mean(values), 3)
+    return result
+
+
+def baseline_key(args):
+    key = "%s-n%d-r%g-c%d-l%g-b%d" % (args.scenario, args.events, args.rate, args.concurrency,
+                                      args.latency_ms, args.records_per_event)
+    return key if args.source == "ses" else key + "-" + args.source
+
+
+def check(result, baseline, tolerance):
+    """Return a list of regressions of `result` compared to `baseline`."""
+    problems = []
+    if result["messages_per_sec"] < baseline["messages_per_sec"] * (1 - tolerance):
+        problems.append("throughput %.2f/s below baseline %.2f/s" % (result["messages_per_sec"], baseline["messages_per_sec"]))
+    for key in ["p50_ms", "p99_ms"]:
+        if result[key] > baseline[key] * (1 + tolerance):
+            problems.append("%s %.3f above baseline %.3f" % (key, result[key], baseline[key]))
+    if result["errors"]:
+        problems.append("%d errors" % result["errors"])
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenario", default="mixed", choices=sorted(corpus.SCENARIOS))
+    parser.add_argument("--events", type=int, default=200, help="number of events to replay")
+    parser.add_argument("--records-per-event", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=0, help="events per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent invocations")
+    parser.add_argument("--latency-ms", type=float, default=0, help="simulated latency per AWS call")
+    parser.add_argument("--max-send-rate", type=float, default=1000, help="SES account MaxSendRate")
+    parser.add_argument("--throttle", type=int, default=0, help="number of sends rejected as throttled")
+    parser.add_argument("--index-format", default="json", choices=["json", "ndjson"])
+    parser.add_argument("--source", default="ses", choices=sorted(EVENTS),
+                        help="event format; sqs batches are replayed through handle_ses_batch")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="report the median of this many runs")
+    parser.add_argument("--check", action="store_true", help="compare with the stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    runs = [run(args.scenario, args.events, args.rate, args.concurrency, args.latency_ms,
+                args.records_per_event, args.seed, args.max_send_rate, args.throttle,
+                args.index_format, args.source) for _ in range(args.repeat)]
+    result = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+    print(json.dumps(result, indent=2))
+
+    key = baseline_key(args)
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)
+    if args.update_baseline:
+        baselines[key] = result
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baseline updated:", key)
+    elif args.check:
+        if key not in baselines:
+            print("No baseline for", key)
+            return 2
+        problems = check(result, baselines[key], args.tolerance)
+        for problem in problems:
+            print("REGRESSION:", problem)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""In-memory stand-ins for the S3, SESv2, SNS and SQS clients.
+
+They implement the subset of the boto3 client API used by handle_email,
+raise botocore ClientError like the real services, and can add a fixed
+latency per call to simulate network round trips.  Install them in the
+client registry with `install()`.
+"""
+import io
+import time
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+from handle_email import clients
+
+
+def client_error(code, message, operation, status=400):
+    return ClientError({
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status},
+    }, operation)
+
+
+class StandIn:
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def _call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class Paginator:
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get('IsTruncated'):
+                break
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class InMemoryS3(StandIn):
+    """S3 client stand-in; objects are kept per bucket in dictionaries."""
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.buckets = {}
+
+    def _objects(self, bucket):
+        return self.buckets.setdefault(bucket, {})
+
+    def _get(self, bucket, key, operation):
+        obj = self._objects(bucket).get(key)
+        if obj is None:
+            raise client_error('NoSuchKey', 'The specified key does not exist.', operation, 404)
+        return obj
+
+    def put_object(self, Bucket, Key, Body=b"", IfNoneMatch=None, **kwargs):
+        self._call('PutObject')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        Body = bytes(Body)
+        etag = '"%s"' % hashlib.md5(Body).hexdigest()
+        with self.lock:
+            objects = self._objects(Bucket)
+            if IfNoneMatch == '*' and Key in objects:
+                raise client_error('PreconditionFailed', 'At least one of the pre-conditions you specified did not hold',
+                                   'PutObject', 412)
+            objects[Key] = {
+                'Body': Body,
+                'ETag': etag,
+                'LastModified': datetime.now(timezone.utc),
+                'ContentType': kwargs.get('ContentType', 'binary/octet-stream'),
+                'Metadata': kwargs.get('Metadata', {}),
+            }
+        return {'ETag': etag}
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None, **kwargs):
+        self._call('GetObject')
+        obj = self._get(Bucket, Key, 'GetObject')
+        if IfNoneMatch is not None and IfNoneMatch == obj['ETag']:
+            raise client_error('304', 'Not Modified', 'GetObject', 304)
+        body = obj['Body']
+        response = {'ETag': obj['ETag'], 'LastModified': obj['LastModified'],
+                    'ContentType': obj['ContentType'], 'Metadata': obj['Metadata']}
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            start, end = int(start), min(int(end), len(body) - 1)
+            response['ContentRange'] = 'bytes %d-%d/%d' % (start, end, len(body))
+            body = body[start:end + 1]
+        response['ContentLength'] = len(body)
+        response['Body'] = StreamingBody(io.BytesIO(body), len(body))
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('HeadObject')
+        obj = self._get(Bucket, Key, 'HeadObject')
+        return {'ETag': obj['ETag'], 'LastModified': obj['LastModified'],
+                'ContentLength': len(obj['Body']), 'Metadata': obj['Metadata']}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('DeleteObject')
+        with self.lock:
+            self._objects(Bucket).pop(Key, None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._call('DeleteObjects')
+        with self.lock:
+            for item in Delete['Objects']:
+                self._objects(Bucket).pop(item['Key'], None)
+        return {'Deleted': [{'Key': item['Key']} for item in Delete['Objects']]}
+
+    def list_objects_v2(self, Bucket, Prefix="", Delimiter=None, MaxKeys=1000,
+                        ContinuationToken=None, StartAfter=None, **kwargs):
+        self._call('ListObjectsV2')
+        with self.lock:
+            objects = dict(self._objects(Bucket))
+        entries = []
+        for key in sorted(k for k in objects if k.startswith(Prefix) and k > (StartAfter or "")):
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common = Prefix + key[len(Prefix):].split(Delimiter, 1)[0] + Delimiter
+                if not entries or entries[-1] != ('prefix', common):
+                    entries.append(('prefix', common))
+            else:
+                entries.append(('key', key))
+        offset = int(ContinuationToken or 0)
+        page = entries[offset:offset + MaxKeys]
+        truncated = offset + MaxKeys < len(entries)
+        response = {'KeyCount': len(page), 'IsTruncated': truncated, 'Prefix': Prefix}
+        contents = [{'Key': key, 'Size': len(objects[key]['Body']), 'ETag': objects[key]['ETag'],
+                     'LastModified': objects[key]['LastModified']} for kind, key in page if kind == 'key']
+        if contents:
+            response['Contents'] = contents
+        prefixes = [{'Prefix': p} for kind, p in page if kind == 'prefix']
+        if prefixes:
+            response['CommonPrefixes'] = prefixes
+        if truncated:
+            response['NextContinuationToken'] = str(offset + MaxKeys)
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        return Paginator(self.list_objects_v2)
+
+
+class InMemorySESv2(StandIn):
+    """SESv2 client stand-in; sent messages are kept in `sent`.
+
+    `throttle` is a number of initial send_email calls to reject with
+    TooManyRequestsException, and `max_send_rate` is reported by get_account.
+    With `keep_content` False only the size of each message is kept.
+    """
+
+    def __init__(self, latency=0.0, throttle=0, max_send_rate=14.0, keep_content=True):
+        super().__init__(latency)
+        self.sent = []
+        self.throttle = throttle
+        self.max_send_rate = max_send_rate
+        self.keep_content = keep_content
+
+    def send_email(self, Content, Destination=None, **kwargs):
+        self._call('SendEmail')
+        with self.lock:
+            if self.throttle > 0:
+                self.throttle -= 1
+                raise client_error('TooManyRequestsException', 'Maximum sending rate exceeded.', 'SendEmail', 429)
+            message_id = str(uuid.uuid4())
+            self.sent.append({
+                'MessageId': message_id,
+                'Content': Content if self.keep_content else None,
+                'Size': len(Content['Raw']['Data']) if 'Raw' in Content else None,
+                'Destination': Destination,
+            })
+        return {'MessageId': message_id}
+
+    def get_account(self):
+        self._call('GetAccount')
+        return {'SendQuota': {'Max24HourSend': 50000.0, 'MaxSendRate': self.max_send_rate, 'SentLast24Hours': 0.0}}
+
+
+class InMemorySNS(StandIn):
+    """SNS client stand-in; published messages are kept in `published`."""
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.published = []
+
+    def publish(self, TopicArn, Message, Subject=None, **kwargs):
+        self._call('Publish')
+        message_id = str(uuid.uuid4())
+        with self.lock:
+            self.published.append({'MessageId': message_id, 'TopicArn': TopicArn, 'Subject': Subject, 'Message': Message})
+        return {'MessageId': message_id}
+
+
+class InMemorySQS(StandIn):
+    """SQS client stand-in; messages are kept per queue URL in `queues`.
+
+    Received messages are invisible for VisibilityTimeout seconds, and each
+    receive gives a new receipt handle, as in SQS.
+    """
+
+    def __init__(self, latency=0.0, clock=time.monotonic):
+        super().__init__(latency)
+        self.queues = {}
+        self.clock = clock
+
+    def _queue(self, url):
+        return self.queues.setdefault(url, [])
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        self._call('SendMessage')
+        message_id = str(uuid.uuid4())
+        with self.lock:
+            self._queue(QueueUrl).append({
+                'MessageId': message_id,
+                'Body': MessageBody,
+                'MessageAttributes': MessageAttributes or {},
+                'ReceiptHandle': None,
+                'ReceiveCount': 0,
+                'VisibleAt': 0.0,
+            })
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0,
+                        MessageAttributeNames=None, **kwargs):
+        self._call('ReceiveMessage')
+        messages = []
+        with self.lock:
+            now = self.clock()
+            for message in self._queue(QueueUrl):
+                if len(messages) >= MaxNumberOfMessages:
+                    break
+                if message['VisibleAt'] > now:
+                    continue
+                message['ReceiptHandle'] = str(uuid.uuid4())
+                message['ReceiveCount'] += 1
+                message['VisibleAt'] = now + VisibilityTimeout
+                received = {'MessageId': message['MessageId'], 'ReceiptHandle': message['ReceiptHandle'],
+                            'Body': message['Body'],
+                            'Attributes': {'ApproximateReceiveCount': str(message['ReceiveCount'])}}
+                if MessageAttributeNames:
+                    received['MessageAttributes'] = message['MessageAttributes']
+                messages.append(received)
+        return {'Messages': messages} if messages else {}
+
+    def _delete(self, url, handle):
+        queue = self._queue(url)
+        for i, message in enumerate(queue):
+            if message['ReceiptHandle'] == handle:
+                del queue[i]
+                return True
+        return False
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self._call('DeleteMessage')
+        with self.lock:
+            if not self._delete(QueueUrl, ReceiptHandle):
+                raise client_error('ReceiptHandleIsInvalid', 'The receipt handle is not valid.', 'DeleteMessage')
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self._call('DeleteMessageBatch')
+        response = {'Successful': [], 'Failed': []}
+        with self.lock:
+            for entry in Entries:
+                if self._delete(QueueUrl, entry['ReceiptHandle']):
+                    response['Successful'].append({'Id': entry['Id']})
+                else:
+                    response['Failed'].append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid',
+                                               'Message': 'The receipt handle is not valid.', 'SenderFault': True})
+        return response
+
+
+def install(latency=0.0, **ses_options):
+    """Install stand-ins for S3, SESv2, SNS and SQS in the client registry.
+
+    Returns
+    -------
+    Dictionary of service name to stand-in
+
+    """
+    standins = {
+        's3': InMemoryS3(latency),
+        'sesv2': InMemorySESv2(latency, **ses_options),
+        'sns': InMemorySNS(latency),
+        'sqs': InMemorySQS(latency),
+    }
+    for service, client in standins.items():
+        clients.set_client(service, client)
+    return standins
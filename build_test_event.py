@@ -1,47 +1,100 @@
+"""Build test events from the message index.
+
+SES notifications in the index are listed and downloaded in parallel for a
+range of days, using the local cache of query_index.py (keyed by ETag), so
+only new index objects are downloaded on later runs.  They can be filtered
+by sender, verdict and message size, and sampled, and each is saved as an
+SES event in the output directory, optionally with its raw message:
+
+    python3 build_test_event.py                          # the last 3 messages received today
+    python3 build_test_event.py --days 7 --limit 0 --output corpus/ --raw
+    python3 build_test_event.py --since 2021/09/01 --sender example.com --verdict spam=PASS --max-size 1048576
+    python3 build_test_event.py --days 30 --sample 0.1 --seed 1 --limit 5000 --output corpus/
+"""
 import os
 import sys
 import json
-import boto3
-from datetime import datetime
+import heapq
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from handle_email import clients, filters
+import query_index
 
 try:
     import toml
     config = toml.load(open('samconfig.toml'))
-    cf_params = dict(map(lambda x: (x.split('=')[0], x.split('=')[1].strip('"')), 
+    cf_params = dict(map(lambda x: (x.split('=')[0], x.split('=')[1].strip('"')),
                         config['default']['deploy']['parameters']['parameter_overrides'].split(' ')))
     S3_BUCKET = cf_params.get('S3BucketName') or os.environ.get("S3_BUCKET")
-except ImportError:
+except (ImportError, OSError):
     S3_BUCKET = os.environ.get("S3_BUCKET")
 
-S3_PREFIX_MSG = os.environ.get("S3_PREFIX") or "messages/"
-S3_PREFIX_IDX = os.environ.get("S3_PREFIX") or "index/"
+S3_PREFIX_MSG = os.environ.get("S3_PREFIX_MSG") or "messages/"
+S3_PREFIX_IDX = os.environ.get("S3_PREFIX_IDX") or "index/"
 
 EVENTS_DIR = os.path.join(os.path.dirname(__file__), 'events')
 MAX_EVENTS = 3
 
 
-def list_messages():
-    ''' List messages received today. 
-    Return list of tuple pairs of (index_key, data_key) for each message.
-    '''
-    client = boto3.client('s3')
-    ts = datetime.now()
-    search_prefix = f"{S3_PREFIX_IDX}{ts:%Y/%m/%d}/"
-    response = client.list_objects(Bucket=S3_BUCKET, Prefix=search_prefix)
-    # Example Index Key:  'index/2021/09/13/85eu2d3ichl5bfpfemfn2m78di6sl6k2l54dlp01.json'
-    return [ (x['Key'], S3_PREFIX_MSG + x['Key'][len(search_prefix):-5]) for x in response['Contents'] ]
+def parse_verdicts(values):
+    """Map "spam=PASS" style arguments to {"spamVerdict": {"PASS"}}."""
+    verdicts = {}
+    for value in values:
+        name, _, status = value.partition("=")
+        if not status:
+            raise ValueError("Verdict must be NAME=STATUS: %s" % (value,))
+        if not name.endswith("Verdict"):
+            name += "Verdict"
+        verdicts.setdefault(name, set()).add(status.upper())
+    return verdicts
+
+
+def matches(notification, senders=None, verdicts=None):
+    """True if a notification is from one of `senders` and has one of the statuses of each verdict."""
+    if senders and not any(s in senders for s in filters.sender_addresses(notification['mail'])):
+        return False
+    receipt = notification.get('receipt', {})
+    for name, statuses in (verdicts or {}).items():
+        if receipt.get(name, {}).get('status', "").upper() not in statuses:
+            return False
+    return True
+
+
+def select(records, senders=None, verdicts=None, sample=1.0, limit=0, rng=random):
+    """Filter and sample notifications, keeping the `limit` most recent (0 for all)."""
+    selected = (r for r in records if matches(r, senders, verdicts) and (sample >= 1 or rng.random() < sample))
+    if limit:
+        return heapq.nlargest(limit, selected, key=lambda r: r['mail']['timestamp'])
+    return sorted(selected, key=lambda r: r['mail']['timestamp'], reverse=True)
+
+
+def message_size(bucket, message_id):
+    """Size of a raw message, or None if it no longer exists."""
+    try:
+        return clients.get_client('s3').head_object(Bucket=bucket, Key=S3_PREFIX_MSG + message_id)['ContentLength']
+    except ClientError:
+        return None
+
 
+def filter_size(bucket, notifications, min_size=None, max_size=None, workers=query_index.WORKERS):
+    """Keep the notifications whose raw message size is within the limits."""
+    with ThreadPoolExecutor(workers) as pool:
+        sizes = pool.map(lambda n: message_size(bucket, n['mail']['messageId']), notifications)
+        return [n for n, size in zip(notifications, sizes) if size is not None and
+                (min_size is None or size >= min_size) and (max_size is None or size <= max_size)]
 
-def save_message_event(key):
-    ''' Download the event path provided by key and save in the EVENTS_DIR folder. '''
-    target = os.path.join(EVENTS_DIR, os.path.basename(key))
-    client = boto3.client('s3')
-    response = client.get_object(Bucket=S3_BUCKET, Key=key)
+
+def save_message_event(notification, output):
+    """Save a notification as an SES event in the `output` directory."""
+    target = os.path.join(output, notification['mail']['messageId'] + ".json")
     event = {
         "Records": [{
             "eventSource": "aws:ses",
             "eventVersion": "1.0",
-            "ses": json.load(response['Body'])
+            "ses": notification
         }]
     }
     with open(target, 'w') as f:
@@ -49,9 +102,79 @@ def save_message_event(key):
     return target
 
 
-todays_messages = sorted(list_messages())
-if len(todays_messages) >= MAX_EVENTS:
-    todays_messages = todays_messages[-MAX_EVENTS:]
-for (msg_event, msg_data) in todays_messages:
-    saved_filename = save_message_event(msg_event)
-    print("Saved:", saved_filename)
+def save_raw_message(bucket, message_id, output):
+    """Download a raw message to the `output` directory, unless already there.
+    
+    Returns
+    -------
+    Path of the message, or None if it no longer exists
+    
+    """
+    target = os.path.join(output, message_id + ".eml")
+    if not os.path.exists(target):
+        try:
+            response = clients.get_client('s3').get_object(Bucket=bucket, Key=S3_PREFIX_MSG + message_id)
+        except ClientError as e:
+            print("Unable to download %s: %s" % (message_id, e), file=sys.stderr)
+            return None
+        with open(target + ".tmp", 'wb') as f:
+            for chunk in response['Body'].iter_chunks(1024 * 1024):
+                f.write(chunk)
+        os.replace(target + ".tmp", target)
+    return target
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--bucket", default=S3_BUCKET, required=not S3_BUCKET)
+    parser.add_argument("--days", type=int, default=0, help="also include the DAYS days before --until")
+    parser.add_argument("--since", help="first day, YYYY/MM/DD")
+    parser.add_argument("--until", help="last day, YYYY/MM/DD (default today)")
+    parser.add_argument("--sender", action="append", default=[], help="sender address or domain, may be repeated")
+    parser.add_argument("--verdict", action="append", default=[], help="NAME=STATUS, e.g. spam=PASS, may be repeated")
+    parser.add_argument("--min-size", type=int, help="minimum raw message size in bytes")
+    parser.add_argument("--max-size", type=int, help="maximum raw message size in bytes")
+    parser.add_argument("--sample", type=float, default=1.0, help="fraction of the matching messages to keep")
+    parser.add_argument("--seed", type=int, help="random seed for --sample")
+    parser.add_argument("--limit", type=int, default=MAX_EVENTS, help="keep the LIMIT most recent, 0 for all")
+    parser.add_argument("--raw", action="store_true", help="also save the raw messages as <messageId>.eml")
+    parser.add_argument("--output", default=EVENTS_DIR, help="output directory")
+    parser.add_argument("--cache-dir", default=query_index.CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=query_index.WORKERS, help="concurrent downloads")
+    args = parser.parse_args(argv)
+
+    until = datetime.strptime(args.until, "%Y/%m/%d") if args.until else query_index.today()
+    since = datetime.strptime(args.since, "%Y/%m/%d") if args.since else until - timedelta(days=args.days)
+    days = query_index.day_range(since, until)
+    senders = filters.AddressSet(args.sender)
+    try:
+        verdicts = parse_verdicts(args.verdict)
+    except ValueError as e:
+        parser.error(str(e))
+
+    cache = query_index.IndexCache(args.bucket, args.cache_dir, prefix=S3_PREFIX_IDX, workers=args.workers)
+    downloaded = cache.sync(days)
+    print("Downloaded %d index objects" % (downloaded,), file=sys.stderr)
+    rng = random.Random(args.seed)
+    if args.min_size is None and args.max_size is None:
+        notifications = select(cache.records(days), senders, verdicts, args.sample, args.limit, rng)
+    else:
+        notifications = select(cache.records(days), senders, verdicts, args.sample, 0, rng)
+        notifications = filter_size(args.bucket, notifications, args.min_size, args.max_size, args.workers)
+        if args.limit:
+            notifications = notifications[:args.limit]
+
+    os.makedirs(args.output, exist_ok=True)
+    for notification in notifications:
+        print("Saved:", save_message_event(notification, args.output))
+    if args.raw:
+        with ThreadPoolExecutor(args.workers) as pool:
+            for target in pool.map(lambda n: save_raw_message(args.bucket, n['mail']['messageId'], args.output),
+                                   notifications):
+                if target:
+                    print("Saved:", target)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
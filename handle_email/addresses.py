@@ -0,0 +1,100 @@
+"""Parsing and rewriting of the address lists of header fields.
+
+Header values are parsed with `email.utils.getaddresses`, so quoted display
+names holding commas or angle brackets, comments, encoded words and lists of
+several addresses are handled.  Each address is rewritten to a form within
+the sending domain that preserves the original, "user@example.com" becoming
+"user_example.com@<domain>", and display names are kept as they were:
+
+    "Doe, John" <john@example.com>, =?utf-8?q?Ren=C3=A9?= <rene@example.org>
+    "Doe, John" <john_example.com@source.com>, =?utf-8?q?Ren=C3=A9?= <rene_example.org@source.com>
+
+The same senders repeat heavily, so rewritten values are kept in a
+per-container LRU cache of ADDRESS_CACHE_SIZE entries, keyed on the value and
+the domain.
+"""
+import os
+from functools import lru_cache
+from email.utils import formataddr, getaddresses
+
+
+ADDRESS_CACHE_SIZE = int(os.environ.get("ADDRESS_CACHE_SIZE") or 4096)
+SPECIALS = '()<>@,:;".[]\\'
+
+
+def parse(value):
+    """List of (display name, address) of a header value; empty addresses are dropped.
+
+    A value with an "@" that does not parse as an address list is taken as one
+    address; values without any address, such as "<>", give an empty list.
+    """
+    pairs = [(name, addr) for name, addr in getaddresses([value]) if addr]
+    if not pairs and "@" in value:
+        pairs = [("", value.strip().strip("<>").strip())]
+    return pairs
+
+
+def format_address(name, addr):
+    """Format a (display name, address) pair, quoting the name if needed.
+
+    Encoded words are left as they are.  Names with raw non-ASCII bytes
+    (surrogate escapes, see rewrite.field_value) are quoted and kept unchanged.
+    """
+    if not name:
+        return addr
+    try:
+        return formataddr((name, addr))
+    except UnicodeError:
+        if any(c in SPECIALS for c in name):
+            name = '"%s"' % (name.replace("\\", "\\\\").replace('"', '\\"'),)
+        return "%s <%s>" % (name, addr)
+
+
+def user_part(addr):
+    """The original address as a local part:  "user@example.com" becomes "user_example.com"."""
+    return addr.strip().replace("@", "_")
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def transform(value, domain):
+    """Rewrite every address of a header value into `domain`, keeping display names.
+
+    Returns
+    -------
+    New header value, addresses separated by ", "
+
+    """
+    return ", ".join(format_address(name, "%s@%s" % (user_part(addr), domain)) for name, addr in parse(value))
+
+
+def transform_all(values, domain):
+    """Rewrite the addresses of several header values, see `transform`.
+
+    Returns
+    -------
+    List of new header values, in the order of `values`
+
+    """
+    return [transform(value, domain) for value in values]
+
+
+def users(value):
+    """Local parts (see `user_part`) of every address of a header value."""
+    return [user_part(addr) for _, addr in parse(value)]
+
+
+def addresses(values):
+    """Unique addresses of header values or plain addresses, in order of first appearance.
+
+    Addresses are compared without case, and the first spelling is kept.
+    """
+    unique = {}
+    for _, addr in getaddresses(list(values)):
+        if addr:
+            unique.setdefault(addr.lower(), addr)
+    return list(unique.values())
+
+
+def cache_info():
+    """Hits, misses and size of the LRU cache of `transform`."""
+    return transform.cache_info()
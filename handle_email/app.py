@@ -1,16 +1,14 @@
 import os
 import json
 import logging
-import boto3
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from botocore.exceptions import ClientError
-###
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-###
-from email.parser import BytesParser
-from email.message import EmailMessage
 from datetime import datetime, timezone
+try:
+    from . import addresses, clients, filters, headers, index, ledger, metrics, rewrite, routing, sender, spool, wrap
+except ImportError:  # Lambda loads this file as a top-level module
+    import addresses, clients, filters, headers, index, ledger, metrics, rewrite, routing, sender, spool, wrap
 
 
 # Set environment variable "LOGLEVEL" to "DEBUG" to enable additional logging.
@@ -23,40 +21,52 @@ S3_PREFIX_ERR = os.environ.get("S3_PREFIX_ERR") or "errors/"
 EMAIL_DOM = os.environ.get("EMAIL_DOM")
 DEST_DOM = os.environ.get("DEST_DOM")
 NOTICE_TOPIC = os.environ.get("NOTICE_TOPIC")
+# Number of records processed concurrently by handle_ses_notice.
+#   When greater than 1, the index put also overlaps the fetch/forward of each message.
+RECORD_CONCURRENCY = int(os.environ.get("RECORD_CONCURRENCY") or 1)
+# Number of notifications processed concurrently by handle_ses_batch
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY") or 8)
+# Set environment variable "DLQ_DIGEST" to "true" to send one notice per Dead Letter Queue batch.
+DLQ_DIGEST = (False if os.environ.get("DLQ_DIGEST", "") in [None, "", "false"] else True)
+DIGEST_MAX_BYTES = 200 * 1024  # SNS messages are limited to 256 KiB
+# Number of error details read concurrently for a digest
+DIGEST_READ_CONCURRENCY = 8
+
+# Headers holding the source address; these must be verified identities within SES
+SOURCE_HEADERS = ["From", "Source", "Sender", "Return-Path"]
 
 log = logging.getLogger()
 log.setLevel(LOGLEVEL)
 
 
+class RecordProcessingError(Exception):
+    """Raised when more than one record in an event failed to process.
+    
+    The individual exceptions are available in the `errors` attribute.
+    """
+    def __init__(self, errors):
+        super().__init__("%d records failed: %s" % (len(errors), "; ".join(repr(e) for e in errors)))
+        self.errors = errors
+
+
 def transform_address(addr, user_only=False):
-    """Transform an email address into a form that preserves the original.
+    """Transform the email addresses of a header value into a form that preserves the original.
+    
+    Every address of the value is rewritten into EMAIL_DOM, keeping display 
+    names (see addresses.transform).
     
     Parameters
     ----------
     addr: str, required
-        Email Address to be transformed
+        Email Address, or header value with a list of addresses, to be transformed
     
     user_only: bool, optional
-        If True, returns only the "user" field of the email address
+        If True, returns only the "user" field of the first email address
     
     """
-    # There should be a regex that can do this, but this works too.
-    addr = addr.strip()
-    addr = addr.rstrip(">")
-    addr_split = addr.split("<")
-    if len(addr_split) > 1:
-        display_name = addr_split[0].strip()
-        user_part = addr_split[1].replace("@", "_")
-    else:
-        display_name = ""
-        user_part = addr_split[0].replace("@", "_")
-    # Return Result
     if user_only:
-        return user_part
-    elif len(display_name) > 0:
-        return f"{display_name} <{user_part}@{EMAIL_DOM}>"
-    else:
-        return f"{user_part}@{EMAIL_DOM}"
+        return next(iter(addresses.users(addr)), "")
+    return addresses.transform(addr, EMAIL_DOM)
 
 
 def save_message_index(data):
@@ -74,7 +84,7 @@ def save_message_index(data):
     source = transform_address(data['mail']['source'], user_only=True)
     object_key = f"{S3_PREFIX_IDX}{ts:%Y/%m/%d}/{ts:%Y%m%dT%H%M%S}_{source}_{data['mail']['messageId']}.json"
     log.info("Saving Message Index: s3://%s/%s", S3_BUCKET, object_key)
-    client = boto3.client('s3')
+    client = clients.get_client('s3')
     response = client.put_object(
         Bucket=S3_BUCKET,
         Key=object_key,
@@ -84,22 +94,86 @@ def save_message_index(data):
     return object_key
 
 
-def save_message_error(mid, data):
-    ts = datetime.now()
-    object_key = f"{S3_PREFIX_ERR}{ts:%Y/%m/%d}/{ts:%Y%m%dT%H%M%S}_{mid}.eml"
+def error_keys(mid, timestamp=None, mode=None):
+    """S3 keys of the failed outgoing message and its error details.
+    
+    Parameters
+    ----------
+    mid: string, required
+        Message ID as reported by SES
+    
+    timestamp: string, optional
+        SES receipt timestamp of the message ("mail.timestamp"); the current 
+        time if not provided
+    
+    mode: string, optional
+        Forwarding mode of the failed message; messages wrapped in a new 
+        message ("rfc822" or "attachment") are saved as "<mid>.<mode>.eml", 
+        so each group of recipients keeps its own copy.  There is one details 
+        object per message.
+    
+    Returns
+    -------
+    Tuple of (message key, details key)
+    
+    """
+    if timestamp:
+        ts = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")  # "timestamp":"2015-09-11T20:32:33.936Z",
+    else:
+        ts = datetime.now(timezone.utc)
+    object_key = f"{S3_PREFIX_ERR}{ts:%Y/%m/%d}/{mid}"
+    message_key = object_key + (".eml" if mode in (None, "inline") else f".{mode}.eml")
+    return message_key, object_key + ".json"
+
+
+def save_message_error(mid, data, timestamp=None, details=None, mode=None):
+    """Save a message that could not be sent, and the error details, to the S3 Bucket.
+    
+    Keys are derived from the message ID, receipt timestamp and forwarding mode 
+    (see error_keys), so a retry of the same message replaces them.
+    
+    Parameters
+    ----------
+    details: dict, optional
+        Error details, saved as JSON next to the message
+    
+    mode: string, optional
+        Forwarding mode of the message
+    
+    """
+    object_key, details_key = error_keys(mid, timestamp, mode)
     log.info("Saving Message with Error: s3://%s/%s", S3_BUCKET, object_key)
-    client = boto3.client('s3')
+    client = clients.get_client('s3')
     response = client.put_object(
         Bucket=S3_BUCKET,
         Key=object_key,
         Body=data,
         ContentType='text/plain'
     )
+    details = dict(details or {}, messageId=mid, timestamp=timestamp, mode=mode or "inline",
+                   saved=datetime.now(timezone.utc).isoformat(), message=object_key)
+    response = client.put_object(
+        Bucket=S3_BUCKET,
+        Key=details_key,
+        Body=json.dumps(details),
+        ContentType='application/json'
+    )
     return object_key
 
 
+def read_message_error(mid, timestamp, bucket=None):
+    """Error details saved by save_message_error, or None if there are none."""
+    try:
+        response = clients.get_client('s3').get_object(Bucket=bucket or S3_BUCKET, Key=error_keys(mid, timestamp)[1])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404', 'AccessDenied'):
+            return None
+        raise
+    return json.load(response['Body'])
+
+
 def send_admin_notice(msg_body, msg_subj):
-    client = boto3.client('sns')
+    client = clients.get_client('sns')
     response = client.publish(
         TopicArn=NOTICE_TOPIC,
         Subject=msg_subj,
@@ -108,9 +182,49 @@ def send_admin_notice(msg_body, msg_subj):
     return response['MessageId']
 
 
-def forward_message(mid, recpt):
+def download_message(mid, stats, max_size=None):
+    """Download a message from S3 into a spool file.
+    
+    Parameters
+    ----------
+    mid: string, required
+        Message ID as reported by SES
+    
+    stats: metrics.Metrics, required
+        Records the S3Get stage and message size
+    
+    max_size: callable, optional
+        Called with the message size before the body is downloaded, see 
+        forward_message
+    
+    Returns
+    -------
+    Tuple of (file, size), see spool.spool_body
+    
+    """
+    with stats.stage("S3Get"):
+        s3_client = clients.get_client('s3')
+        s3_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"{S3_PREFIX_MSG}{mid}")
+        # s3_obj['Body'] = botocore.response.StreamingBody
+        try:
+            if max_size is not None:
+                max_size(s3_obj.get('ContentLength'))
+            spool.check_size(s3_obj.get('ContentLength'))
+        except Exception:
+            s3_obj['Body'].close()
+            raise
+        
+        log.debug("Reading Message: s3://%s/%s", S3_BUCKET, f"{S3_PREFIX_MSG}{mid}")
+        raw_file, raw_size = spool.spool_body(s3_obj['Body'])
+    stats.put("MessageBytes", raw_size, "Bytes")
+    return raw_file, raw_size
+
+
+def forward_message(mid, recpt, stats=None, remaining_ms=None, max_size=None, timestamp=None, mode="inline",
+                    message_ledger=None, raw=None):
     """Download email message from S3 storage location using message ID,
-       then forward the message by modifying source and destination header field.
+       then forward the message by modifying source and destination header field, 
+       or wrapped in a new message.
        
     Parameters
     ----------
@@ -120,17 +234,68 @@ def forward_message(mid, recpt):
     recpt: list, required
         Email recipient list
     
+    stats: metrics.Metrics, optional
+        Records stage timings and message size; not emitted by this function
+    
+    remaining_ms: callable, optional
+        Returns the remaining time in milliseconds, used to bound retries when 
+        sending is throttled (context.get_remaining_time_in_millis)
+    
+    max_size: callable, optional
+        Called with the message size before the body is downloaded, 
+        may raise filters.Rejected (see filters.FilterPipeline.check_size)
+    
+    timestamp: string, optional
+        SES receipt timestamp, used for the key of the message saved on error
+    
+    mode: string, optional
+        "inline" (default) to rewrite the headers of the message, or "rfc822" 
+        or "attachment" to wrap it in a new message (see wrap_message)
+    
+    message_ledger: ledger.Ledger, optional
+        If provided, each batch is recorded as a part (keyed on the mode and 
+        the recipients of the batch) as soon as it is sent, and batches 
+        recorded by an earlier attempt are not sent again
+    
+    raw: tuple, optional
+        (file, size) of the message already downloaded by download_message, 
+        used instead of downloading it; the file is left open
+    
     Returns
     -------
-    Outgoing Message ID, if successful, or None
+    Outgoing Message ID.  When the recipients are sent in batches (more than 
+    routing.MAX_RECIPIENTS), a list of Outgoing Message IDs.
     
-    """
-    s3_client = boto3.client('s3')
-    s3_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"{S3_PREFIX_MSG}{mid}")
-    # s3_obj['Body'] = botocore.response.StreamingBody
+    Raises
+    ------
+    spool.MessageTooLarge if the message is larger than the SES limit, 
+    before any send is attempted.
     
-    log.debug("Reading Message: s3://%s/%s", S3_BUCKET, f"{S3_PREFIX_MSG}{mid}")
-    msg = BytesParser().parsebytes(s3_obj['Body'].read())
+    filters.Rejected if rejected by `max_size`.
+    
+    ClientError if sending fails, after the outgoing message and error details 
+    are saved with prefix S3_PREFIX_ERR.
+    
+    """
+    stats = stats or metrics.Metrics()
+    # SES accepts at most 50 recipients per message, larger lists are sent in 
+    #   batches of the same message using the envelope destination.
+    batches = routing.chunked(recpt)
+    sent = {}
+    if message_ledger is not None:
+        with stats.stage("Ledger"):
+            for number, batch in enumerate(batches):
+                entry = message_ledger.lookup(mid, batch, part=mode)
+                if entry is not None:
+                    sent[number] = entry['outgoing']
+        if len(sent) == len(batches):
+            log.info("Message %s already forwarded to %s as %s", mid, recpt, list(sent.values()))
+            return sent[0] if len(sent) == 1 else list(sent.values())
+    if raw is None:
+        raw_file, raw_size = download_message(mid, stats, max_size)
+    else:
+        raw_file, raw_size = raw
+        raw_file.seek(0)
     
     # Amazon SES will automatically apply its own "Message-ID" and "Date" headers; 
     #   if you passed these headers when creating the message, 
@@ -138,121 +303,153 @@ def forward_message(mid, recpt):
     # "From", "Source", "Sender", and "Return-Path" headers must be verified identities within SES
     # If your account is still in the Amazon SES sandbox, 
     #   you also need to verify "To", "CC", and "BCC" recipients.
-    for src_header in ["From", "Source", "Sender", "Return-Path"]:
-        if src_header in msg.keys():
-            msg.replace_header(src_header, transform_address(msg.get(src_header)))
-            log.debug("New Source Header %s: %s", src_header, msg.get(src_header))
     # Replace the To field with the provided recipient list, 
     #   delete CC and BCC to prevent errors and duplicates.
-    msg.replace_header("To", ",".join(recpt))
-    log.debug("New Recipient: %s", msg.get("To"))
-    del msg["CC"]
-    del msg["BCC"]
+    # Replies go to the original sender:  Reply-To is added from From when missing.
+    # Only the headers are parsed; the body is passed through byte for byte.
+    timed_transform = stats.timed("Transform", transform_address)
+    # A message spooled by the caller is left open for its other groups
+    with (raw_file if raw is None else nullcontext()), stats.stage("Rewrite"):
+        if mode == "inline":
+            data = rewrite.rewrite_file(
+                raw_file, raw_size,
+                transform={src_header: timed_transform for src_header in SOURCE_HEADERS},
+                replace={"To": ", ".join(recpt)},
+                delete=["CC", "BCC"],
+                copy={"Reply-To": "From"}
+            )
+        else:
+            spool.check_size(wrap.wrapped_size(raw_size, mode))
+            data = wrap_message(mid, raw_file, raw_size, recpt, mode, timed_transform)
+    log.debug("New Recipient: %s", recpt)
+    spool.check_size(len(data))
+    # The high-water mark of the container since it started, not of this message:  
+    #   messages processed concurrently share the process, so it cannot be reset per message.
+    peak_rss = spool.peak_rss_kib()
+    stats.put("ContainerPeakRSS", peak_rss, "Kilobytes")
+    log.info("Message %s Size: %d bytes in, %d bytes out, container peak RSS %d KiB", 
+        mid, raw_size, len(data), peak_rss)
     
-    # Try to send the message
+    # Try to send the message, waiting for the send rate and retrying throttles.
+    message_ids = []
     try:
-        ses_client = boto3.client('sesv2')
-        response = ses_client.send_email(Content={'Raw': {'Data': msg.as_string()}})
+        for number, batch in enumerate(batches):
+            if number in sent:
+                log.info("Message %s batch %d already forwarded as %s", mid, number + 1, sent[number])
+                message_ids.append(sent[number])
+                continue
+            destination = {'Destination': {'ToAddresses': batch}} if len(batches) > 1 else {}
+            with stats.stage("Send"):
+                response = sender.get_scheduler().send_email(
+                    Content={'Raw': {'Data': data}}, remaining_ms=remaining_ms, stats=stats, **destination)
+            message_ids.append(response['MessageId'])
+            if message_ledger is not None:
+                message_ledger.record(mid, batch, response['MessageId'], part=mode)
     # Display an error if something goes wrong.	
     except ClientError as e:
         log.error("Error Forwarding %s: <%s> %s", mid, e.response['Error']['Code'], e.response['Error']['Message'])
-        save_message_error(mid, msg.as_string())
+        stats.set_outcome("SendError")
+        save_message_error(mid, data, timestamp, {
+            "errorCode": e.response['Error']['Code'],
+            "errorMessage": e.response['Error']['Message'],
+            "attempts": getattr(e, 'attempts', 1),
+            "size": len(data),
+            "recipients": recpt,
+            "sent": message_ids,
+        }, mode)
+        # Raise so the event goes to the Dead Letter Queue
+        raise
     else:
-        log.info("Email Forwarded! Message ID: %s forwarded as %s to %s", mid, response['MessageId'], recpt)
-        return response['MessageId']
+        log.info("Email Forwarded! Message ID: %s forwarded as %s to %s", mid, ",".join(message_ids), recpt)
+        return message_ids[0] if len(message_ids) == 1 else message_ids
 
 
-def forward_message_att(mid, recpt, subj, dry_run=False):
+def forward_message_att(mid, recpt, mode="attachment", **kwargs):
     """Download email message from S3 storage location using message ID,
-       then forward the message as an attachment.
-       
-       Warning:  This does not quite work correctly.  Messages are mangled when forwarding.
+       then forward the message as an attachment, or as a message/rfc822 part.
+    
+    See forward_message for the other parameters.
+    
+    """
+    return forward_message(mid, recpt, mode=mode, **kwargs)
+
+
+def wrap_message(mid, raw_file, raw_size, recpt, mode, transform=transform_address):
+    """Wrap a raw message in a new message, sent from the transformed original sender.
+    
+    Replies go to the Reply-To or From of the original, and the subject is 
+    that of the original with a "[FWD] " prefix.  See wrap.wrap_file.
     
     Parameters
     ----------
-    mid: string, required
-        Message ID as reported by SES
+    raw_file: file-like, required
+        Seekable file object holding the raw message
     
-    recpt: list, required
-        Email recipient list
+    raw_size: int, required
+        Size of the raw message in bytes
+    
+    mode: string, required
+        "rfc822" or "attachment"
     
-    subj: string, required
-        Email subject
+    transform: callable, optional
+        Applied to the From address, transform_address by default
     
     Returns
     -------
-    Outgoing Message ID, if successful, or None
+    New raw message, as a bytearray
     
     """
-    s3_client = boto3.client('s3')
-    s3_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"{S3_PREFIX_MSG}{mid}")
-    # s3_obj['Body'] = botocore.response.StreamingBody
-    
-    # Message Composition Options
-    BODY_TEXT = f"Hello,\r\nPlease see the attached file for the forwarded message.\r\nMessage ID: {mid}"
-    BODY_HTML = f"""\
-    <html>
-    <body>
-    <p>Please see the attached file for the forwarded message.</p>
-    <p>Message ID:  {mid}
-    </body>
-    </html>
-    """
-    CHARSET = "utf-8"
-    
-    # Create a multipart/mixed parent container.
-    msg = MIMEMultipart('mixed')
-    
-    # Add subject, from and to lines.
-    msg['Subject'] = subj
-    msg['To'] = ", ".join(recpt)
-    msg_body = MIMEMultipart('alternative')
-    # Encode the text and HTML content and set the character encoding. This step is
-    # necessary if you're sending a message with characters outside the ASCII range.
-    textpart = MIMEText(BODY_TEXT.encode(CHARSET), 'plain', CHARSET)
-    htmlpart = MIMEText(BODY_HTML.encode(CHARSET), 'html', CHARSET)
-    # transform "From" address to preserve original parts
-    sender = transform_address(att.get('From'))
-    msg['From'] = sender
-    
-    # Add the text and HTML parts to the child container.
-    msg_body.attach(textpart)
-    msg_body.attach(htmlpart)
-
-    # Attach the multipart/alternative child container to the multipart/mixed
-    # parent container.
-    msg.attach(msg_body)
-    
-    # Define the attachment part and encode it using MIMEApplication.
-    att = MIMEApplication(s3_obj['Body'].read())
-    #att = BytesParser().parsebytes(s3_obj['Body'].read())
-
-    # Add a header to tell the email client to treat this part as an attachment,
-    # and to give the attachment a name.
-    att.add_header('Content-Disposition','attachment',filename="orig.eml")
-    # Add the attachment to the parent container.
-    msg.attach(att)
-    
-    if dry_run:
-        with open('message.eml', 'w') as f:
-            f.write(msg.as_string())
-            return('message.eml')
+    header_block, _, _ = rewrite.read_header_block(raw_file)
+    fields = {}
+    for name, raw_field in rewrite.parse_header_block(header_block):
+        fields.setdefault(name.lower(), rewrite.field_value(raw_field))
+    original_from = fields.get("from", "")
+    new_headers = [
+        ("From", transform(original_from)),
+        ("Reply-To", fields.get("reply-to") or original_from),
+        ("To", ", ".join(recpt)),
+        ("Subject", "[FWD] " + fields.get("subject", "")),
+    ]
+    note = f"Forwarded message from {original_from}\nMessage ID: {mid}\n"
+    return wrap.wrap_file(raw_file, raw_size, mode, [(n, v) for n, v in new_headers if v], note)
 
-    try:
-        ses_client = boto3.client('ses')
-        #Provide the contents of the email.
-        response = ses_client.send_raw_email(
-            Source=sender,
-            Destinations=recpt,
-            RawMessage={'Data': msg.as_string()}
-        )
-    # Display an error if something goes wrong.	
-    except ClientError as e:
-        log.error("Error Forwarding Attachment %s: <%s> %s", mid, type(e), e.response['Error']['Message'])
-        save_message_error(mid, msg.as_string())
+
+def forward_routed(mid, groups, message_ledger=None, **kwargs):
+    """Forward a message to each group of recipients with its forwarding mode.
+    
+    Parameters
+    ----------
+    groups: dict, required
+        Forwarding mode to list of recipients (see routing.Router.route_modes)
+    
+    message_ledger: ledger.Ledger, optional
+        Records each send as soon as it succeeds when the message is sent more 
+        than once, see forward_message.  A single send is only recorded by the 
+        caller, for all recipients.
+    
+    See forward_message for the other parameters.
+    
+    Returns
+    -------
+    Outgoing Message ID, or a list of Outgoing Message IDs if more than one 
+    message was sent
+    
+    """
+    if sum(len(routing.chunked(recpt)) for recpt in groups.values()) < 2:
+        message_ledger = None
+    if len(groups) < 2:
+        message_ids = [forward_message(mid, recpt, mode=mode, message_ledger=message_ledger, **kwargs)
+                       for mode, recpt in groups.items()]
     else:
-        log.info("Email Forwarded as Attachment! Message ID: %s forwarded as %s to %s", mid, response['MessageId'], recpt)
-        return response['MessageId']
+        # The message is downloaded once, and each group's message is built from the spool file
+        kwargs['stats'] = kwargs.get('stats') or metrics.Metrics()
+        raw_file, raw_size = download_message(mid, kwargs['stats'], kwargs.get('max_size'))
+        with raw_file:
+            message_ids = [forward_message(mid, recpt, mode=mode, message_ledger=message_ledger,
+                                           raw=(raw_file, raw_size), **kwargs)
+                           for mode, recpt in groups.items()]
+    message_ids = [i for result in message_ids for i in (result if isinstance(result, list) else [result])]
+    return message_ids[0] if len(message_ids) == 1 else message_ids
 
 
 def handle_ses_notice(event, context):
@@ -263,7 +460,7 @@ def handle_ses_notice(event, context):
     Parameters
     ----------
     event: dict, required
-        SES Input Format or SNS with SES Input Format
+        SES Input Format or SNS with SES Input Format (see events/sns_ses_event.json)
 
         Event doc: https://docs.aws.amazon.com/ses/latest/dg/receiving-email-action-lambda-event.html
         
@@ -319,43 +516,353 @@ def handle_ses_notice(event, context):
         CONTINUE or any other invalid value—This means that further actions and receipt rules can be processed.
     
     """
+    ses_notifications = []
     for record in event['Records']:
-        if record['eventSource'] != "aws:ses":
-            log.error("Unknown Event Source: %s", record['eventSource'])
-            log.error("Event Record: %s", record)
-            continue
-        ses_notification = record['ses']
-        log.debug("SES Notification: %s", ses_notification)
-        
-        # Save Message Data to S3
-        save_message_index(ses_notification)
-        
-        # Start Processing
-        message_id = ses_notification['mail']['messageId'] # Used as S3 Key for message
-        log.info("Processing Message ID: %s", message_id)
-        receipt = ses_notification['receipt']
-        
-        # Check SPAM, Virus, SPF, DKIM for passing
-        if (receipt['spamVerdict']['status'] != 'PASS' or
-            receipt['virusVerdict']['status'] != 'PASS' or
-            receipt['spfVerdict']['status'] != 'PASS' or
-            receipt['dkimVerdict']['status'] != 'PASS'):
-                log.info("Message %s Result: Failed Receipt Checks: %s", message_id, 
-                    dict([ (i[0], i[1]['status']) for i in receipt.items() if i[0].endswith("Verdict") ]))
-                continue
-        if (receipt['dmarcVerdict']['status'] != 'PASS' and 
-            receipt.get('dmarcPolicy', {"status": "none"})['status'].upper() == 'REJECT'):
-                log.info("Message %s Result: Failed DMARC with reject policy", message_id)
-                continue
+        ses_notifications.extend(record_notifications(record))
+    
+    index_writer = None
+    if index.INDEX_FORMAT == "ndjson":
+        index_writer = index.IndexWriter(S3_BUCKET, S3_PREFIX_IDX)
+    try:
+        errors = process_records(ses_notifications, context, index_writer)
+    except Exception:
+        # Save the index of every record, without masking the error of the record that failed
+        if index_writer is not None:
+            try:
+                index_writer.flush()
+            except Exception:
+                log.exception("Unable to save the index")
+        raise
+    # Save the index of every record, even if one failed
+    if index_writer is not None:
+        index_writer.flush()
+    # Re-raise so the event goes to the Dead Letter Queue
+    if len(errors) == 1:
+        raise errors[0]
+    elif errors:
+        raise RecordProcessingError(errors)
+
+
+def process_records(ses_notifications, context=None, index_writer=None):
+    """Process SES notifications, RECORD_CONCURRENCY at a time.
+    
+    Returns
+    -------
+    List of exceptions raised by the records that failed; when processed 
+    sequentially, the first error is raised instead
+    
+    """
+    if RECORD_CONCURRENCY <= 1:
+        for ses_notification in ses_notifications:
+            process_ses_notification(ses_notification, context=context, index_writer=index_writer)
+        return []
+    
+    items = [(None, ses_notification) for ses_notification in ses_notifications]
+    return [e for _, e in process_concurrently(items, RECORD_CONCURRENCY, context, index_writer)]
+
+
+def process_concurrently(items, concurrency, context=None, index_writer=None):
+    """Process SES notifications `concurrency` at a time, overlapping each index put.
+    
+    Parameters
+    ----------
+    items: list, required
+        (item identifier, SES notification) pairs; the identifier is 
+        returned with the errors of the notification
+    
+    Returns
+    -------
+    List of (item identifier, exception) for the notifications that failed
+    
+    """
+    errors = []
+    with ThreadPoolExecutor(concurrency) as pool, ThreadPoolExecutor(concurrency) as index_pool:
+        futures = {
+            pool.submit(process_ses_notification, ses_notification, index_pool, context, index_writer): (item_id, ses_notification)
+            for item_id, ses_notification in items
+        }
+        for future in as_completed(futures):
+            item_id, ses_notification = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.error("Error Processing Message ID %s: %r", ses_notification['mail']['messageId'], e)
+                errors.append((item_id, e))
+    return errors
+
+
+def handle_ses_batch(event, context):
+    """Lambda function to handle batches of SES notifications from SQS
+    
+    SES publishes each message to an SNS topic, with the raw message saved by 
+    an S3 action, and the topic delivers it to an SQS queue polled by this 
+    function.  A batch of notifications shares the clients of the container 
+    and is processed BATCH_CONCURRENCY at a time.  Direct SES and SNS events 
+    are accepted as by handle_ses_notice.
+    
+    Parameters
+    ----------
+    event: dict, required
+        SQS Input Format, with bodies that are SES notifications (SNS raw 
+        message delivery), SNS notifications or SES events; or SES Input 
+        Format, or SNS with SES Input Format
+
+        Sample SQS Event Structure::
         
+            {
+                "Records": [
+                    {
+                        "eventSource": "aws:sqs",
+                        "messageId": "059f36b4-87a3-44ab-83d2-661975830a7d",
+                        "body": "{\"notificationType\": \"Received\", \"mail\": {...}, \"receipt\": {...}}",
+                        [...]
+                    },
+                    [...]
+                ]
+            }
+
+    context: object, required
+        Lambda Context runtime methods and attributes
+
+    Returns
+    -------
+    Partial batch response listing the SQS messages that failed and should be redelivered::
+    
+        {"batchItemFailures": [{"itemIdentifier": "059f36b4-87a3-44ab-83d2-661975830a7d"}]}
+    
+    Failures of records that are not from SQS are raised, as by handle_ses_notice.
+    
+    """
+    items = []  # (SQS message ID or None, SES notification)
+    failed_ids = []
+    for record in event['Records']:
+        item_id = record.get('messageId') if record_source(record) == "aws:sqs" else None
+        try:
+            notifications = record_notifications(record)
+        except (ValueError, KeyError, TypeError) as e:
+            if item_id is None:
+                raise
+            # Retried, then moved to the Dead Letter Queue where it is reported
+            log.error("Unable to Read Queue Message %s: %r", item_id, e)
+            failed_ids.append(item_id)
+            continue
+        items.extend((item_id, n) for n in notifications)
+    
+    index_writer = None
+    if index.INDEX_FORMAT == "ndjson":
+        index_writer = index.IndexWriter(S3_BUCKET, S3_PREFIX_IDX)
+    errors = process_concurrently(items, BATCH_CONCURRENCY, context, index_writer)
+    if index_writer is not None:
+        try:
+            index_writer.flush()
+        except Exception as e:
+            # Every message is retried so that its index is saved; the ledger skips sending again
+            log.exception("Error Saving the Index of %d Messages", len(items))
+            errors = [(item_id, e) for item_id, _ in items]
+    
+    failed_ids.extend(item_id for item_id, _ in errors if item_id is not None)
+    raised = [e for item_id, e in errors if item_id is None]
+    if len(raised) == 1:
+        raise raised[0]
+    elif raised:
+        raise RecordProcessingError(raised)
+    return {"batchItemFailures": [{"itemIdentifier": i} for i in dict.fromkeys(failed_ids)]}
+
+
+def record_source(record):
+    """Event source of a record; SNS records use "EventSource"."""
+    return record.get('eventSource') or record.get('EventSource')
+
+
+def record_notifications(record):
+    """SES notifications of an SES, SNS or SQS event record.
+    
+    Records from any other source are logged and skipped.
+    
+    Raises
+    ------
+    ValueError, KeyError or TypeError if the record cannot be read
+    
+    """
+    source = record_source(record)
+    if source == "aws:ses":
+        return [record['ses']]
+    elif source == "aws:sns":
+        return sns_notifications(record['Sns']['Message'])
+    elif source == "aws:sqs":
+        return body_notifications(record['body'])
+    log.error("Unknown Event Source: %s", source)
+    log.error("Event Record: %s", record)
+    return []
+
+
+def body_notifications(body):
+    """SES notifications of an SQS message body.
+    
+    The body is an SES event (as sent to a Dead Letter Queue), an SNS 
+    notification, or an SES notification (SNS raw message delivery).  Other 
+    SNS messages, such as subscription confirmations, are logged and skipped.
+    """
+    message = json.loads(body) if isinstance(body, str) else body
+    if 'Records' in message:
+        notifications = []
+        for record in message['Records']:
+            notifications.extend(record_notifications(record))
+        return notifications
+    if message.get('Type') == "Notification" and 'Message' in message:
+        return sns_notifications(message['Message'])
+    if 'Type' in message and 'TopicArn' in message:
+        log.info("Skipping SNS %s message from %s", message['Type'], message['TopicArn'])
+        return []
+    return sns_notifications(message)
+
+
+def sns_notifications(message):
+    """The SES notification of an SNS message, in the format of SES events.
+    
+    SNS notifications also have a "notificationType", and a "content" when 
+    the SNS action includes the message; only "mail" and "receipt" are kept.  
+    Notifications of any other type than "Received", such as the 
+    "AmazonSnsSubscriptionSucceeded" test notification, are logged and skipped.
+    
+    Returns
+    -------
+    List of the SES notification, or an empty list
+    
+    Raises
+    ------
+    ValueError if the message is not an SES notification
+    
+    """
+    if isinstance(message, str):
+        message = json.loads(message)
+    notification_type = message.get('notificationType')
+    if isinstance(notification_type, str) and notification_type != "Received":
+        log.info("Skipping SES notification of type %s", notification_type)
+        return []
+    if 'mail' not in message or 'receipt' not in message:
+        raise ValueError("Not an SES notification: %s" % (message.get('notificationType') or sorted(message),))
+    return [{'mail': message['mail'], 'receipt': message['receipt']}]
+
+
+def process_ses_notification(ses_notification, index_executor=None, context=None, index_writer=None):
+    """Check, index and forward the message for a single SES notification.
+    
+    The filter pipeline runs first, using only the notification, so rejected 
+    messages cause no S3 or SES requests (unless sampled for the index).  
+    Header rules, and INDEX_EXTRA_HEADERS, read the headers from the start of 
+    the message only when SES truncated them in the notification.  
+    Messages already forwarded to the same recipients, as recorded in the 
+    ledger, are not indexed, downloaded or sent again.
+    
+    Parameters
+    ----------
+    ses_notification: dict, required
+        The "ses" member of an SES event record
+    
+    index_executor: concurrent.futures.Executor, optional
+        If provided, the index is saved using this executor while the message is
+        forwarded.  The index put is always waited for before returning.
+    
+    context: object, optional
+        Lambda Context, used for the remaining time when sending is throttled
+    
+    index_writer: index.IndexWriter, optional
+        If provided, the index is buffered by this writer instead of saved 
+        as one object per message
+    
+    Returns
+    -------
+    Outgoing Message ID, if forwarded, or None
+    
+    """
+    log.debug("SES Notification: %s", ses_notification)
+    message_id = ses_notification['mail']['messageId'] # Used as S3 Key for message
+    log.info("Processing Message ID: %s", message_id)
+    stats = metrics.Metrics(MessageId=message_id)
+    save_index = stats.timed("IndexPut", save_message_index if index_writer is None else index_writer.add)
+    pipeline = filters.get_pipeline()
+    message_headers = headers.MessageHeaders(ses_notification, S3_BUCKET, f"{S3_PREFIX_MSG}{message_id}", stats)
+    
+    # Check SPAM, Virus, SPF, DKIM, DMARC, senders, recipients and headers
+    try:
+        with stats.stage("Filter"):
+            recipients = pipeline.evaluate(ses_notification)
+            if pipeline.deny_headers:
+                pipeline.check_headers(message_headers)
+    except filters.Rejected as e:
+        log.info("Message %s Result: Rejected by %s: %s", message_id, e.rule, e.detail)
+        stats.set_outcome("Rejected")
+        stats.set_dimension("FilterRule", e.rule)
+        # Requests avoided:  index put, message get and send
+        saved_requests = 3
+        try:
+            if pipeline.sample_rejected():
+                save_index(index.enrich(ses_notification, message_headers))
+                saved_requests -= 1
+        finally:
+            stats.put("SavedRequests", saved_requests, "Count")
+            stats.flush()
+        return None
+    
+    # Skip messages forwarded by an earlier attempt
+    message_ledger = ledger.get_ledger(S3_BUCKET)
+    if message_ledger is not None:
+        with stats.stage("Ledger"):
+            entry = message_ledger.lookup(message_id, recipients)
+        if entry is not None:
+            log.info("Message %s Result: Already forwarded as %s", message_id, entry['outgoing'])
+            if index_writer is not None:
+                # The buffered index of the first attempt may not have been written
+                save_index(index.enrich(ses_notification, message_headers))
+            stats.set_outcome("Duplicate")
+            # Requests avoided:  index put, message get and send
+            stats.put("SavedRequests", 3, "Count")
+            stats.flush()
+            return entry['outgoing']
+    
+    # Save Message Data to S3
+    index_entry = index.enrich(ses_notification, message_headers)
+    if index_executor is None or index_writer is not None:
+        save_index(index_entry)
+        index_future = None
+    else:
+        index_future = index_executor.submit(save_index, index_entry)
+    
+    try:
         # Fail for testing
         if TESTFAILURES:
             log.error("Testing Failures, Message Not Forwarded: %s", message_id)
             raise Exception("Test Failure for %s" % (message_id,))
         
-        message_subj = "[FWD] " + ses_notification['mail']['commonHeaders']['subject']
-        message_recp = [ "@".join([e.split("@")[0], DEST_DOM]) for e in ses_notification['receipt']['recipients'] ]
-        result = forward_message(message_id, message_recp)
+        message_groups = routing.get_router().route_modes(recipients, DEST_DOM)
+        stats.put("RecipientCount", sum(len(recpt) for recpt in message_groups.values()), "Count")
+        remaining_ms = context.get_remaining_time_in_millis if context is not None else None
+        result = forward_routed(message_id, message_groups, stats=stats, remaining_ms=remaining_ms,
+                                max_size=pipeline.check_size, timestamp=ses_notification['mail']['timestamp'],
+                                message_ledger=message_ledger)
+        if result:
+            stats.set_outcome("Forwarded")
+            if message_ledger is not None:
+                message_ledger.record(message_id, recipients, result)
+        return result
+    except filters.Rejected as e:
+        log.info("Message %s Result: Rejected by %s: %s", message_id, e.rule, e.detail)
+        stats.set_outcome("Rejected")
+        stats.set_dimension("FilterRule", e.rule)
+        # Requests avoided:  send
+        stats.put("SavedRequests", 1, "Count")
+        return None
+    except Exception:
+        if stats.dimensions["Outcome"] == "Unknown":
+            stats.set_outcome("Failed")
+        raise
+    finally:
+        try:
+            if index_future is not None:
+                index_future.result()
+        finally:
+            stats.flush()
 
 
 def handle_dead_letter(event, context):
@@ -413,69 +920,238 @@ def handle_dead_letter(event, context):
 
         Context doc: https://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
 
+    Returns
+    -------
+    Partial batch response listing the SQS messages that failed and should be redelivered::
+    
+        {"batchItemFailures": [{"itemIdentifier": "059f36b4-87a3-44ab-83d2-661975830a7d"}]}
+    
     """
+    batch_failures = []
+    digest = []  # (sqs_message_id, failure) for DLQ_DIGEST
     for record in event['Records']:
         if record['eventSource'] != "aws:sqs":
             log.error("Unknown Event Source: %s", record['eventSource'])
             log.error("Event Record: %s", record)
             continue
-        # sqs_message_id = record["messageId"]
-        failed_req_id = record['messageAttributes']['RequestID']
-        failed_event = json.loads(record['body'])  # Decode JSON String body
-        log.info("Processing Failed Request ID: %s", failed_req_id)
-        log.debug("Failed Request ID %s Record: %s", failed_req_id, failed_event)
-        for failed_record in failed_event['Records']:
-            if failed_record['eventSource'] != "aws:ses":
-                log.error("Unknown Event Source: %s", failed_record['eventSource'])
-                log.error("Event Record: %s", failed_record)
-                continue
-            ses_notification = failed_record['ses']
-            log.debug("SES Notification: %s", ses_notification)
-            # Start Processing
-            message_id = ses_notification['mail']['messageId'] # Used as S3 Key for message
-            log.info("Processing Message ID: %s", message_id)
-            mail = ses_notification['mail']
-            # "mail": { "timestamp":"2015-09-11T20:32:33.936Z", "source":"user@example.com", 
-            #           "messageId":"d6iitobk75ur44p8kdnnp7g2n800", "destination":[ "recipient@example.com" ] }
-            log.info("Message Failure Details: %s", {
-                "messageId": mail['messageId'],
-                "timestamp": mail['timestamp'],
-                "source": mail['source'],
-                "destination": mail['destination']
-            })
-            
-            ts = datetime.strptime(mail['timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ")  # "timestamp":"2015-09-11T20:32:33.936Z",
-            source = transform_address(mail['source'], user_only=True)
-            dest_list = ", ".join(mail['destination'])
-
-            error_notice_body = "\n".join([
-                "Hello Admin,",
-                "",
-                "The applicaiton failed to forward a message.", 
-                "",
-                "Here are the message details:",
-                f"  Message ID: {mail['messageId']}",
-                f"  Timestamp: {mail['timestamp']}",
-                f"  Sender: {mail['source']}",
-                f"  Destination:  {dest_list}",
-                "",
-                "The original message should be available here:", 
-                f"s3://{S3_BUCKET}/{S3_PREFIX_MSG}{mail['messageId']}",
-                "  Note:  raw message can be downloaded and viewed in a text viewer or adding the '.eml' extention prompt it to open in an email client",
-                "",
-                "If saved, the notification from SES might be available here:", 
-                f"s3://{S3_BUCKET}/{S3_PREFIX_IDX}{ts:%Y/%m/%d}/{ts:%Y%m%dT%H%M%S}_{source}_{message_id}.json",
-                "",
-                "If the failure occured during sending, the failed message to be sent might be available here:", 
-                f"s3://{S3_BUCKET}/{S3_PREFIX_ERR}{ts:%Y/%m/%d}/{ts:%Y%m%d}THHMMSS_{message_id}.eml (timestamp may be different)",
-                "",
-                "Please investigate this failure.",
-                "",
-                "Thank you,",
-                "SES Forwarder",
-                "",
-                "Failed Record:",
-                json.dumps({"Records": [failed_record]})
-            ])
-            notice_msg_id = send_admin_notice(error_notice_body, "Failed Message Delivery: %s" % (mail['messageId'],))
-            log.info("Sent Notice to Admin: %s", notice_msg_id)
+        sqs_message_id = record["messageId"]
+        try:
+            failures = dead_letter_failures(record)
+        except (ValueError, KeyError, TypeError) as e:
+            # Malformed records will never succeed, report them instead of redelivering
+            log.error("Unable to Read Dead Letter %s: %r, Record: %s", sqs_message_id, e, record)
+            failures = [{"messageId": None, "timestamp": None, "source": None, "destination": [],
+                         "requestId": message_attribute(record, 'RequestID'), "errorCode": "Unreadable",
+                         "errorMessage": repr(e), "record": record.get('body')}]
+        if DLQ_DIGEST:
+            digest.extend((sqs_message_id, failure) for failure in failures)
+            continue
+        try:
+            for failure in failures:
+                notice_msg_id = send_admin_notice(failure_notice(failure),
+                    "Failed Message Delivery: %s" % (failure['messageId'] or sqs_message_id,))
+                log.info("Sent Notice to Admin: %s", notice_msg_id)
+        except Exception:
+            log.exception("Error Sending Notice for %s", sqs_message_id)
+            batch_failures.append({"itemIdentifier": sqs_message_id})
+    
+    if digest:
+        try:
+            with ThreadPoolExecutor(max_workers=DIGEST_READ_CONCURRENCY) as executor:
+                failures = list(executor.map(send_error, [failure for _, failure in digest]))
+            subject, body = failure_digest(failures)
+            notice_msg_id = send_admin_notice(body, subject)
+            log.info("Sent Digest of %d Failures to Admin: %s", len(digest), notice_msg_id)
+        except Exception:
+            log.exception("Error Sending Digest Notice")
+            batch_failures.extend({"itemIdentifier": i} for i in dict.fromkeys(i for i, _ in digest))
+    return {"batchItemFailures": batch_failures}
+
+
+def message_attribute(record, name):
+    """Value of an SQS message attribute, as a string or None."""
+    value = record.get('messageAttributes', {}).get(name)
+    if isinstance(value, dict):
+        return value.get('stringValue')
+    return value
+
+
+def dead_letter_failures(record):
+    """Failure details for each SES notification in a Dead Letter Queue SQS record."""
+    failed_req_id = message_attribute(record, 'RequestID')
+    log.info("Processing Failed Request ID: %s", failed_req_id)
+    log.debug("Failed Request ID %s Body: %s", failed_req_id, record['body'])
+    failures = []
+    # SES events of handle_ses_notice, or queue messages of handle_ses_batch
+    for ses_notification in body_notifications(record['body']):
+        failed_record = {"eventSource": "aws:ses", "eventVersion": "1.0", "ses": ses_notification}
+        log.debug("SES Notification: %s", ses_notification)
+        mail = ses_notification['mail']
+        # "mail": { "timestamp":"2015-09-11T20:32:33.936Z", "source":"user@example.com", 
+        #           "messageId":"d6iitobk75ur44p8kdnnp7g2n800", "destination":[ "recipient@example.com" ] }
+        log.info("Message Failure Details: %s", {
+            "messageId": mail['messageId'],
+            "timestamp": mail['timestamp'],
+            "source": mail['source'],
+            "destination": mail['destination']
+        })
+        failures.append({
+            "messageId": mail['messageId'],
+            "timestamp": mail['timestamp'],
+            "source": mail['source'],
+            "destination": mail['destination'],
+            "requestId": failed_req_id,
+            "errorCode": message_attribute(record, 'ErrorCode'),
+            "errorMessage": message_attribute(record, 'ErrorMessage'),
+            "record": failed_record,
+        })
+    return failures
+
+
+def failure_locations(failure):
+    """S3 locations of the original message, index and error copy of a failed message."""
+    message_id = failure['messageId']
+    ts = datetime.strptime(failure['timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ")  # "timestamp":"2015-09-11T20:32:33.936Z",
+    source = transform_address(failure['source'], user_only=True)
+    if index.INDEX_FORMAT == "json":
+        index_location = f"s3://{S3_BUCKET}/{S3_PREFIX_IDX}{ts:%Y/%m/%d}/{ts:%Y%m%dT%H%M%S}_{source}_{message_id}.json"
+    else:
+        index_location = f"s3://{S3_BUCKET}/{index.partition(ts, S3_PREFIX_IDX)} (in a .ndjson.gz object)"
+    error_key, details_key = error_keys(message_id, failure['timestamp'])
+    return {
+        "message": f"s3://{S3_BUCKET}/{S3_PREFIX_MSG}{message_id}",
+        "index": index_location,
+        "error": f"s3://{S3_BUCKET}/{error_key}",
+        "details": f"s3://{S3_BUCKET}/{details_key}",
+    }
+
+
+def failure_notice(failure):
+    """Admin notice text for a single failed message."""
+    if failure['messageId'] is None:
+        return "\n".join([
+            "Hello Admin,",
+            "",
+            "The application was unable to read a failure record from the Dead Letter Queue.",
+            "",
+            f"Error: {failure['errorMessage']}",
+            "",
+            "Failed Record:",
+            str(failure['record'])
+        ])
+    locations = failure_locations(failure)
+    dest_list = ", ".join(failure['destination'])
+    try:
+        details = read_message_error(failure['messageId'], failure['timestamp'])
+    except Exception:
+        log.exception("Unable to read error details of %s", failure['messageId'])
+        details = None
+    if details is not None:
+        send_error = [
+            f"The message failed while sending, after {details.get('attempts')} attempt(s):",
+            f"  Error: ({details.get('errorCode')}) {details.get('errorMessage')}",
+            f"  Size: {details.get('size')} bytes",
+            f"  Recipients: {', '.join(details.get('recipients') or [])}",
+            "The failed message to be sent is available here:", 
+            f"s3://{S3_BUCKET}/{details['message']}" if details.get('message') else locations['error'],
+            "with error details here:",
+            locations['details'],
+        ]
+    else:
+        send_error = [
+            "No sending error was recorded; it would be saved here:", 
+            locations['details'],
+        ]
+    return "\n".join([
+        "Hello Admin,",
+        "",
+        "The applicaiton failed to forward a message.", 
+        "",
+        "Here are the message details:",
+        f"  Message ID: {failure['messageId']}",
+        f"  Timestamp: {failure['timestamp']}",
+        f"  Sender: {failure['source']}",
+        f"  Destination:  {dest_list}",
+        f"  Error: ({failure['errorCode']}) {failure['errorMessage']}",
+        "",
+        "The original message should be available here:", 
+        locations['message'],
+        "  Note:  raw message can be downloaded and viewed in a text viewer or adding the '.eml' extention prompt it to open in an email client",
+        "",
+        "If saved, the notification from SES might be available here:", 
+        locations['index'],
+        "",
+    ] + send_error + [
+        "",
+        "Please investigate this failure.",
+        "",
+        "Thank you,",
+        "SES Forwarder",
+        "",
+        "Failed Record:",
+        json.dumps({"Records": [failure['record']]})
+    ])
+
+
+def send_error(failure):
+    """A failure with the error code and message of its send error, if one was saved.
+    
+    The ErrorCode attribute of Dead Letter Queue messages is the HTTP status of 
+    the invocation, 200 for every function error, so the code saved by 
+    save_message_error is used when there is one.
+    """
+    if failure['messageId'] is None:
+        return failure
+    try:
+        details = read_message_error(failure['messageId'], failure['timestamp'])
+    except Exception:
+        log.exception("Unable to read error details of %s", failure['messageId'])
+        return failure
+    if not details or not details.get('errorCode'):
+        return failure
+    return dict(failure, errorCode=details['errorCode'],
+                errorMessage=details.get('errorMessage') or failure['errorMessage'])
+
+
+def failure_digest(failures):
+    """Admin notice subject and text summarizing many failed messages, as a tuple.
+    
+    Failures are grouped by error code (see send_error) and sender domain.  The text is limited 
+    to DIGEST_MAX_BYTES to stay within the SNS message size limit.
+    """
+    groups = {}
+    for failure in failures:
+        domain = (failure.get('source') or "").rpartition("@")[2].rstrip(">").lower() or "unknown"
+        groups.setdefault(failure['errorCode'] or "unknown", {}).setdefault(domain, []).append(failure)
+    lines = [
+        "Hello Admin,",
+        "",
+        f"The application failed to forward {len(failures)} messages.",
+        "",
+        "Summary by error code and sender domain:",
+    ]
+    for code, domains in sorted(groups.items()):
+        lines.append(f"  Error Code {code}: {sum(len(f) for f in domains.values())}")
+        for domain, domain_failures in sorted(domains.items(), key=lambda i: -len(i[1])):
+            lines.append(f"    {domain}: {len(domain_failures)}")
+    lines.extend([
+        "",
+        "Original messages are stored with prefix:", 
+        f"s3://{S3_BUCKET}/{S3_PREFIX_MSG}",
+        "",
+        "Failed messages:",
+    ])
+    footer = ["", "Please investigate these failures.", "", "Thank you,", "SES Forwarder"]
+    size = sum(len(l) + 1 for l in lines + footer)
+    for code, domains in sorted(groups.items()):
+        for domain, domain_failures in sorted(domains.items()):
+            for failure in domain_failures:
+                line = "  [{}] {} {} from {} to {}: {}".format(
+                    code, failure['timestamp'] or "", failure['messageId'], failure['source'],
+                    ", ".join(failure['destination'] or []), (failure['errorMessage'] or "")[:200])
+                if size + len(line) + 1 > DIGEST_MAX_BYTES:
+                    lines.append("  ... (list truncated)")
+                    return f"Failed Message Delivery: {len(failures)} messages", "\n".join(lines + footer)
+                lines.append(line)
+                size += len(line) + 1
+    return f"Failed Message Delivery: {len(failures)} messages", "\n".join(lines + footer)
@@ -0,0 +1,79 @@
+import os
+import threading
+
+
+# Connection pool size per client.  Raise this along with RECORD_CONCURRENCY.
+CLIENT_MAX_POOL = int(os.environ.get("CLIENT_MAX_POOL") or 10)
+# Retry behavior for all clients, see:
+#   https://boto3.amazonaws.com/v1/documentation/api/latest/guide/retries.html
+CLIENT_MAX_ATTEMPTS = int(os.environ.get("CLIENT_MAX_ATTEMPTS") or 3)
+CLIENT_RETRY_MODE = os.environ.get("CLIENT_RETRY_MODE") or "standard"
+CLIENT_CONNECT_TIMEOUT = float(os.environ.get("CLIENT_CONNECT_TIMEOUT") or 5)
+CLIENT_READ_TIMEOUT = float(os.environ.get("CLIENT_READ_TIMEOUT") or 30)
+# Services whose calls are retried by the caller only:  sender.SendScheduler retries
+#   throttled sends within the Lambda time budget, and counts its attempts.
+NO_RETRY_SERVICES = {"sesv2"}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def client_config(service=None):
+    """Build the botocore Config of a client in the registry.
+
+    Clients of NO_RETRY_SERVICES make a single attempt per call.
+    """
+    from botocore.config import Config
+    if service in NO_RETRY_SERVICES:
+        retries = {'total_max_attempts': 1, 'mode': CLIENT_RETRY_MODE}
+    else:
+        retries = {'max_attempts': CLIENT_MAX_ATTEMPTS, 'mode': CLIENT_RETRY_MODE}
+    return Config(
+        max_pool_connections=CLIENT_MAX_POOL,
+        connect_timeout=CLIENT_CONNECT_TIMEOUT,
+        read_timeout=CLIENT_READ_TIMEOUT,
+        retries=retries,
+    )
+
+
+def get_client(service):
+    """Return the client for an AWS service, creating it on first use.
+
+    Clients are created once per container and reused across records and
+    warm invocations, so credential resolution, endpoint setup and the TLS
+    handshake are paid only once.  boto3 clients are thread-safe.  boto3 itself 
+    is imported on first use too, so handlers that never reach AWS (or tests 
+    with stand-ins) do not pay for it at cold start.
+
+    Parameters
+    ----------
+    service: str, required
+        Service name as passed to boto3.client, e.g. 's3', 'sesv2' or 'sns'
+
+    """
+    client = _clients.get(service)
+    if client is None:
+        with _lock:
+            client = _clients.get(service)
+            if client is None:
+                import boto3
+                client = boto3.client(service, config=client_config(service))
+                _clients[service] = client
+    return client
+
+
+def set_client(service, client):
+    """Install a client for a service, e.g. a stubbed client for testing.
+
+    Returns the previously registered client, or None.
+    """
+    with _lock:
+        previous = _clients.get(service)
+        _clients[service] = client
+    return previous
+
+
+def reset_clients():
+    """Forget all registered clients; new ones are created on next use."""
+    with _lock:
+        _clients.clear()
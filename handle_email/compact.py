@@ -0,0 +1,273 @@
+"""Compact the day partitions of the message index.
+
+Each day partition under S3_PREFIX_IDX is read in parallel and rewritten as
+a single gzip compressed NDJSON object, with duplicate notifications (from
+retries) removed:
+
+    index/YYYY/MM/DD/compacted_YYYYMMDD.ndjson.gz
+
+A manifest listing the source objects is written outside the index, so it
+is not crawled:
+
+    manifests/index/YYYY/MM/DD.json
+
+Compaction is idempotent and resumable.  A day whose objects are all listed
+in its manifest is skipped; objects added later are merged with the
+compacted object.  With `delete`, the source objects are deleted only after
+the compacted object and manifest are written, and an interrupted run
+finishes the deletion when run again.
+
+Run from the command line:
+
+    python -m handle_email.compact --bucket my-bucket 2024/01/01 2024/01/02
+    python -m handle_email.compact --bucket my-bucket --days 7 --delete
+
+or as the scheduled Lambda function `handle_compaction`, which compacts the
+days from COMPACT_DAYS to COMPACT_MIN_AGE_DAYS ago.
+"""
+import os
+import sys
+import gzip
+import json
+import logging
+import argparse
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+try:
+    from . import clients, index
+except ImportError:  # Lambda loads this file as a top-level module
+    import clients, index
+
+
+# Set environment variable "LOGLEVEL" to "DEBUG" to enable additional logging.
+LOGLEVEL = getattr(logging, os.environ.get("LOGLEVEL", "INFO").upper())
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_PREFIX_IDX = os.environ.get("S3_PREFIX_IDX") or "index/"
+COMPACT_MANIFEST_PREFIX = os.environ.get("COMPACT_MANIFEST_PREFIX") or "manifests/index/"
+COMPACT_CONCURRENCY = int(os.environ.get("COMPACT_CONCURRENCY") or 16)
+# Days are compacted once no more notifications are expected, including Lambda retries (up to 6 hours)
+COMPACT_MIN_AGE_DAYS = int(os.environ.get("COMPACT_MIN_AGE_DAYS") or 2)
+COMPACT_DAYS = int(os.environ.get("COMPACT_DAYS") or 7)
+COMPACT_DELETE = (False if os.environ.get("COMPACT_DELETE", "") in [None, "", "false"] else True)
+# Output is kept in memory up to this size, and in /tmp beyond it
+COMPACT_MAX_MEMORY = 64 * 1024 * 1024
+DELETE_BATCH = 1000  # S3 DeleteObjects limit
+
+log = logging.getLogger()
+log.setLevel(LOGLEVEL)
+
+
+def output_key(day, prefix=None):
+    """Key of the compacted object for a day (datetime)."""
+    return f"{index.partition(day, S3_PREFIX_IDX if prefix is None else prefix)}compacted_{day:%Y%m%d}.ndjson.gz"
+
+
+def manifest_key(day):
+    """Key of the manifest for a day (datetime)."""
+    return f"{COMPACT_MANIFEST_PREFIX}{day:%Y/%m/%d}.json"
+
+
+def read_manifest(bucket, day):
+    """Manifest of a compacted day, or None."""
+    try:
+        response = clients.get_client('s3').get_object(Bucket=bucket, Key=manifest_key(day))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.load(response['Body'])
+
+
+def write_manifest(bucket, day, manifest):
+    clients.get_client('s3').put_object(
+        Bucket=bucket,
+        Key=manifest_key(day),
+        Body=json.dumps(manifest, indent=1).encode('utf-8'),
+        ContentType='application/json',
+    )
+
+
+def read_object(bucket, key):
+    """SES notifications in an index object."""
+    response = clients.get_client('s3').get_object(Bucket=bucket, Key=key)
+    return index.decode_object(key, response['Body'].read())
+
+
+def ordered_map(func, items, workers):
+    """Like Executor.map, but with at most 4 * `workers` results held at once."""
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 4 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def delete_objects(bucket, keys):
+    """Delete objects in batches; returns the number deleted."""
+    client = clients.get_client('s3')
+    deleted = 0
+    for i in range(0, len(keys), DELETE_BATCH):
+        batch = keys[i:i + DELETE_BATCH]
+        response = client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in batch], 'Quiet': True})
+        errors = response.get('Errors', [])
+        if errors:
+            raise RuntimeError("Unable to delete %d objects, first: %s" % (len(errors), errors[0]))
+        deleted += len(batch)
+    return deleted
+
+
+def compact_day(day, bucket=None, delete=False, workers=None, force=False):
+    """Compact the index partition of one day.
+
+    Parameters
+    ----------
+    day: datetime, required
+        Day of the partition
+
+    bucket: str, optional
+        Bucket name, S3_BUCKET by default
+
+    delete: bool, optional
+        Delete the source objects once the compacted object is written
+
+    workers: int, optional
+        Concurrent downloads, COMPACT_CONCURRENCY by default
+
+    force: bool, optional
+        Rewrite the compacted object even if the manifest is up to date
+
+    Returns
+    -------
+    The manifest of the day, or None if the partition is empty
+
+    """
+    bucket = bucket or S3_BUCKET
+    workers = workers or COMPACT_CONCURRENCY
+    partition = index.partition(day, S3_PREFIX_IDX)
+    target = output_key(day)
+    objects = index.list_partition(bucket, partition)
+    current = {o['Key']: o for o in objects if o['Key'] != target}
+    compacted = any(o['Key'] == target for o in objects)
+    manifest = read_manifest(bucket, day)
+    # Objects already in the compacted object
+    known = {o['Key']: o for o in manifest['sources']} if manifest is not None and compacted else {}
+    new = [key for key in current if key not in known]
+
+    if not new and not force:
+        if delete and current:
+            log.info("Resuming deletion of %d objects in %s", len(current), partition)
+            delete_objects(bucket, sorted(current))
+            manifest['deleted'] = True
+            write_manifest(bucket, day, manifest)
+        elif known:
+            log.info("Partition %s is already compacted", partition)
+        else:
+            log.info("Partition %s is empty", partition)
+        return manifest
+    # An existing compacted object is merged with the new objects; duplicates are dropped
+    inputs = ([target] if compacted else []) + (sorted(current) if force else new)
+    sources = dict(known)
+    sources.update(current)
+
+    log.info("Compacting %d objects in %s", len(inputs), partition)
+    seen = set()
+    records = duplicates = 0
+    with tempfile.SpooledTemporaryFile(max_size=COMPACT_MAX_MEMORY) as spool:
+        with gzip.GzipFile(fileobj=spool, mode='wb', mtime=0) as f:
+            for notifications in ordered_map(lambda key: read_object(bucket, key), inputs, workers):
+                for notification in notifications:
+                    message_id = notification['mail']['messageId']
+                    if message_id in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(message_id)
+                    f.write(json.dumps(notification).encode('utf-8'))
+                    f.write(b"\n")
+                    records += 1
+        size = spool.tell()
+        spool.seek(0)
+        clients.get_client('s3').put_object(Bucket=bucket, Key=target, Body=spool,
+                                            ContentType='application/x-ndjson')
+    manifest = {
+        "partition": partition,
+        "output": target,
+        "records": records,
+        "duplicates": duplicates,
+        "bytes": size,
+        "sources": [sources[key] for key in sorted(sources)],
+        "deleted": False,
+        "compacted": datetime.now(timezone.utc).isoformat(),
+    }
+    write_manifest(bucket, day, manifest)
+    log.info("Compacted %d records (%d duplicates) from %s into s3://%s/%s (%d bytes)",
+             records, duplicates, partition, bucket, target, size)
+    if delete:
+        delete_objects(bucket, sorted(current))
+        manifest['deleted'] = True
+        write_manifest(bucket, day, manifest)
+    return manifest
+
+
+def recent_days(days=None, min_age=None, today=None):
+    """Days from `days` to `min_age` days before `today` (UTC), oldest first."""
+    days = COMPACT_DAYS if days is None else days
+    min_age = COMPACT_MIN_AGE_DAYS if min_age is None else min_age
+    today = today or datetime.now(timezone.utc).replace(tzinfo=None)
+    today = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    return [today - timedelta(days=age) for age in range(days, min_age - 1, -1)]
+
+
+def handle_compaction(event, context):
+    """Lambda function to compact the index, run on a schedule.
+
+    Parameters
+    ----------
+    event: dict, required
+        Scheduled event; an optional "days" list of "YYYY/MM/DD" dates
+        replaces the default range of days
+
+    context: object, required
+        Lambda Context runtime methods and attributes
+
+    """
+    if event.get("days"):
+        days = [datetime.strptime(d, "%Y/%m/%d") for d in event["days"]]
+    else:
+        days = recent_days()
+    results = {}
+    for day in days:
+        manifest = compact_day(day, delete=COMPACT_DELETE)
+        results[f"{day:%Y/%m/%d}"] = manifest and manifest['records']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("days", nargs="*", help="days to compact as YYYY/MM/DD")
+    parser.add_argument("--bucket", default=S3_BUCKET, required=not S3_BUCKET)
+    parser.add_argument("--days", dest="recent", type=int, default=None,
+                        help="compact the last DAYS days, up to --min-age days ago")
+    parser.add_argument("--min-age", type=int, default=COMPACT_MIN_AGE_DAYS)
+    parser.add_argument("--workers", type=int, default=COMPACT_CONCURRENCY, help="concurrent downloads")
+    parser.add_argument("--delete", action="store_true", help="delete the source objects")
+    parser.add_argument("--force", action="store_true", help="rewrite days that are already compacted")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(message)s")
+
+    days = [datetime.strptime(d, "%Y/%m/%d") for d in args.days]
+    if args.recent is not None or not days:
+        days.extend(recent_days(args.recent, args.min_age))
+    for day in days:
+        manifest = compact_day(day, args.bucket, args.delete, args.workers, args.force)
+        print(f"{day:%Y/%m/%d}:", "empty" if manifest is None else "%d records" % (manifest['records'],))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
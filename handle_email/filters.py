@@ -0,0 +1,199 @@
+"""Filter pipeline applied to SES notifications before any S3 or SES traffic.
+
+The pipeline is built once per container from a JSON configuration, given in
+the environment variable FILTER_CONFIG or in the file named by
+FILTER_CONFIG_FILE (relative to this directory).  All keys are optional:
+
+    {
+      "verdicts": {"spamVerdict": ["PASS"], "virusVerdict": ["PASS"],
+                   "spfVerdict": ["PASS"], "dkimVerdict": ["PASS"]},
+      "dmarc_reject": true,
+      "deny_senders": ["spammer@example.com", "example.net"],
+      "allow_senders": [],
+      "deny_recipients": ["noreply@example.org"],
+      "allow_recipients": [],
+      "deny_headers": {"Auto-Submitted": ["auto-replied", "auto-generated"], "List-Id": ["*"]},
+      "max_size": 10485760,
+      "reject_index_sample": 0.01
+    }
+
+Sender and recipient entries are addresses or domains, compared without case.
+Recipients are deduplicated without case, and denied recipients are removed
+from the message; it is rejected if none remain.
+Messages with a denied header value ("*" for any value, compared without
+case) are rejected; the headers come from the notification, or from the
+start of the raw message when SES truncated them (see headers.py).
+SES notifications do not include the message size, so "max_size" is checked
+against the S3 object size before the message body is downloaded.
+"""
+import os
+import json
+import random
+import logging
+import threading
+try:
+    from . import addresses
+except ImportError:  # Lambda loads this file as a top-level module
+    import addresses
+
+
+FILTER_CONFIG = os.environ.get("FILTER_CONFIG")
+FILTER_CONFIG_FILE = os.environ.get("FILTER_CONFIG_FILE")
+
+DEFAULT_CONFIG = {
+    "verdicts": {
+        "spamVerdict": ["PASS"],
+        "virusVerdict": ["PASS"],
+        "spfVerdict": ["PASS"],
+        "dkimVerdict": ["PASS"],
+    },
+    "dmarc_reject": True,
+    "deny_senders": [],
+    "allow_senders": [],
+    "deny_recipients": [],
+    "allow_recipients": [],
+    "deny_headers": {},
+    "max_size": None,
+    "reject_index_sample": 0.0,
+}
+
+log = logging.getLogger()
+
+_pipeline = None
+_lock = threading.Lock()
+
+
+class Rejected(Exception):
+    """Raised when a message is rejected by a filter rule."""
+    def __init__(self, rule, detail=None):
+        super().__init__("Rejected by %s%s" % (rule, ": %s" % (detail,) if detail else ""))
+        self.rule = rule
+        self.detail = detail
+
+
+class AddressSet:
+    """Addresses and domains for O(1) matching."""
+
+    def __init__(self, entries):
+        entries = [e.strip().lower() for e in entries]
+        self.addresses = {e for e in entries if "@" in e}
+        self.domains = {e.lstrip("@") for e in entries if "@" not in e or e.startswith("@")}
+
+    def __bool__(self):
+        return bool(self.addresses or self.domains)
+
+    def __contains__(self, addr):
+        addr = addr.strip().lower()
+        return addr in self.addresses or addr.rpartition("@")[2] in self.domains
+
+
+def sender_addresses(mail):
+    """Envelope sender and From header addresses of a notification."""
+    from_headers = mail.get('commonHeaders', {}).get('from', [])
+    return [a for a in [mail.get('source', "")] + addresses.addresses(from_headers) if a]
+
+
+class FilterPipeline:
+    """Compiled filter rules.
+
+    Parameters
+    ----------
+    config: dict, optional
+        Filter configuration, see the module documentation
+
+    """
+
+    def __init__(self, config=None):
+        config = dict(DEFAULT_CONFIG, **(config or {}))
+        unknown = set(config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError("Unknown filter configuration: %s" % (", ".join(sorted(unknown)),))
+        self.verdicts = {name: {s.upper() for s in statuses} for name, statuses in config["verdicts"].items()}
+        self.dmarc_reject = bool(config["dmarc_reject"])
+        self.deny_senders = AddressSet(config["deny_senders"])
+        self.allow_senders = AddressSet(config["allow_senders"])
+        self.deny_recipients = AddressSet(config["deny_recipients"])
+        self.allow_recipients = AddressSet(config["allow_recipients"])
+        self.deny_headers = [(name, {v.strip().lower() for v in values}) for name, values in config["deny_headers"].items()]
+        self.max_size = config["max_size"]
+        self.reject_index_sample = float(config["reject_index_sample"])
+
+    def evaluate(self, ses_notification):
+        """Apply the rules to an SES notification, without any I/O.
+
+        Returns
+        -------
+        List of recipients to forward the message to
+
+        Raises
+        ------
+        Rejected when the message should be dropped
+
+        """
+        mail = ses_notification['mail']
+        receipt = ses_notification['receipt']
+        for name, statuses in self.verdicts.items():
+            status = receipt.get(name, {}).get('status', "").upper()
+            if status not in statuses:
+                raise Rejected(name, dict((k, v['status']) for k, v in receipt.items() if k.endswith("Verdict")))
+        if (self.dmarc_reject and
+                receipt.get('dmarcVerdict', {}).get('status') != 'PASS' and
+                receipt.get('dmarcPolicy', {"status": "none"})['status'].upper() == 'REJECT'):
+            raise Rejected("dmarcPolicy", "Failed DMARC with reject policy")
+        senders = sender_addresses(mail)
+        if self.deny_senders and any(s in self.deny_senders for s in senders):
+            raise Rejected("deny_senders", senders)
+        if self.allow_senders and not any(s in self.allow_senders for s in senders):
+            raise Rejected("allow_senders", senders)
+        # Parsed and deduplicated without case
+        recipients = addresses.addresses(receipt['recipients'])
+        if self.deny_recipients:
+            recipients = [r for r in recipients if r not in self.deny_recipients]
+        if self.allow_recipients:
+            recipients = [r for r in recipients if r in self.allow_recipients]
+        if not recipients:
+            raise Rejected("recipients", receipt['recipients'])
+        return recipients
+
+    def check_headers(self, message_headers):
+        """Raise Rejected if a header of a headers.MessageHeaders has a denied value."""
+        for name, values in self.deny_headers:
+            for value in message_headers.get_all(name):
+                if "*" in values or value.strip().lower() in values:
+                    raise Rejected("deny_headers", "%s: %s" % (name, value))
+
+    def check_size(self, size):
+        """Raise Rejected if `size` is over the configured "max_size"."""
+        if self.max_size is not None and size is not None and size > self.max_size:
+            raise Rejected("max_size", "%d bytes" % (size,))
+
+    def sample_rejected(self):
+        """True if a rejected message should be indexed anyway."""
+        return self.reject_index_sample > 0 and random.random() < self.reject_index_sample
+
+
+def load_config():
+    """Read the filter configuration from FILTER_CONFIG or FILTER_CONFIG_FILE."""
+    if FILTER_CONFIG:
+        return json.loads(FILTER_CONFIG)
+    if FILTER_CONFIG_FILE:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), FILTER_CONFIG_FILE)) as f:
+            return json.load(f)
+    return None
+
+
+def get_pipeline():
+    """Return the filter pipeline for this container, building it on first use."""
+    global _pipeline
+    if _pipeline is None:
+        with _lock:
+            if _pipeline is None:
+                _pipeline = FilterPipeline(load_config())
+    return _pipeline
+
+
+def set_pipeline(pipeline):
+    """Replace the filter pipeline, e.g. for testing.  None rebuilds it on next use."""
+    global _pipeline
+    with _lock:
+        _pipeline = pipeline
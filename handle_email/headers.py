@@ -0,0 +1,129 @@
+"""Message headers for filtering and index enrichment, without the body.
+
+SES notifications include every header of the message in `mail.headers`,
+unless the header block is too large and `mail.headersTruncated` is true.
+Only then are the headers read from the raw message in S3, with a ranged GET
+of the first HEADER_RANGE_BYTES.  If the header block does not end within
+that range, the following bytes are read with ranges twice as large each
+time, up to HEADER_MAX_BYTES in total.  Only the header block is parsed.
+"""
+import os
+import logging
+from botocore.exceptions import ClientError
+try:
+    from . import clients, rewrite
+except ImportError:  # Lambda loads this file as a top-level module
+    import clients, rewrite
+
+
+HEADER_RANGE_BYTES = int(os.environ.get("HEADER_RANGE_BYTES") or 8 * 1024)
+HEADER_MAX_BYTES = int(os.environ.get("HEADER_MAX_BYTES") or 256 * 1024)
+
+log = logging.getLogger()
+
+
+def fetch_headers(bucket, key, range_bytes=None, max_bytes=None):
+    """Read the header fields of a raw message in S3 with ranged GETs.
+
+    Parameters
+    ----------
+    range_bytes: int, optional
+        Size of the first range, HEADER_RANGE_BYTES by default
+
+    max_bytes: int, optional
+        Bytes read at most, HEADER_MAX_BYTES by default; the fields
+        complete within them are returned
+
+    Returns
+    -------
+    Tuple of (list of (name, value) fields, bytes read)
+
+    """
+    max_bytes = max_bytes or HEADER_MAX_BYTES
+    end = min(range_bytes or HEADER_RANGE_BYTES, max_bytes)
+    client = clients.get_client('s3')
+    buffer = b""
+    header_block = b""
+    while True:
+        try:
+            response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={len(buffer)}-{end - 1}")
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':  # Empty object
+                raise
+            break
+        buffer += response['Body'].read()
+        size = int(response.get('ContentRange', "/%d" % (len(buffer),)).rpartition("/")[2])
+        header_block, separator, _ = rewrite.split_message(buffer)
+        if separator or len(buffer) >= size:
+            break
+        if end >= max_bytes:
+            log.warning("Header block of s3://%s/%s is larger than %d bytes", bucket, key, max_bytes)
+            # Drop the incomplete last line
+            header_block = header_block[:header_block.rfind(b"\n") + 1]
+            break
+        end = min(2 * end, max_bytes)
+    fields = [(name, rewrite.field_value(raw_field)) for name, raw_field in rewrite.parse_header_block(header_block)]
+    return fields, len(buffer)
+
+
+class MessageHeaders:
+    """Headers of a received message, read from S3 only if needed and only once.
+
+    Parameters
+    ----------
+    ses_notification: dict, required
+        The "ses" member of an SES event record
+
+    bucket: str, required
+        Bucket of the raw message
+
+    key: str, required
+        Key of the raw message
+
+    stats: metrics.Metrics, optional
+        Time spent reading the headers is added as "HeaderGetTime", with the
+        bytes read as "HeaderBytes"
+
+    """
+
+    def __init__(self, ses_notification, bucket, key, stats=None):
+        self.mail = ses_notification['mail']
+        self.bucket = bucket
+        self.key = key
+        self.stats = stats
+        self.bytes_read = 0
+        self._fields = None
+
+    @property
+    def fetched(self):
+        """True if the headers were read from S3."""
+        return self.bytes_read > 0
+
+    def fields(self):
+        """Dictionary of lowercase header name to the values of its fields, in message order."""
+        if self._fields is None:
+            if 'headers' in self.mail and not self.mail.get('headersTruncated'):
+                fields = [(h['name'], h['value']) for h in self.mail['headers']]
+            elif self.stats is not None:
+                with self.stats.stage("HeaderGet"):
+                    fields, self.bytes_read = fetch_headers(self.bucket, self.key)
+                self.stats.put("HeaderBytes", self.bytes_read, "Bytes")
+            else:
+                fields, self.bytes_read = fetch_headers(self.bucket, self.key)
+            self._fields = {}
+            for name, value in fields:
+                self._fields.setdefault(name.lower(), []).append(value)
+        return self._fields
+
+    def get_all(self, name):
+        """Values of every field named `name`, compared without case."""
+        return self.fields().get(name.lower(), [])
+
+    def get(self, name, default=None):
+        """Value of the first field named `name`."""
+        values = self.get_all(name)
+        return values[0] if values else default
+
+    def select(self, names):
+        """Dictionary of the first value of each of `names` present in the message."""
+        return {name: self.get(name) for name in names if self.get_all(name)}
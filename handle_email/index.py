@@ -0,0 +1,205 @@
+"""Buffered writer for the message index.
+
+With INDEX_FORMAT "ndjson", SES notifications are buffered during an
+invocation and written as gzip compressed, newline-delimited JSON, one
+object per day and flush, instead of one small JSON object per message:
+
+    index/YYYY/MM/DD/YYYYMMDDTHHMMSS_<id>.ndjson.gz
+
+The date partitions are the same as for the per-message JSON objects
+(INDEX_FORMAT "json", the default), so both can be crawled by Glue and
+queried by Athena together.  Each line holds the same JSON document as a
+per-message object.
+
+The buffer is flushed when it holds INDEX_FLUSH_RECORDS notifications or
+INDEX_FLUSH_BYTES of JSON, when the oldest notification has waited
+INDEX_FLUSH_SECONDS, and always at the end of the invocation, including
+when a record fails.  A failed flush is raised, so the event is retried.
+"""
+import os
+import io
+import gzip
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+try:
+    from . import clients
+except ImportError:  # Lambda loads this file as a top-level module
+    import clients
+
+
+INDEX_FORMAT = os.environ.get("INDEX_FORMAT") or "json"
+INDEX_FLUSH_RECORDS = int(os.environ.get("INDEX_FLUSH_RECORDS") or 500)
+INDEX_FLUSH_BYTES = int(os.environ.get("INDEX_FLUSH_BYTES") or 4 * 1024 * 1024)
+INDEX_FLUSH_SECONDS = float(os.environ.get("INDEX_FLUSH_SECONDS") or 5)
+# Comma separated headers added to each index entry as "extraHeaders", e.g. "List-Id,Auto-Submitted,X-Mailer"
+INDEX_EXTRA_HEADERS = [h.strip() for h in (os.environ.get("INDEX_EXTRA_HEADERS") or "").split(",") if h.strip()]
+
+log = logging.getLogger()
+
+
+def notification_time(data):
+    """Receipt time of an SES notification."""
+    return datetime.strptime(data['mail']['timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ")  # "timestamp":"2015-09-11T20:32:33.936Z",
+
+
+def partition(ts, prefix):
+    """Date partition prefix of the index for a timestamp."""
+    return f"{prefix}{ts:%Y/%m/%d}/"
+
+
+def list_partition(bucket, partition):
+    """List the objects of a partition, following pagination.
+
+    Returns
+    -------
+    List of dictionaries with Key, ETag and Size, sorted by key
+
+    """
+    paginator = clients.get_client('s3').get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=partition):
+        objects.extend({'Key': o['Key'], 'ETag': o['ETag'], 'Size': o['Size']} for o in page.get('Contents', []))
+    return sorted(objects, key=lambda o: o['Key'])
+
+
+def enrich(data, message_headers, names=None):
+    """Add headers of the message to an SES notification, as "extraHeaders".
+
+    Parameters
+    ----------
+    message_headers: headers.MessageHeaders, required
+        Headers of the message, read only if `names` is not empty
+
+    names: list, optional
+        Header names, INDEX_EXTRA_HEADERS by default
+
+    Returns
+    -------
+    A copy of `data` with the headers present in the message, or `data`
+    itself if there are no `names`
+
+    """
+    names = INDEX_EXTRA_HEADERS if names is None else names
+    if not names:
+        return data
+    return dict(data, extraHeaders=message_headers.select(names))
+
+
+def encode_lines(lines):
+    """Gzip compress a list of JSON lines (str) as one NDJSON document."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+        for line in lines:
+            f.write(line.encode('utf-8'))
+            f.write(b"\n")
+    return buffer.getvalue()
+
+
+def decode_object(key, body):
+    """SES notifications in an index object of either format.
+
+    Parameters
+    ----------
+    key: str, required
+        Object key; ".json" objects hold one notification, and ".gz" 
+        objects are decompressed and hold one per line
+
+    body: bytes, required
+        Object content
+
+    """
+    if key.endswith(".json"):
+        return [json.loads(body)]
+    if key.endswith(".gz"):
+        body = gzip.decompress(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+class IndexWriter:
+    """Buffer SES notifications and write them to S3 as gzip NDJSON.
+
+    Parameters
+    ----------
+    bucket: str, required
+        Bucket name
+
+    prefix: str, required
+        Key prefix of the index, e.g. "index/"
+
+    """
+
+    def __init__(self, bucket, prefix, max_records=None, max_bytes=None, max_age=None, clock=time.monotonic):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.max_records = INDEX_FLUSH_RECORDS if max_records is None else max_records
+        self.max_bytes = INDEX_FLUSH_BYTES if max_bytes is None else max_bytes
+        self.max_age = INDEX_FLUSH_SECONDS if max_age is None else max_age
+        self.clock = clock
+        self.days = {}  # partition -> (first timestamp, list of JSON lines)
+        self.records = 0
+        self.size = 0
+        self.oldest = None
+        self.keys = []
+        self._lock = threading.Lock()
+
+    def add(self, data):
+        """Buffer a notification, flushing the buffer if a limit is reached."""
+        ts = notification_time(data)
+        line = json.dumps(data)
+        with self._lock:
+            self.days.setdefault(partition(ts, self.prefix), (ts, []))[1].append(line)
+            self.records += 1
+            self.size += len(line) + 1
+            if self.oldest is None:
+                self.oldest = self.clock()
+            full = (self.records >= self.max_records or self.size >= self.max_bytes or
+                    self.clock() - self.oldest >= self.max_age)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered notifications, one object per day.
+
+        Returns
+        -------
+        List of object keys written
+
+        """
+        with self._lock:
+            days, self.days = self.days, {}
+            self.records, self.size, self.oldest = 0, 0, None
+        keys = []
+        try:
+            client = clients.get_client('s3')
+            for day, (ts, lines) in sorted(days.items()):
+                object_key = f"{day}{ts:%Y%m%dT%H%M%S}_{uuid.uuid4().hex}.ndjson.gz"
+                log.info("Saving Message Index (%d records): s3://%s/%s", len(lines), self.bucket, object_key)
+                client.put_object(
+                    Bucket=self.bucket,
+                    Key=object_key,
+                    Body=encode_lines(lines),
+                    ContentType='application/x-ndjson',
+                )
+                keys.append(object_key)
+                del days[day]
+        except Exception:
+            log.error("Unable to save %d index records", sum(len(lines) for _, lines in days.values()))
+            self._restore(days)
+            raise
+        finally:
+            self.keys.extend(keys)
+        return keys
+
+    def _restore(self, days):
+        """Put unwritten notifications back in the buffer."""
+        with self._lock:
+            for day, (ts, lines) in days.items():
+                self.days.setdefault(day, (ts, []))[1][:0] = lines
+                self.records += len(lines)
+                self.size += sum(len(line) + 1 for line in lines)
+            if self.records and self.oldest is None:
+                self.oldest = self.clock()
@@ -0,0 +1,215 @@
+"""Idempotency ledger of forwarded messages.
+
+Lambda retries of asynchronous invocations and redelivery from the Dead
+Letter Queue can process the same SES notification more than once.  Once a
+message has been forwarded, an entry keyed on the SES message ID and the set
+of recipients is written to the ledger with the outgoing SES message IDs, and
+later attempts return those IDs without saving the index, downloading the
+message or sending it again.  When a message is sent more than once, in
+recipient batches or forwarding modes, each send is also recorded as soon as it
+succeeds, as a part keyed on the mode and the recipients of the batch, so a
+retry after a partial failure only sends the remaining parts.
+
+Entries are kept in a per-container LRU cache in front of a durable backend,
+selected with LEDGER_BACKEND:
+
+* "s3" (default):  one object per entry under LEDGER_PREFIX in the message
+  bucket, written with a conditional put so the first writer wins.
+* "memory":  a dictionary, for testing and local runs.
+* "none":  disables the ledger.
+
+Ledger objects are small and only needed while retries are possible; an S3
+lifecycle rule on LEDGER_PREFIX can expire them after a few days.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+try:
+    from . import clients
+except ImportError:  # Lambda loads this file as a top-level module
+    import clients
+
+
+LEDGER_BACKEND = os.environ.get("LEDGER_BACKEND") or "s3"
+LEDGER_PREFIX = os.environ.get("LEDGER_PREFIX") or "ledger/"
+LEDGER_CACHE_SIZE = int(os.environ.get("LEDGER_CACHE_SIZE") or 1024)
+
+log = logging.getLogger()
+
+_ledger = None
+_lock = threading.Lock()
+
+
+def ledger_key(message_id, recipients, part=None):
+    """Ledger key for a message and its (unordered) recipients, or for a part sent to some of them."""
+    digest = hashlib.sha256("\n".join(sorted({r.strip().lower() for r in recipients})).encode()).hexdigest()
+    if part is not None:
+        return "%s/%s/%s" % (message_id, part, digest[:32])
+    return "%s/%s" % (message_id, digest[:32])
+
+
+class MemoryBackend:
+    """Ledger backend holding entries in a dictionary."""
+
+    def __init__(self):
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry):
+        """Store `entry` unless `key` exists; returns False if it did."""
+        with self._lock:
+            if key in self.entries:
+                return False
+            self.entries[key] = entry
+            return True
+
+
+class S3Backend:
+    """Ledger backend storing each entry as a JSON object in S3.
+
+    Parameters
+    ----------
+    bucket: str, required
+        Bucket name
+
+    prefix: str, optional
+        Key prefix of the ledger objects, LEDGER_PREFIX by default
+
+    """
+
+    def __init__(self, bucket, prefix=None):
+        self.bucket = bucket
+        self.prefix = LEDGER_PREFIX if prefix is None else prefix
+
+    def get(self, key):
+        try:
+            response = clients.get_client('s3').get_object(Bucket=self.bucket, Key=self.prefix + key + ".json")
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.load(response['Body'])
+
+    def put(self, key, entry):
+        """Store `entry` unless `key` exists; returns False if it did."""
+        try:
+            clients.get_client('s3').put_object(
+                Bucket=self.bucket,
+                Key=self.prefix + key + ".json",
+                Body=json.dumps(entry).encode('utf-8'),
+                ContentType="application/json",
+                IfNoneMatch='*',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+
+class Ledger:
+    """LRU cache of delivered messages in front of a durable backend.
+
+    Backend errors are logged and treated as a cache miss, so an unavailable
+    ledger never stops mail from being forwarded.
+
+    Parameters
+    ----------
+    backend: object, required
+        Object with get(key) and put(key, entry) methods, see MemoryBackend
+
+    cache_size: int, optional
+        Number of entries kept in memory, LEDGER_CACHE_SIZE by default
+
+    """
+
+    def __init__(self, backend, cache_size=None):
+        self.backend = backend
+        self.cache_size = LEDGER_CACHE_SIZE if cache_size is None else cache_size
+        self.cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def lookup(self, message_id, recipients, part=None):
+        """Return the ledger entry if the message (or `part`) was already forwarded, or None."""
+        key = ledger_key(message_id, recipients, part)
+        with self._lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+                return entry
+        try:
+            entry = self.backend.get(key)
+        except Exception:
+            log.exception("Unable to read ledger entry for %s", message_id)
+            return None
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def record(self, message_id, recipients, outgoing, part=None):
+        """Record that a message (or `part`) was forwarded as the `outgoing` SES message ID(s).
+
+        Returns
+        -------
+        The ledger entry; if another attempt recorded the message first, its
+        entry is kept in the ledger
+
+        """
+        entry = {
+            "messageId": message_id,
+            "recipients": sorted(recipients),
+            "outgoing": outgoing,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        }
+        if part is not None:
+            entry["part"] = part
+        key = ledger_key(message_id, recipients, part)
+        self._remember(key, entry)
+        try:
+            if not self.backend.put(key, entry):
+                log.warning("Message %s was already recorded as forwarded", message_id)
+        except Exception:
+            # The message was sent; failing here would only cause a duplicate on retry
+            log.exception("Unable to write ledger entry for %s", message_id)
+        return entry
+
+
+def get_ledger(bucket=None):
+    """Return the ledger for this container, or None if LEDGER_BACKEND is "none".
+
+    The S3 backend uses `bucket`, given on first use.
+    """
+    global _ledger
+    if _ledger is None and LEDGER_BACKEND != "none":
+        with _lock:
+            if _ledger is None:
+                if LEDGER_BACKEND == "memory":
+                    backend = MemoryBackend()
+                elif LEDGER_BACKEND == "s3":
+                    backend = S3Backend(bucket)
+                else:
+                    raise ValueError("Unknown LEDGER_BACKEND: %s" % (LEDGER_BACKEND,))
+                _ledger = Ledger(backend)
+    return _ledger
+
+
+def set_ledger(ledger):
+    """Replace the ledger, e.g. for testing.  None rebuilds it on next use."""
+    global _ledger
+    with _lock:
+        _ledger = ledger
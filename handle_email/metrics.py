@@ -0,0 +1,115 @@
+"""Per-message timing and size metrics, emitted as CloudWatch Embedded Metric Format.
+
+EMF log lines are turned into CloudWatch metrics by CloudWatch Logs, so no
+API calls are made.  Format details:
+https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+Hooks registered with `add_hook` receive every record that is emitted, which
+lets tests and benchmarks capture the same data.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE") or "SESForwarder"
+# Set environment variable "METRICS_ENABLED" to "false" to stop writing EMF lines (hooks still run).
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() not in ["", "false", "0"]
+# Every record has these dimensions; others set with Metrics.set_dimension are added to them in a second dimension set
+METRICS_DIMENSIONS = ["Outcome"]
+
+_hooks = []
+
+
+def add_hook(func):
+    """Call `func(record)` with each EMF record as it is flushed."""
+    _hooks.append(func)
+
+
+def remove_hook(func):
+    _hooks.remove(func)
+
+
+class Metrics:
+    """Collect metrics and properties for one unit of work, such as a message.
+
+    Metrics are named values with a CloudWatch unit.  Properties are extra
+    fields in the log record that are searchable but are not metrics.
+    """
+
+    def __init__(self, **properties):
+        self.metrics = {}
+        self.properties = dict(properties)
+        self.dimensions = {"Outcome": "Unknown"}
+        self._lock = threading.Lock()
+
+    def put(self, name, value, unit="None"):
+        """Set a metric value, replacing any earlier value."""
+        with self._lock:
+            self.metrics[name] = (value, unit)
+
+    def add(self, name, value, unit="None"):
+        """Add to a metric value."""
+        with self._lock:
+            previous = self.metrics.get(name, (0, unit))[0]
+            self.metrics[name] = (previous + value, unit)
+
+    def set_property(self, name, value):
+        with self._lock:
+            self.properties[name] = value
+
+    def set_outcome(self, outcome):
+        with self._lock:
+            self.dimensions["Outcome"] = outcome
+
+    def set_dimension(self, name, value):
+        """Set an extra dimension, such as the "FilterRule" of a rejected message."""
+        with self._lock:
+            self.dimensions[name] = value
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of code as metric "<name>Time" in milliseconds."""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(f"{name}Time", (time.perf_counter() - start) * 1000, "Milliseconds")
+
+    def timed(self, name, func):
+        """Wrap `func` so the time spent in all calls adds to metric "<name>Time"."""
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def record(self):
+        """Build the EMF record."""
+        with self._lock:
+            record = dict(self.properties)
+            record.update(self.dimensions)
+            dimensions = [METRICS_DIMENSIONS]
+            if len(self.dimensions) > len(METRICS_DIMENSIONS):
+                dimensions.append(list(self.dimensions))
+            record.update({name: value for name, (value, unit) in self.metrics.items()})
+            record["_aws"] = {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": dimensions,
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (value, unit) in self.metrics.items()],
+                }],
+            }
+        return record
+
+    def flush(self):
+        """Emit the record to hooks and, if enabled, as an EMF line on stdout."""
+        record = self.record()
+        for hook in list(_hooks):
+            hook(record)
+        if METRICS_ENABLED:
+            sys.stdout.write(json.dumps(record, default=str) + "\n")
+        return record
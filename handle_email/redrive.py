@@ -0,0 +1,349 @@
+"""Forward failed messages again, at a bounded send rate.
+
+Messages are selected in one of three ways:
+
+* by receipt day:  the error details saved in S3_PREFIX_ERR for those days
+  (see app.save_message_error) list the messages that failed to send;
+* by message ID:  the receipt day is read from the raw message object;
+* from the Dead Letter Queue:  SES events (or SES notifications of the
+  batch ingest queue) are received until the queue is empty, and deleted
+  once forwarded.
+
+The SES notifications of the first two are read from the index of the
+receipt day.  Each message is checked by the filter pipeline and the ledger
+again, so messages already forwarded are not sent twice, and forwarded
+with `--workers` in parallel, limited to `--rate` sends per second.
+
+Progress is appended to a checkpoint file, one JSON line per message;
+running again with the same checkpoint skips the messages already done:
+
+    python -m handle_email.redrive --bucket my-bucket --since 2024/01/01 --until 2024/01/07
+    python -m handle_email.redrive --bucket my-bucket --ids d6iitobk75ur44p8kdnnp7g2n800
+    python -m handle_email.redrive --bucket my-bucket --queue https://sqs... --rate 5 --checkpoint redrive.jsonl
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+try:
+    from . import app, clients, compact, filters, headers, index, ledger, routing, sender
+except ImportError:  # Lambda loads this file as a top-level module
+    import app, clients, compact, filters, headers, index, ledger, routing, sender
+
+
+REDRIVE_CONCURRENCY = int(os.environ.get("REDRIVE_CONCURRENCY") or 8)
+# Seconds a received Dead Letter Queue message stays invisible, so it is not received twice in a run
+REDRIVE_VISIBILITY_TIMEOUT = 900
+# Outcomes that need no further attempt
+COMPLETE = {"Forwarded", "Duplicate", "Rejected"}
+
+log = logging.getLogger()
+
+
+def error_message_ids(bucket, day):
+    """IDs of the messages with error details saved for a receipt day."""
+    partition = f"{app.S3_PREFIX_ERR}{day:%Y/%m/%d}/"
+    return [o['Key'][len(partition):-len(".json")] for o in index.list_partition(bucket, partition)
+            if o['Key'].endswith(".json")]
+
+
+def receipt_day(bucket, message_id):
+    """Day the raw message was stored, or None if it no longer exists."""
+    try:
+        head = clients.get_client('s3').head_object(Bucket=bucket, Key=app.S3_PREFIX_MSG + message_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404', 'NotFound'):
+            return None
+        raise
+    received = head['LastModified'].astimezone(timezone.utc).replace(tzinfo=None)
+    return received.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def find_notifications(bucket, days, message_ids, workers=None):
+    """Read the SES notifications of `message_ids` from the index of `days`.
+
+    Returns
+    -------
+    Dictionary of message ID to notification, for those found
+
+    """
+    wanted = set(message_ids)
+    keys = [o['Key'] for day in sorted(set(days))
+            for o in index.list_partition(bucket, index.partition(day, app.S3_PREFIX_IDX))]
+    found = {}
+    for notifications in compact.ordered_map(lambda key: compact.read_object(bucket, key), keys,
+                                             workers or REDRIVE_CONCURRENCY):
+        for notification in notifications:
+            message_id = notification['mail']['messageId']
+            if message_id in wanted:
+                found.setdefault(message_id, notification)
+    return found
+
+
+def by_days(bucket, days, workers=None):
+    """Notifications of the messages that failed to send on `days`, oldest first."""
+    found = {}
+    for day in days:
+        message_ids = error_message_ids(bucket, day)
+        if message_ids:
+            found.update(find_notifications(bucket, [day], message_ids, workers))
+    return sorted(found.values(), key=lambda n: n['mail']['timestamp'])
+
+
+def by_ids(bucket, message_ids, workers=None):
+    """Notifications of `message_ids`, in the order given; missing messages are logged."""
+    days = set()
+    for message_id in message_ids:
+        day = receipt_day(bucket, message_id)
+        if day is None:
+            log.warning("Message %s is not in the bucket", message_id)
+            continue
+        # The notification time may be just before midnight
+        days.update([day - timedelta(days=1), day])
+    found = find_notifications(bucket, days, message_ids, workers)
+    for message_id in message_ids:
+        if message_id not in found:
+            log.warning("Message %s is not in the index", message_id)
+    return [found[m] for m in message_ids if m in found]
+
+
+class QueuedNotification(dict):
+    """SES notification read from a queue message, with the message ID as `queue_message_id`."""
+
+    def __init__(self, notification, queue_message_id):
+        super().__init__(notification)
+        self.queue_message_id = queue_message_id
+
+
+class QueueDrain:
+    """Receive the SES events of a Dead Letter Queue until it is empty.
+
+    Iterating yields the SES notifications, as QueuedNotification; `delete`
+    removes the queue message of a notification once all its notifications
+    are complete.
+
+    Parameters
+    ----------
+    queue_url: str, required
+        URL of the queue
+
+    """
+
+    def __init__(self, queue_url, visibility_timeout=REDRIVE_VISIBILITY_TIMEOUT):
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.pending = {}  # queue message ID -> [receipt handle, message IDs not yet complete]
+        self.unreadable = 0
+        self.deleted = 0
+
+    def __iter__(self):
+        client = clients.get_client('sqs')
+        while True:
+            response = client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                              VisibilityTimeout=self.visibility_timeout, WaitTimeSeconds=1)
+            messages = response.get('Messages', [])
+            if not messages:
+                return
+            for message in messages:
+                try:
+                    notifications = app.body_notifications(message['Body'])
+                except (ValueError, KeyError, TypeError) as e:
+                    # Left in the queue for the dead letter handler
+                    log.error("Unable to read queue message %s: %r", message['MessageId'], e)
+                    self.unreadable += 1
+                    continue
+                self.pending[message['MessageId']] = [message['ReceiptHandle'],
+                                                      {n['mail']['messageId'] for n in notifications}]
+                for notification in notifications:
+                    yield QueuedNotification(notification, message['MessageId'])
+
+    def delete(self, notification):
+        queue_message_id = getattr(notification, 'queue_message_id', None)
+        handle, remaining = self.pending.get(queue_message_id, (None, set()))
+        remaining.discard(notification['mail']['messageId'])
+        if handle is not None and not remaining:
+            clients.get_client('sqs').delete_message(QueueUrl=self.queue_url, ReceiptHandle=handle)
+            del self.pending[queue_message_id]
+            self.deleted += 1
+
+
+class Checkpoint:
+    """Append-only record of the messages redriven, one JSON line each.
+
+    Parameters
+    ----------
+    path: str, optional
+        Checkpoint file; None keeps no record
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        if result['outcome'] in COMPLETE:
+                            self.done.add(result['messageId'])
+        self.file = open(path, 'a') if path else None
+
+    def __contains__(self, message_id):
+        return message_id in self.done
+
+    def record(self, result):
+        if result['outcome'] in COMPLETE:
+            self.done.add(result['messageId'])
+        if self.file is not None:
+            self.file.write(json.dumps(result) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def redrive_message(notification):
+    """Check and forward one message again, like process_ses_notification without the index.
+
+    Returns
+    -------
+    Dictionary with messageId, outcome, and outgoing (the outgoing Message
+    ID) or errorCode and errorMessage
+
+    """
+    message_id = notification['mail']['messageId']
+    result = {"messageId": message_id}
+    pipeline = filters.get_pipeline()
+    try:
+        recipients = pipeline.evaluate(notification)
+        if pipeline.deny_headers:
+            pipeline.check_headers(headers.MessageHeaders(notification, app.S3_BUCKET, app.S3_PREFIX_MSG + message_id))
+        message_ledger = ledger.get_ledger(app.S3_BUCKET)
+        entry = message_ledger.lookup(message_id, recipients) if message_ledger is not None else None
+        if entry is not None:
+            return dict(result, outcome="Duplicate", outgoing=entry['outgoing'])
+        message_groups = routing.get_router().route_modes(recipients, app.DEST_DOM)
+        outgoing = app.forward_routed(message_id, message_groups, max_size=pipeline.check_size,
+                                      timestamp=notification['mail']['timestamp'], message_ledger=message_ledger)
+        if message_ledger is not None:
+            message_ledger.record(message_id, recipients, outgoing)
+        return dict(result, outcome="Forwarded", outgoing=outgoing)
+    except filters.Rejected as e:
+        return dict(result, outcome="Rejected", errorCode=e.rule, errorMessage=e.detail)
+    except ClientError as e:
+        return dict(result, outcome="Failed", errorCode=e.response['Error']['Code'],
+                    errorMessage=e.response['Error']['Message'])
+    except Exception as e:
+        log.exception("Error Redriving %s", message_id)
+        return dict(result, outcome="Failed", errorCode=type(e).__name__, errorMessage=str(e))
+
+
+def redrive(notifications, workers=None, checkpoint=None, on_complete=None):
+    """Forward messages again, `workers` at a time.
+
+    Parameters
+    ----------
+    notifications: iterable, required
+        SES notifications, read as they are needed
+
+    checkpoint: Checkpoint, optional
+        Messages in the checkpoint are skipped, and results are recorded in it
+
+    on_complete: callable, optional
+        Called with each notification that needs no further attempt
+
+    Returns
+    -------
+    Summary dictionary with the number of messages, seconds, and counters
+    of outcomes and error codes
+
+    """
+    checkpoint = checkpoint or Checkpoint()
+    outcomes, errors = Counter(), Counter()
+
+    def attempt(notification):
+        if notification['mail']['messageId'] in checkpoint:
+            return notification, {"messageId": notification['mail']['messageId'], "outcome": "Skipped"}
+        return notification, redrive_message(notification)
+
+    start = time.perf_counter()
+    for notification, result in compact.ordered_map(attempt, notifications, workers or REDRIVE_CONCURRENCY):
+        outcomes[result['outcome']] += 1
+        if result['outcome'] == "Skipped":
+            complete = True
+        else:
+            checkpoint.record(result)
+            complete = result['outcome'] in COMPLETE
+        if result['outcome'] == "Failed":
+            errors[result['errorCode']] += 1
+            log.error("Message %s Failed: <%s> %s", result['messageId'], result['errorCode'], result['errorMessage'])
+        if complete and on_complete is not None:
+            on_complete(notification)
+    return {
+        "messages": sum(outcomes.values()),
+        "seconds": time.perf_counter() - start,
+        "outcomes": outcomes,
+        "errors": errors,
+    }
+
+
+def format_summary(summary):
+    seconds = summary['seconds']
+    lines = ["%d messages in %.1f s, %.1f messages/sec" % (
+        summary['messages'], seconds, summary['messages'] / seconds if seconds else 0.0)]
+    lines.extend("  %s: %d" % item for item in sorted(summary['outcomes'].items()))
+    if summary['errors']:
+        lines.append("Errors by code:")
+        lines.extend("  %s: %d" % item for item in summary['errors'].most_common())
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--bucket", default=app.S3_BUCKET, required=not app.S3_BUCKET)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--since", help="first receipt day of failed messages, YYYY/MM/DD")
+    source.add_argument("--ids", nargs="+", metavar="MESSAGE_ID", help="message IDs to forward")
+    source.add_argument("--queue", metavar="QUEUE_URL", help="drain this Dead Letter Queue")
+    parser.add_argument("--until", help="last receipt day for --since (default today)")
+    parser.add_argument("--rate", type=float, help="sends per second (default SEND_RATE or the account rate)")
+    parser.add_argument("--workers", type=int, default=REDRIVE_CONCURRENCY, help="messages forwarded at once")
+    parser.add_argument("--checkpoint", help="file recording progress, to resume an interrupted run")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(message)s")
+
+    app.S3_BUCKET = args.bucket
+    if args.rate:
+        sender.set_scheduler(sender.SendScheduler(args.rate))
+    drain = None
+    if args.queue:
+        drain = QueueDrain(args.queue)
+        notifications = drain
+    elif args.ids:
+        notifications = by_ids(args.bucket, args.ids, args.workers)
+    else:
+        since = datetime.strptime(args.since, "%Y/%m/%d")
+        until = datetime.strptime(args.until, "%Y/%m/%d") if args.until else datetime.now(timezone.utc).replace(tzinfo=None)
+        days = [since + timedelta(days=n) for n in range((until - since).days + 1)]
+        notifications = by_days(args.bucket, days, args.workers)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        summary = redrive(notifications, args.workers, checkpoint, drain and drain.delete)
+    finally:
+        checkpoint.close()
+    print(format_summary(summary))
+    if drain is not None:
+        print("Deleted %d queue messages, %d unreadable left in the queue" % (drain.deleted, drain.unreadable))
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""Header-only rewriting of raw email messages.
+
+Only the header block is parsed.  The body is joined back to the new headers
+byte for byte, so MIME parts are never decoded, re-encoded or re-folded.
+"""
+
+# Header folding whitespace, see RFC 5322 section 2.2.3
+FOLDING_WS = (b" ", b"\t")
+# Longer header lines are folded at address list commas, see RFC 5322 section 2.1.1
+FOLD_LENGTH = 78
+
+
+def split_message(raw):
+    """Split a raw message into its header block, blank separator line and body.
+
+    Parameters
+    ----------
+    raw: bytes, required
+        Raw email message
+
+    Returns
+    -------
+    Tuple of (header_block, separator, body) where header_block includes the
+    line ending of the last header, separator is the empty line and body is a
+    memoryview of `raw` (no copy is made).
+
+    """
+    crlf = raw.find(b"\r\n\r\n")
+    lf = raw.find(b"\n\n")
+    if crlf < 0 and lf < 0:
+        return raw, b"", memoryview(b"")
+    if lf < 0 or (0 <= crlf < lf):
+        split, eol = crlf, b"\r\n"
+    else:
+        split, eol = lf, b"\n"
+    body_start = split + 2 * len(eol)
+    return raw[:split + len(eol)], eol, memoryview(raw)[body_start:]
+
+
+def header_eol(header_block):
+    """Line ending used by a header block, CRLF unless the block uses bare LF."""
+    first = header_block.find(b"\n")
+    if first > 0 and header_block[first - 1:first] != b"\r":
+        return b"\n"
+    return b"\r\n"
+
+
+def parse_header_block(header_block):
+    """Split a header block into fields.
+
+    Returns
+    -------
+    List of (name, raw_field) tuples, where raw_field are the original bytes of
+    the field including continuation lines and line endings.
+
+    """
+    fields = []
+    for line in header_block.splitlines(keepends=True):
+        if fields and line.startswith(FOLDING_WS):
+            name, raw_field = fields[-1]
+            fields[-1] = (name, raw_field + line)
+        else:
+            name = line.split(b":", 1)[0].strip().decode('ascii', 'surrogateescape')
+            fields.append((name, line))
+    return fields
+
+
+def field_value(raw_field):
+    """Return the unfolded value of a raw header field as a string.
+
+    Non-ASCII bytes are kept as surrogate escapes so that they are restored
+    unchanged by `format_field`.
+    """
+    value = raw_field.split(b":", 1)[1] if b":" in raw_field else b""
+    value = value.decode('ascii', 'surrogateescape')
+    return "".join(value.splitlines()).strip()
+
+
+def fold_line(line, eol="\r\n"):
+    """Fold a header line longer than FOLD_LENGTH.
+
+    Lines are folded after the commas of ", " separators, and items that are
+    still too long, such as a subject of encoded words, at their spaces.  The
+    space becomes the folding whitespace of the next line, so the unfolded value
+    is unchanged.
+    """
+    lines = [""]
+    for number, part in enumerate(line.split(", ")):
+        separator = ""
+        if number > 0:
+            separator = ", "
+            if len(lines[-1]) + 2 + len(part) > FOLD_LENGTH:
+                lines[-1] += ","
+                lines.append("")
+                separator = " "
+        for index, word in enumerate(part.split(" ")):
+            if index > 0:
+                separator = " "
+                if len(lines[-1]) + 1 + len(word) > FOLD_LENGTH and lines[-1].strip():
+                    lines.append("")
+            lines[-1] += separator + word
+    return eol.join(lines)
+
+
+def format_field(name, value, eol=b"\r\n"):
+    """Encode a header field from a name and value, folding long lines (see `fold_line`)."""
+    line = f"{name}: {value}"
+    if len(line) > FOLD_LENGTH:
+        line = fold_line(line, eol.decode('ascii'))
+    return line.encode('utf-8', 'surrogateescape') + eol
+
+
+def rewrite_header_block(header_block, transform=None, replace=None, delete=(), eol=None, copy=None):
+    """Rewrite the fields of a header block.
+
+    Parameters
+    ----------
+    header_block: bytes, required
+        Header block as returned by `split_message`
+
+    transform: dict, optional
+        Map of header name to a function applied to the value of every field
+        with that name
+
+    replace: dict, optional
+        Map of header name to a new value.  The first field with that name is
+        replaced, any others are removed, and the field is added if missing.
+
+    delete: list, optional
+        Header names to remove
+
+    eol: bytes, optional
+        Line ending for new fields, detected from `header_block` by default
+
+    copy: dict, optional
+        Map of header name to the name of another header.  If the message has
+        no field with that name, one is added with the original value of the
+        first field of the other header, if any.
+
+    Returns
+    -------
+    New header block, as bytes
+
+    """
+    eol = eol or header_eol(header_block)
+    if header_block and not header_block.endswith(b"\n"):
+        header_block += eol
+    transform = {k.lower(): v for k, v in (transform or {}).items()}
+    replace_lower = {k.lower(): k for k in (replace or {})}
+    delete = {k.lower() for k in delete}
+    copy = {k.lower(): (k, v.lower()) for k, v in (copy or {}).items()}
+    copy_sources = {source for _, source in copy.values()}
+    originals = {}
+    seen = set()
+    replaced = set()
+    fields = []
+    for name, raw_field in parse_header_block(header_block):
+        key = name.lower()
+        seen.add(key)
+        if key in copy_sources and key not in originals:
+            originals[key] = field_value(raw_field)
+        if key in delete:
+            continue
+        if key in replace_lower:
+            if key not in replaced:
+                replaced.add(key)
+                fields.append(format_field(name, replace[replace_lower[key]], eol))
+            continue
+        if key in transform:
+            raw_field = format_field(name, transform[key](field_value(raw_field)), eol)
+        fields.append(raw_field)
+    for key, name in replace_lower.items():
+        if key not in replaced:
+            fields.append(format_field(name, replace[name], eol))
+    for key, (name, source) in copy.items():
+        if key not in seen and key not in delete and key not in replace_lower and source in originals:
+            fields.append(format_field(name, originals[source], eol))
+    return b"".join(fields)
+
+
+def rewrite_message(raw, transform=None, replace=None, delete=(), copy=None):
+    """Rewrite the headers of a raw message, leaving the body untouched.
+
+    See `rewrite_header_block` for the parameters.
+
+    Returns
+    -------
+    New raw message, as bytes.  The body bytes are identical to those of `raw`.
+
+    """
+    header_block, separator, body = split_message(raw)
+    new_headers = rewrite_header_block(header_block, transform, replace, delete, separator or None, copy)
+    return b"".join((new_headers, separator, body))
+
+
+def read_header_block(fp, chunk_size=64 * 1024):
+    """Read the header block from the start of a file object.
+
+    Returns
+    -------
+    Tuple of (header_block, separator, body_offset), see `split_message`.
+    The file position is left undefined.
+
+    """
+    buffer = bytearray()
+    while True:
+        chunk = fp.read(chunk_size)
+        # Only the new bytes, and the end of a separator started in the previous chunk, are searched
+        start = max(len(buffer) - 3, 0)
+        buffer += chunk
+        if buffer.find(b"\n\n", start) >= 0 or buffer.find(b"\r\n\r\n", start) >= 0 or not chunk:
+            header_block, separator, body = split_message(bytes(buffer))
+            return header_block, separator, len(buffer) - len(body)
+
+
+def rewrite_file(fp, size, transform=None, replace=None, delete=(), chunk_size=1024 * 1024, copy=None):
+    """Rewrite the headers of a raw message held in a seekable file object.
+
+    The output is assembled in a single pre-allocated buffer and the body is
+    copied into it chunk by chunk, so only one full copy of the message is held
+    in memory.  See `rewrite_header_block` for the parameters.
+
+    Parameters
+    ----------
+    fp: file-like, required
+        Seekable file object positioned at the start of the message
+
+    size: int, required
+        Size of the message in bytes
+
+    Returns
+    -------
+    New raw message, as a bytearray
+
+    """
+    header_block, separator, body_offset = read_header_block(fp)
+    new_headers = rewrite_header_block(header_block, transform, replace, delete, separator or None, copy)
+    head_size = len(new_headers) + len(separator)
+    out = bytearray(head_size + size - body_offset)
+    out[:head_size] = new_headers + separator
+    view = memoryview(out)
+    pos = head_size
+    fp.seek(body_offset)
+    while pos < len(out):
+        chunk = fp.read(min(chunk_size, len(out) - pos))
+        if not chunk:
+            raise ValueError("Message ended after %d of %d bytes" % (pos - head_size + body_offset, size))
+        view[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+    return out
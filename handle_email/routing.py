@@ -0,0 +1,250 @@
+"""Recipient routing table.
+
+Routes map incoming recipient addresses to one or more destination
+addresses.  The table is loaded from the environment variable ROUTES_CONFIG
+(JSON), the file named by ROUTES_CONFIG_FILE (relative to this directory), or
+the S3 object named by ROUTES_CONFIG_S3 ("s3://bucket/key"), and is cached
+per container.  An S3 table is refreshed every ROUTES_TTL seconds with a
+conditional GET, so it is only downloaded again when it changes.
+
+    {
+      "routes": {
+        "alice@example.com": ["alice@dest.com", "alice@backup.example.net"],
+        "sales-*@example.com": "sales@dest.com",
+        "*@example.org": "{local}.org@dest.com",
+        "reports@example.com": {"to": "reports@dest.com", "forward": "attachment"},
+        "*": "{local}@{dest_domain}"
+      }
+    }
+
+Patterns are an exact address, a local-part prefix followed by "*" within a
+domain (the longest prefix wins), "*@domain" for a domain catch-all, or "*"
+for everything else.  Destinations may use "{local}", "{domain}" and
+"{dest_domain}" (the DEST_DOM setting).  Without a "*" route, recipients are
+sent to "{local}@{dest_domain}".
+
+A route may also be an object with the destinations in "to" and the way the
+message is forwarded in "forward" (see FORWARD_MODES), FORWARD_MODE by default:
+
+* "inline":  the original message, with its headers rewritten (app.forward_message)
+* "rfc822":  wrapped as a message/rfc822 part of a new message (see wrap.py)
+* "attachment":  wrapped as a base64 encoded "original.eml" attachment
+"""
+import os
+import json
+import time
+import logging
+import threading
+from botocore.exceptions import ClientError
+try:
+    from . import clients
+except ImportError:  # Lambda loads this file as a top-level module
+    import clients
+
+
+ROUTES_CONFIG = os.environ.get("ROUTES_CONFIG")
+ROUTES_CONFIG_FILE = os.environ.get("ROUTES_CONFIG_FILE")
+ROUTES_CONFIG_S3 = os.environ.get("ROUTES_CONFIG_S3")
+ROUTES_TTL = float(os.environ.get("ROUTES_TTL") or 300)
+DEFAULT_ROUTE = "{local}@{dest_domain}"
+FORWARD_MODES = ("inline", "rfc822", "attachment")
+# Forwarding mode of routes that do not set one
+FORWARD_MODE = os.environ.get("FORWARD_MODE") or "inline"
+# SES limit on the number of recipients per message
+MAX_RECIPIENTS = 50
+
+log = logging.getLogger()
+
+_router = None
+_lock = threading.Lock()
+
+_END = ""  # Trie key holding the destinations of a prefix
+
+
+def chunked(items, size=MAX_RECIPIENTS):
+    """Split a list into lists of at most `size` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def parse_route(route):
+    """Destinations and forwarding mode (None for the default) of a route value."""
+    mode = None
+    if isinstance(route, dict):
+        mode = route.get("forward")
+        if mode is not None and mode not in FORWARD_MODES:
+            raise ValueError("Unsupported forwarding mode: %s" % (mode,))
+        route = route.get("to", [DEFAULT_ROUTE])
+    if isinstance(route, str):
+        route = [route]
+    return list(route), mode
+
+
+class Router:
+    """Compiled routing table.
+
+    Parameters
+    ----------
+    routes: dict, optional
+        Map of pattern to a destination, a list of destinations, or an
+        object with "to" and "forward" (see parse_route)
+
+    """
+
+    def __init__(self, routes=None):
+        self.exact = {}
+        self.prefixes = {}  # domain -> trie of local part prefixes
+        self.default = ([DEFAULT_ROUTE], None)
+        for pattern, value in (routes or {}).items():
+            route = parse_route(value)
+            pattern = pattern.strip().lower()
+            if pattern == "*":
+                self.default = route
+            elif "*" in pattern:
+                local, _, domain = pattern.rpartition("@")
+                if not local.endswith("*") or "*" in local[:-1] or "*" in domain:
+                    raise ValueError("Unsupported route pattern: %s" % (pattern,))
+                node = self.prefixes.setdefault(domain, {})
+                for char in local[:-1]:
+                    node = node.setdefault(char, {})
+                node[_END] = route
+            else:
+                self.exact[pattern] = route
+
+    def lookup(self, recipient):
+        """Destination templates and forwarding mode for a single recipient address."""
+        recipient = recipient.strip().lower()
+        route = self.exact.get(recipient)
+        if route is not None:
+            return route
+        local, _, domain = recipient.rpartition("@")
+        node = self.prefixes.get(domain)
+        if node is not None:
+            route = node.get(_END)
+            for char in local:
+                node = node.get(char)
+                if node is None:
+                    break
+                route = node.get(_END, route)
+            if route is not None:
+                return route
+        return self.default
+
+    def routed(self, recipients, dest_domain=None):
+        """Map recipients to their destinations and forwarding modes.
+
+        Returns
+        -------
+        List of unique (destination address, mode), in order of first
+        appearance; a destination routed more than once keeps its first mode
+
+        """
+        routed = {}
+        for recipient in recipients:
+            local, _, domain = recipient.strip().rpartition("@")
+            templates, mode = self.lookup(recipient)
+            for template in templates:
+                destination = template.format(local=local, domain=domain, dest_domain=dest_domain)
+                routed.setdefault(destination.lower(), (destination, mode or FORWARD_MODE))
+        return list(routed.values())
+
+    def route(self, recipients, dest_domain=None):
+        """Map recipients to their destinations.
+
+        Returns
+        -------
+        List of unique destination addresses, in order of first appearance
+
+        """
+        return [destination for destination, _ in self.routed(recipients, dest_domain)]
+
+    def route_modes(self, recipients, dest_domain=None):
+        """Map recipients to their destinations, grouped by forwarding mode.
+
+        Returns
+        -------
+        Dictionary of mode to list of destination addresses, see `routed`
+
+        """
+        groups = {}
+        for destination, mode in self.routed(recipients, dest_domain):
+            groups.setdefault(mode, []).append(destination)
+        return groups
+
+
+def load_routes(etag=None):
+    """Read the routing table configuration.
+
+    Returns
+    -------
+    Tuple of (routes, etag).  routes is None if the S3 object has not changed
+    since `etag`.
+
+    """
+    if ROUTES_CONFIG:
+        return json.loads(ROUTES_CONFIG).get("routes"), None
+    if ROUTES_CONFIG_FILE:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), ROUTES_CONFIG_FILE)) as f:
+            return json.load(f).get("routes"), None
+    if ROUTES_CONFIG_S3:
+        bucket, _, key = ROUTES_CONFIG_S3[len("s3://"):].partition("/")
+        kwargs = {'IfNoneMatch': etag} if etag else {}
+        try:
+            response = clients.get_client('s3').get_object(Bucket=bucket, Key=key, **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return None, etag
+            raise
+        return json.load(response['Body']).get("routes"), response.get('ETag')
+    return None, None
+
+
+class CachedRouter:
+    """Router that reloads its table when older than ROUTES_TTL seconds."""
+
+    def __init__(self, ttl=None, clock=time.monotonic):
+        self.ttl = ROUTES_TTL if ttl is None else ttl
+        self.clock = clock
+        self.router = None
+        self.etag = None
+        self.loaded = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.router is not None and not ROUTES_CONFIG_S3:
+            return self.router
+        if self.router is None or self.clock() - self.loaded >= self.ttl:
+            with self._lock:
+                if self.router is None or self.clock() - self.loaded >= self.ttl:
+                    self.refresh()
+        return self.router
+
+    def refresh(self):
+        try:
+            routes, etag = load_routes(self.etag)
+        except Exception:
+            if self.router is None:
+                raise
+            log.exception("Unable to reload routes, keeping the current table")
+            routes, etag = None, self.etag
+        if routes is not None or self.router is None:
+            self.router = Router(routes)
+            log.info("Loaded %d routes (ETag %s)", len(routes or {}), etag)
+        self.etag = etag
+        self.loaded = self.clock()
+
+
+def get_router():
+    """Return the routing table for this container, loading or refreshing it as needed."""
+    global _router
+    if _router is None:
+        with _lock:
+            if _router is None:
+                _router = CachedRouter()
+    return _router.get()
+
+
+def reset_router():
+    """Forget the cached routing table; it is reloaded on next use."""
+    global _router
+    with _lock:
+        _router = None
@@ -0,0 +1,197 @@
+"""Rate-limited sending through SES with backoff on throttling.
+
+A token bucket per container spaces sends to the account's maximum send rate,
+read once from SES and cached.  Throttled sends are retried with jittered
+exponential backoff for as long as the remaining Lambda time allows.
+"""
+import os
+import time
+import random
+import logging
+import threading
+from botocore.exceptions import ClientError
+try:
+    from . import clients
+except ImportError:  # Lambda loads this file as a top-level module
+    import clients
+
+
+# Sends per second for this container; when not set, the account MaxSendRate is used.
+SEND_RATE = float(os.environ.get("SEND_RATE") or 0)
+# Fraction of the account send rate used by each container, for running several concurrently.
+SEND_RATE_FRACTION = float(os.environ.get("SEND_RATE_FRACTION") or 1.0)
+SEND_MAX_ATTEMPTS = int(os.environ.get("SEND_MAX_ATTEMPTS") or 8)
+SEND_BACKOFF_BASE = float(os.environ.get("SEND_BACKOFF_BASE") or 0.2)  # seconds
+SEND_BACKOFF_MAX = float(os.environ.get("SEND_BACKOFF_MAX") or 10)  # seconds
+# Time kept in reserve for the error path when retrying within the Lambda time budget.
+SEND_TIME_RESERVE_MS = int(os.environ.get("SEND_TIME_RESERVE_MS") or 3000)
+
+THROTTLE_CODES = {"Throttling", "ThrottlingException", "TooManyRequestsException"}
+
+log = logging.getLogger()
+
+_scheduler = None
+_lock = threading.Lock()
+
+
+def is_throttle(error):
+    """True if a ClientError is a send rate throttle (and not the daily quota)."""
+    err = error.response.get('Error', {})
+    return (err.get('Code') in THROTTLE_CODES and
+            "daily message quota" not in err.get('Message', "").lower())
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` operations per second."""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait=None):
+        """Take a token, returning the seconds to wait before using it.
+
+        Returns None, without taking a token, if the wait would be longer
+        than `max_wait` seconds.
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def acquire(self, max_wait=None):
+        """Wait for a token; returns False if it would take longer than `max_wait` seconds."""
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+def account_send_rate():
+    """Read the maximum send rate of the account from SES, or None if unavailable."""
+    try:
+        quota = clients.get_client('sesv2').get_account()['SendQuota']
+    except ClientError as e:
+        log.warning("Unable to read SES send quota: <%s> %s", e.response['Error']['Code'], e.response['Error']['Message'])
+        return None
+    log.info("SES Send Quota: %s", quota)
+    return quota.get('MaxSendRate')
+
+
+class SendScheduler:
+    """Send raw messages through SESv2 at a bounded rate, retrying throttles.
+
+    Parameters
+    ----------
+    rate: float, optional
+        Sends per second; None or 0 disables rate limiting
+
+    """
+
+    def __init__(self, rate=None, sleep=time.sleep):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.sleep = sleep
+
+    def backoff(self, attempt):
+        """Full jitter exponential backoff, in seconds."""
+        return random.uniform(0, min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * 2 ** attempt))
+
+    def send_email(self, remaining_ms=None, stats=None, **kwargs):
+        """Call sesv2 send_email, waiting for the rate limit and retrying throttles.
+
+        Parameters
+        ----------
+        remaining_ms: callable, optional
+            Returns the remaining time budget in milliseconds, such as
+            context.get_remaining_time_in_millis of the Lambda context
+
+        stats: metrics.Metrics, optional
+            Throttles and time spent waiting are added to these metrics
+
+        Returns
+        -------
+        Response of send_email
+
+        Raises
+        ------
+        ClientError when sending fails, or when throttled and either the time
+        budget or SEND_MAX_ATTEMPTS is exhausted.  Its `attempts` attribute is
+        the number of send_email calls made.
+
+        """
+        def budget():
+            if remaining_ms is None:
+                return None
+            return max(0.0, (remaining_ms() - SEND_TIME_RESERVE_MS) / 1000)
+
+        ses_client = clients.get_client('sesv2')
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                start = time.perf_counter()
+                if not self.bucket.acquire(budget()):
+                    error = ClientError({'Error': {
+                        'Code': 'Throttling',
+                        'Message': "Send rate limit not available within the remaining time",
+                    }}, 'SendEmail')
+                    error.attempts = attempt
+                    raise error
+                if stats is not None:
+                    stats.add("RateWaitTime", (time.perf_counter() - start) * 1000, "Milliseconds")
+            try:
+                return ses_client.send_email(**kwargs)
+            except ClientError as e:
+                attempt += 1
+                e.attempts = attempt
+                if not is_throttle(e):
+                    raise
+                if stats is not None:
+                    stats.add("SendThrottles", 1, "Count")
+                delay = self.backoff(attempt)
+                remaining = budget()
+                if attempt >= SEND_MAX_ATTEMPTS or (remaining is not None and delay > remaining):
+                    log.warning("Send Throttled, giving up after %d attempts", attempt)
+                    raise
+                log.info("Send Throttled, retrying in %.2f s (attempt %d)", delay, attempt)
+                self.sleep(delay)
+
+
+def get_scheduler():
+    """Return the scheduler for this container, reading the send quota on first use."""
+    global _scheduler
+    if _scheduler is None:
+        with _lock:
+            if _scheduler is None:
+                rate = SEND_RATE
+                if not rate:
+                    rate = account_send_rate()
+                    if rate:
+                        rate *= SEND_RATE_FRACTION
+                log.info("Send Rate Limit: %s per second", rate or "none")
+                _scheduler = SendScheduler(rate)
+    return _scheduler
+
+
+def set_scheduler(scheduler):
+    """Replace the scheduler, e.g. with a different send rate.  None recreates it on next use."""
+    global _scheduler
+    with _lock:
+        _scheduler = scheduler
+
+
+def reset_scheduler():
+    """Forget the scheduler and cached quota; they are recreated on next use."""
+    global _scheduler
+    with _lock:
+        _scheduler = None
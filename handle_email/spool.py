@@ -0,0 +1,68 @@
+import os
+import resource
+import tempfile
+
+
+# Raw messages up to this size are buffered in memory, larger ones spill to disk (/tmp in Lambda).
+SPOOL_MAX_MEMORY = int(os.environ.get("SPOOL_MAX_MEMORY") or 8 * 1024 * 1024)
+SPOOL_CHUNK_SIZE = int(os.environ.get("SPOOL_CHUNK_SIZE") or 1024 * 1024)
+SPOOL_DIR = os.environ.get("SPOOL_DIR") or None  # Default is tempfile.gettempdir()
+# SES limit on the size of a raw message, including headers and attachments.
+MAX_MESSAGE_SIZE = int(os.environ.get("MAX_MESSAGE_SIZE") or 40 * 1024 * 1024)
+
+
+class MessageTooLarge(Exception):
+    """Raised when a message is larger than the SES raw message size limit."""
+    def __init__(self, size, limit=None):
+        limit = limit or MAX_MESSAGE_SIZE
+        super().__init__("Message size %d exceeds limit of %d bytes" % (size, limit))
+        self.size = size
+        self.limit = limit
+
+
+def check_size(size, limit=None):
+    """Raise MessageTooLarge if `size` is over the limit (MAX_MESSAGE_SIZE by default)."""
+    limit = limit or MAX_MESSAGE_SIZE
+    if size is not None and size > limit:
+        raise MessageTooLarge(size, limit)
+
+
+def spool_body(body, limit=None, chunk_size=None, max_memory=None):
+    """Copy a streaming body into a spooled temporary file, one chunk at a time.
+
+    Parameters
+    ----------
+    body: file-like, required
+        Object with a read(size) method, such as botocore.response.StreamingBody
+
+    limit: int, optional
+        Maximum number of bytes to accept, MAX_MESSAGE_SIZE by default
+
+    Returns
+    -------
+    Tuple of (spool, size).  The spool is positioned at the start and should be
+    closed by the caller; it is held in memory up to SPOOL_MAX_MEMORY bytes,
+    then moved to a temporary file.
+
+    """
+    chunk_size = chunk_size or SPOOL_CHUNK_SIZE
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory or SPOOL_MAX_MEMORY, dir=SPOOL_DIR)
+    size = 0
+    try:
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            check_size(size, limit)
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, size
+
+
+def peak_rss_kib():
+    """Peak resident set size of this process (container) in KiB, since it started."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
@@ -0,0 +1,137 @@
+"""Forwarding of raw email messages wrapped in a new message.
+
+The original message is kept whole, as the second part of a multipart/mixed
+message after a short text note, either:
+
+* "rfc822":  as a message/rfc822 part, shown inline by most mail clients, with
+  the original bytes unchanged (7bit or 8bit), or
+* "attachment":  as an application/octet-stream attachment "original.eml",
+  base64 encoded.
+
+Like `rewrite.rewrite_file`, the output is assembled in a single buffer
+allocated at its final size, and the original is copied (or encoded) into it
+chunk by chunk from its spool file, so no MIME tree or intermediate copy of the
+message is built.
+"""
+import base64
+import uuid
+try:
+    from . import rewrite
+except ImportError:  # Lambda loads this file as a top-level module
+    import rewrite
+
+
+WRAP_MODES = ("rfc822", "attachment")
+ATTACHMENT_NAME = "original.eml"
+# Bytes encoded per base64 line (76 characters)
+LINE_BYTES = 57
+
+
+def base64_size(size):
+    """Size of `size` bytes encoded as base64 in lines of 76 characters ending in CRLF."""
+    lines, rest = divmod(size, LINE_BYTES)
+    return lines * 78 + ((rest + 2) // 3 * 4 + 2 if rest else 0)
+
+
+def wrapped_size(size, mode):
+    """Size of a message of `size` bytes within a wrapper message, without the wrapper headers."""
+    return base64_size(size) if mode == "attachment" else size
+
+
+def wrapper_parts(mode, headers, note, boundary, eol=b"\r\n"):
+    """Header block and MIME framing of a wrapper message.
+
+    Returns
+    -------
+    Tuple of (head, tail), the bytes before and after the original message
+    (or its base64 encoding)
+
+    """
+    if mode not in WRAP_MODES:
+        raise ValueError("Unknown forwarding mode: %s" % (mode,))
+    note = note.encode('utf-8', 'surrogateescape')
+    note_encoding = "7bit" if note.isascii() else "8bit"
+    if mode == "rfc822":
+        part = [("Content-Type", "message/rfc822"),
+                ("Content-Disposition", "inline"),
+                ("Content-Transfer-Encoding", "7bit")]  # Set to 8bit by wrap_file if needed
+    else:
+        part = [("Content-Type", f'application/octet-stream; name="{ATTACHMENT_NAME}"'),
+                ("Content-Disposition", f'attachment; filename="{ATTACHMENT_NAME}"'),
+                ("Content-Transfer-Encoding", "base64")]
+    delimiter = b"--" + boundary.encode('ascii')
+    head = b"".join(
+        [rewrite.format_field(name, value, eol) for name, value in headers] +
+        [rewrite.format_field("MIME-Version", "1.0", eol),
+         rewrite.format_field("Content-Type", f'multipart/mixed; boundary="{boundary}"', eol),
+         eol,
+         delimiter, eol,
+         rewrite.format_field("Content-Type", "text/plain; charset=utf-8", eol),
+         rewrite.format_field("Content-Transfer-Encoding", note_encoding, eol),
+         eol,
+         note.replace(b"\r\n", b"\n").replace(b"\n", eol), eol,
+         delimiter, eol] +
+        [rewrite.format_field(name, value, eol) for name, value in part] +
+        [eol])
+    tail = eol + delimiter + b"--" + eol
+    return head, tail
+
+
+def wrap_file(fp, size, mode, headers, note, chunk_size=1024 * 1024, boundary=None):
+    """Wrap a raw message held in a seekable file object in a new message.
+
+    Parameters
+    ----------
+    fp: file-like, required
+        Seekable file object positioned at the start of the message
+
+    size: int, required
+        Size of the message in bytes
+
+    mode: str, required
+        "rfc822" or "attachment"
+
+    headers: list, required
+        (name, value) header fields of the new message, such as From, To and
+        Subject; the MIME headers are added
+
+    note: str, required
+        Text of the first part
+
+    boundary: str, optional
+        MIME boundary, random by default
+
+    Returns
+    -------
+    New raw message, as a bytearray
+
+    """
+    boundary = boundary or "=_fwd_" + uuid.uuid4().hex
+    head, tail = wrapper_parts(mode, headers, note, boundary)
+    encoded = mode == "attachment"
+    out = bytearray(len(head) + wrapped_size(size, mode) + len(tail))
+    out[:len(head)] = head
+    view = memoryview(out)
+    pos = len(head)
+    if encoded:
+        chunk_size = max(chunk_size // LINE_BYTES, 1) * LINE_BYTES  # Whole lines per chunk
+    eight_bit = False
+    remaining = size
+    fp.seek(0)
+    while remaining > 0:
+        chunk = fp.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError("Message ended after %d of %d bytes" % (size - remaining, size))
+        remaining -= len(chunk)
+        if encoded:
+            chunk = base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+        elif not eight_bit:
+            eight_bit = not chunk.isascii()
+        view[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+    view[pos:] = tail
+    if eight_bit:
+        # "7bit" and "8bit" have the same length, so the part header is updated in place
+        value = head.rindex(b"Content-Transfer-Encoding: 7bit") + len(b"Content-Transfer-Encoding: ")
+        out[value:value + 4] = b"8bit"
+    return out
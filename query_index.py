@@ -0,0 +1,258 @@
+"""Query the message index from the command line, without Athena.
+
+Day partitions of the index are listed and downloaded in parallel into a
+local cache, with a manifest of the cached objects, so repeated queries
+only download new objects.  Partitions older than SETTLED_DAYS are not
+listed again once cached.  Queries stream through the cached objects one
+at a time:
+
+    python3 query_index.py recent -n 10
+    python3 query_index.py top-sources --days 30
+    python3 query_index.py source-domains --since 2021/09/01 --until 2021/09/30
+    python3 query_index.py destinations
+    python3 query_index.py message d6iitobk75ur44p8kdnnp7g2n800
+
+A message is found by reading the receipt time of its raw message object,
+then searching only the index of that day.  The error details of a message
+that failed to send are read directly from their key in the errors prefix.
+"""
+import os
+import sys
+import gzip
+import json
+import heapq
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+from handle_email import app, clients, index
+
+S3_BUCKET = os.environ.get("S3_BUCKET")
+S3_PREFIX_MSG = os.environ.get("S3_PREFIX_MSG") or "messages/"
+S3_PREFIX_IDX = os.environ.get("S3_PREFIX_IDX") or "index/"
+CACHE_DIR = os.environ.get("INDEX_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "ses-forwarder")
+# Days after which a partition no longer changes, including compaction (see handle_email/compact.py)
+SETTLED_DAYS = 8
+WORKERS = 16
+
+
+def iter_file(path):
+    """Stream the SES notifications of a cached index object."""
+    if path.endswith(".json"):
+        with open(path, 'rb') as f:
+            yield json.load(f)
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def day_range(since, until):
+    """Days from `since` to `until`, inclusive."""
+    days = []
+    day = since
+    while day <= until:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def today():
+    return datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+
+
+class IndexCache:
+    """Local copy of the index partitions of a bucket.
+
+    Parameters
+    ----------
+    bucket: str, required
+        Bucket name
+
+    cache_dir: str, optional
+        Directory of the cache, CACHE_DIR by default
+
+    """
+
+    def __init__(self, bucket, cache_dir=None, prefix=None, workers=WORKERS):
+        self.bucket = bucket
+        self.prefix = S3_PREFIX_IDX if prefix is None else prefix
+        self.root = os.path.join(cache_dir or CACHE_DIR, bucket)
+        self.workers = workers
+        self.manifest_file = os.path.join(self.root, "manifest.json")
+        self.manifest = {"partitions": {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def save_manifest(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.manifest_file + ".tmp", 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+
+    def download(self, key):
+        response = clients.get_client('s3').get_object(Bucket=self.bucket, Key=key)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'wb') as f:
+            for chunk in response['Body'].iter_chunks(1024 * 1024):
+                f.write(chunk)
+        os.replace(path + ".tmp", path)
+
+    def sync(self, days):
+        """Bring the cached partitions of `days` up to date.
+
+        Returns
+        -------
+        Number of objects downloaded
+
+        """
+        partitions = self.manifest["partitions"]
+        settled = today() - timedelta(days=SETTLED_DAYS)
+        stale = [day for day in days if not partitions.get(f"{day:%Y/%m/%d}", {}).get("settled")]
+        with ThreadPoolExecutor(self.workers) as pool:
+            listings = list(pool.map(lambda day: index.list_partition(self.bucket, index.partition(day, self.prefix)),
+                                     stale))
+            downloads = []
+            for day, objects in zip(stale, listings):
+                cached = partitions.get(f"{day:%Y/%m/%d}", {}).get("objects", {})
+                listed = {o['Key']: o['ETag'] for o in objects}
+                downloads.extend(key for key, etag in listed.items() if cached.get(key) != etag)
+                # Objects removed from S3, e.g. by compaction, are removed from the cache
+                for key in set(cached) - set(listed):
+                    if os.path.exists(self.path(key)):
+                        os.remove(self.path(key))
+                partitions[f"{day:%Y/%m/%d}"] = {"objects": listed, "settled": day < settled}
+            list(pool.map(self.download, downloads))
+        if stale:
+            self.save_manifest()
+        return len(downloads)
+
+    def records(self, days):
+        """Stream the SES notifications of `days`, skipping duplicates within each day."""
+        for day in days:
+            seen = set()
+            objects = self.manifest["partitions"].get(f"{day:%Y/%m/%d}", {}).get("objects", {})
+            for key in sorted(objects):
+                for notification in iter_file(self.path(key)):
+                    message_id = notification['mail']['messageId']
+                    if message_id not in seen:
+                        seen.add(message_id)
+                        yield notification
+
+
+def source_domain(source):
+    """Domain of a source address, like split_part(source, '@', 2) in the README queries."""
+    parts = source.split("@")
+    return parts[1].replace(">", "").lower() if len(parts) > 1 else ""
+
+
+def top_sources(records, n=10):
+    return Counter(r['mail']['source'].lower() for r in records).most_common(n)
+
+
+def top_source_domains(records, n=10):
+    return Counter(source_domain(r['mail']['source']) for r in records).most_common(n)
+
+
+def top_destinations(records, n=10):
+    return Counter(d for r in records for d in r['mail']['destination']).most_common(n)
+
+
+def recent(records, n=10):
+    """The `n` most recent messages, as (timestamp, source, destination, subject, messageId)."""
+    latest = heapq.nlargest(n, records, key=lambda r: r['mail']['timestamp'])
+    return [(r['mail']['timestamp'], r['mail']['source'], ", ".join(r['mail']['destination']),
+             r['mail'].get('commonHeaders', {}).get('subject', ""), r['mail']['messageId']) for r in latest]
+
+
+def find_message(cache, message_id, days=None):
+    """Find the SES notification of a message.
+
+    The day is read from the raw message object with a single HEAD request;
+    if it no longer exists, `days` are searched instead.
+
+    Returns
+    -------
+    Tuple of (notification or None, head_object response or None)
+
+    """
+    try:
+        head = clients.get_client('s3').head_object(Bucket=cache.bucket, Key=S3_PREFIX_MSG + message_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404', 'NotFound'):
+            raise
+        head = None
+    if head is not None:
+        received = head['LastModified'].astimezone(timezone.utc).replace(tzinfo=None)
+        day = received.replace(hour=0, minute=0, second=0, microsecond=0)
+        # The notification time may be just before midnight
+        days = [day - timedelta(days=1), day]
+    days = days or []
+    cache.sync(days)
+    for notification in cache.records(days):
+        if notification['mail']['messageId'] == message_id:
+            return notification, head
+    return None, head
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("query", choices=["recent", "top-sources", "source-domains", "destinations", "message"])
+    parser.add_argument("message_id", nargs="?", help="message ID for the message query")
+    parser.add_argument("--bucket", default=S3_BUCKET, required=not S3_BUCKET)
+    parser.add_argument("--days", type=int, default=30, help="query the past DAYS days (default 30)")
+    parser.add_argument("--since", help="first day to query, YYYY/MM/DD")
+    parser.add_argument("--until", help="last day to query, YYYY/MM/DD")
+    parser.add_argument("-n", type=int, default=10, help="number of rows")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="concurrent downloads")
+    args = parser.parse_args(argv)
+
+    until = datetime.strptime(args.until, "%Y/%m/%d") if args.until else today()
+    since = datetime.strptime(args.since, "%Y/%m/%d") if args.since else until - timedelta(days=args.days)
+    days = day_range(since, until)
+    cache = IndexCache(args.bucket, args.cache_dir, workers=args.workers)
+
+    if args.query == "message":
+        if not args.message_id:
+            parser.error("the message query requires a message ID")
+        notification, head = find_message(cache, args.message_id, days)
+        if head is not None:
+            print("Message: s3://%s/%s%s (%d bytes, received %s)" % (
+                args.bucket, S3_PREFIX_MSG, args.message_id, head['ContentLength'], head['LastModified']))
+        if notification is None:
+            print("Message %s is not in the index" % (args.message_id,))
+            return 1
+        print(json.dumps(notification, indent=2))
+        details = app.read_message_error(args.message_id, notification['mail']['timestamp'], args.bucket)
+        if details is not None:
+            print("Send error: s3://%s/%s" % (args.bucket, details['message']))
+            print(json.dumps(details, indent=2))
+        return 0
+
+    downloaded = cache.sync(days)
+    print("Downloaded %d index objects" % (downloaded,), file=sys.stderr)
+    records = cache.records(days)
+    if args.query == "recent":
+        rows = recent(records, args.n)
+    elif args.query == "top-sources":
+        rows = top_sources(records, args.n)
+    elif args.query == "source-domains":
+        rows = top_source_domains(records, args.n)
+    else:
+        rows = top_destinations(records, args.n)
+    for row in rows:
+        print("\t".join(str(value) for value in row))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
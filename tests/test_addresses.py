@@ -0,0 +1,72 @@
+import random
+import unittest
+from email.utils import formataddr, getaddresses
+from handle_email import addresses, rewrite
+from benchmarks.bench_addresses import legacy_transform_address
+from tests.test_handle_email import TRANSFORM_CASES
+
+DOMAIN = "source.com"
+NAMES = ["", "John", "Name One", "Doe, John", 'Jane "JJ" Doe', "O'Brien (Sales)", "a <b> c", "back\\slash",
+         "=?utf-8?q?Ren=C3=A9?=", "=?utf-8?b?w6lsw6huZQ==?="]
+LOCALS = ["a", "first.last", "user+tag", "x-y_z", "o'brien"]
+DOMAINS = ["example.com", "mail.example.org", "sub.example.co.uk"]
+
+
+def random_address_list(rng):
+    """Header value of 1-4 random addresses, and the (name, address) pairs it holds."""
+    pairs = [(rng.choice(NAMES), "%s@%s" % (rng.choice(LOCALS), rng.choice(DOMAINS)))
+             for _ in range(rng.randint(1, 4))]
+    return ", ".join(formataddr(pair) for pair in pairs), pairs
+
+
+class TestAddresses(unittest.TestCase):
+
+    def test_existing_cases(self):
+        for value, transformed, user in TRANSFORM_CASES:
+            self.assertEqual(addresses.transform(value, DOMAIN), transformed)
+            self.assertEqual(addresses.users(value), [user])
+            # Same result as the previous implementation for single addresses
+            self.assertEqual(addresses.transform(value, DOMAIN), legacy_transform_address(value, DOMAIN))
+
+    def test_address_lists(self):
+        self.assertEqual(addresses.transform('"Doe, John" <john@example.com>, jane@example.org', DOMAIN),
+                         '"Doe, John" <john_example.com@source.com>, jane_example.org@source.com')
+        self.assertEqual(addresses.transform("=?utf-8?q?Ren=C3=A9?= <rene@example.org>", DOMAIN),
+                         "=?utf-8?q?Ren=C3=A9?= <rene_example.org@source.com>")
+        self.assertEqual(addresses.transform_all(["a@example.com", "b@example.com (Bee)"], DOMAIN),
+                         ["a_example.com@source.com", "Bee <b_example.com@source.com>"])
+
+    def test_raw_non_ascii_name(self):
+        raw = rewrite.field_value('From: "Déjà, Vu" <dv@example.com>\r\n'.encode())
+        transformed = addresses.transform(raw, DOMAIN)
+        self.assertEqual(rewrite.format_field("From", transformed),
+                         'From: "Déjà, Vu" <dv_example.com@source.com>\r\n'.encode())
+
+    def test_no_address(self):
+        for value in ["", "<>", "undisclosed-recipients:;"]:
+            self.assertEqual(addresses.transform(value, DOMAIN), "")
+
+    def test_addresses(self):
+        self.assertEqual(addresses.addresses(["A@example.com", "Bee <b@example.com>, a@example.com", "c@example.com"]),
+                         ["A@example.com", "b@example.com", "c@example.com"])
+
+    def test_properties(self):
+        rng = random.Random(22)
+        for _ in range(500):
+            value, pairs = random_address_list(rng)
+            transformed = addresses.transform(value, DOMAIN)
+            # Every address is rewritten, and display names survive a round trip
+            self.assertEqual(getaddresses([transformed]),
+                             [(name, "%s@%s" % (addr.replace("@", "_"), DOMAIN)) for name, addr in pairs])
+            self.assertEqual(addresses.users(value), [addr.replace("@", "_") for _, addr in pairs])
+            # Idempotent per value, and cached
+            self.assertEqual(addresses.transform(value, DOMAIN), transformed)
+
+    def test_cache_keyed_on_domain(self):
+        self.assertEqual(addresses.transform("a@example.com", "one.com"), "a_example.com@one.com")
+        self.assertEqual(addresses.transform("a@example.com", "two.com"), "a_example.com@two.com")
+        self.assertLessEqual(addresses.cache_info().currsize, addresses.ADDRESS_CACHE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from handle_email import clients
+from benchmarks import bench_startup, corpus, driver, standins
+
+
+class TestStandIns(unittest.TestCase):
+
+    def test_s3_list_pagination(self):
+        s3 = standins.InMemoryS3()
+        for i in range(25):
+            s3.put_object(Bucket="b", Key="index/2021/09/%02d/%d.json" % (i % 3, i), Body=b"{}")
+        s3.put_object(Bucket="b", Key="other/x", Body=b"")
+        pages = list(s3.get_paginator('list_objects_v2').paginate(Bucket="b", Prefix="index/", MaxKeys=10))
+        self.assertEqual([p['KeyCount'] for p in pages], [10, 10, 5])
+        keys = [c['Key'] for p in pages for c in p['Contents']]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), 25)
+        days = s3.list_objects_v2(Bucket="b", Prefix="index/2021/09/", Delimiter="/")
+        self.assertEqual([p['Prefix'] for p in days['CommonPrefixes']],
+                         ["index/2021/09/00/", "index/2021/09/01/", "index/2021/09/02/"])
+
+    def test_s3_get_range_and_missing(self):
+        s3 = standins.InMemoryS3()
+        s3.put_object(Bucket="b", Key="k", Body=b"0123456789")
+        self.assertEqual(s3.get_object(Bucket="b", Key="k", Range="bytes=2-4")['Body'].read(), b"234")
+        with self.assertRaises(standins.ClientError) as cm:
+            s3.get_object(Bucket="b", Key="missing")
+        self.assertEqual(cm.exception.response['Error']['Code'], 'NoSuchKey')
+
+
+class TestDriver(unittest.TestCase):
+
+    def tearDown(self):
+        clients.reset_clients()
+
+    def test_corpus(self):
+        messages = corpus.generate(20, "mixed", seed=1)
+        self.assertEqual(len(messages), 20)
+        self.assertEqual(len({n['mail']['messageId'] for n, raw in messages}), 20)
+        self.assertTrue(all(raw.startswith(b"From: ") for n, raw in messages))
+
+    def test_run(self):
+        result = driver.run("small", count=10, concurrency=2)
+        self.assertEqual(result["errors"], 0)
+        self.assertEqual(result["sent"], 10)
+        self.assertIn("p99_ms", result)
+        self.assertIn("Send_mean_ms", result)
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        timings, lines = bench_startup.run_child("handle_dead_letter", importtime=True)
+        self.assertEqual(set(timings), set(bench_startup.PHASES))
+        phases = bench_startup.import_breakdown(lines)
+        imported = [line.rsplit("|", 1)[-1].strip() for line in
+                    lines[:lines.index(bench_startup.MARKER + "clients")] if line.startswith("import time:")]
+        self.assertIn("handle_email.app", imported)
+        self.assertNotIn("boto3", imported)
+        self.assertFalse([m for m in imported if m.startswith("email.mime")])
+        self.assertIn("boto3", phases["clients"][1])
+
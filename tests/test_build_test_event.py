@@ -0,0 +1,71 @@
+import os
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from handle_email import app, clients
+from benchmarks import corpus, standins
+import build_test_event
+
+
+class TestBuildTestEvent(unittest.TestCase):
+    
+    def setUp(self):
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('s3', self.s3)
+        self.tmp = tempfile.mkdtemp()
+        app.S3_BUCKET = "bucket"
+        self.messages = corpus.generate(30, "small", seed=2)
+        for notification, raw in self.messages:
+            app.save_message_index(notification)
+            self.s3.put_object(Bucket="bucket", Key="messages/" + notification['mail']['messageId'], Body=raw)
+    
+    def tearDown(self):
+        clients.reset_clients()
+        shutil.rmtree(self.tmp)
+    
+    def run_main(self, *args, output="out"):
+        output = os.path.join(self.tmp, output)
+        build_test_event.main(["--bucket", "bucket", "--cache-dir", os.path.join(self.tmp, "cache"),
+                               "--since", "2021/09/13", "--until", "2021/09/13", "--output", output] + list(args))
+        return sorted(os.listdir(output))
+    
+    def test_latest_events_with_raw(self):
+        files = self.run_main("--raw")
+        self.assertEqual(files, ["small000027.eml", "small000027.json", "small000028.eml", "small000028.json",
+                                 "small000029.eml", "small000029.json"])
+        with open(os.path.join(self.tmp, "out", "small000029.json")) as f:
+            event = json.load(f)
+        self.assertEqual(event["Records"][0]["ses"]["mail"]["messageId"], "small000029")
+        # A second run uses the cache
+        gets = self.s3.calls['GetObject']
+        self.run_main("--raw")
+        self.assertEqual(self.s3.calls['GetObject'], gets)
+    
+    def test_filters(self):
+        sender = self.messages[0][0]['mail']['source']
+        expected = {n['mail']['messageId'] for n, raw in self.messages if n['mail']['source'] == sender}
+        files = self.run_main("--limit", "0", "--sender", sender)
+        self.assertEqual({f[:-5] for f in files}, expected)
+        self.assertEqual(self.run_main("--limit", "0", "--verdict", "spam=FAIL", output="fail"), [])
+        sizes = sorted(len(raw) for n, raw in self.messages)
+        files = self.run_main("--limit", "0", "--max-size", str(sizes[9]), output="size")
+        self.assertEqual(len(files), 10)
+    
+    def test_select_sample(self):
+        records = [n for n, raw in self.messages]
+        selected = build_test_event.select(records, sample=0.5, rng=random.Random(1))
+        self.assertLess(len(selected), 30)
+        self.assertEqual([n['mail']['timestamp'] for n in selected],
+                         sorted((n['mail']['timestamp'] for n in selected), reverse=True))
+    
+    def test_parse_verdicts(self):
+        self.assertEqual(build_test_event.parse_verdicts(["spam=pass", "dkimVerdict=FAIL", "spam=GRAY"]),
+                         {"spamVerdict": {"PASS", "GRAY"}, "dkimVerdict": {"FAIL"}})
+        with self.assertRaises(ValueError):
+            build_test_event.parse_verdicts(["spam"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+from unittest import mock
+from handle_email import clients
+
+
+class TestClients(unittest.TestCase):
+
+    def setUp(self):
+        clients.reset_clients()
+
+    def tearDown(self):
+        clients.reset_clients()
+
+    def test_get_client_created_once(self):
+        with mock.patch('boto3.client') as boto_client:
+            boto_client.side_effect = lambda service, config: object()
+            first = clients.get_client('s3')
+            self.assertIs(clients.get_client('s3'), first)
+            self.assertIsNot(clients.get_client('sns'), first)
+        self.assertEqual(boto_client.call_count, 2)
+        config = boto_client.call_args[1]['config']
+        self.assertEqual(config.max_pool_connections, clients.CLIENT_MAX_POOL)
+        self.assertEqual(config.retries['mode'], clients.CLIENT_RETRY_MODE)
+
+    def test_set_client(self):
+        stub = object()
+        self.assertIsNone(clients.set_client('sesv2', stub))
+        self.assertIs(clients.get_client('sesv2'), stub)
+        self.assertIs(clients.set_client('sesv2', None), stub)
+
+    def test_sesv2_not_retried(self):
+        self.assertEqual(clients.client_config('sesv2').retries['total_max_attempts'], 1)
+        self.assertNotIn('total_max_attempts', clients.client_config('s3').retries)
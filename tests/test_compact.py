@@ -0,0 +1,86 @@
+import json
+import unittest
+from datetime import datetime
+from handle_email import app, clients, compact, index
+from benchmarks import standins
+
+DAY = datetime(2024, 1, 2)
+
+
+def notification(message_id):
+    return {"mail": {"messageId": message_id, "timestamp": "2024-01-02T10:00:00.000Z", "source": "a@example.com"}}
+
+
+class TestCompact(unittest.TestCase):
+    
+    def setUp(self):
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('s3', self.s3)
+        self.objects = self.s3.buckets.setdefault("bucket", {})
+    
+    def tearDown(self):
+        clients.reset_clients()
+    
+    def put_index(self, *message_ids):
+        for message_id in message_ids:
+            self.s3.put_object(Bucket="bucket", Key="index/2024/01/02/%s.json" % (message_id,),
+                               Body=json.dumps(notification(message_id)))
+    
+    def compacted(self):
+        key = "index/2024/01/02/compacted_20240102.ndjson.gz"
+        return [n["mail"]["messageId"] for n in index.decode_object(key, self.objects[key]['Body'])]
+    
+    def test_compact_paginated(self):
+        self.put_index(*["m%04d" % i for i in range(1200)])
+        writer = index.IndexWriter("bucket", "index/")
+        writer.add(notification("m0001"))  # Duplicate from a retry
+        writer.add(notification("extra"))
+        writer.flush()
+        manifest = compact.compact_day(DAY, "bucket", workers=4)
+        self.assertEqual(manifest["records"], 1201)
+        self.assertEqual(manifest["duplicates"], 1)
+        self.assertEqual(len(manifest["sources"]), 1201)
+        self.assertEqual(len(self.compacted()), 1201)
+        self.assertGreater(self.s3.calls['ListObjectsV2'], 1)
+        self.assertIn("manifests/index/2024/01/02.json", self.objects)
+    
+    def test_idempotent_and_merges_new_objects(self):
+        self.put_index("m1", "m2")
+        compact.compact_day(DAY, "bucket")
+        gets = self.s3.calls['GetObject']
+        compact.compact_day(DAY, "bucket")
+        self.assertEqual(self.s3.calls['GetObject'], gets + 1)  # Manifest only
+        self.put_index("m3")
+        manifest = compact.compact_day(DAY, "bucket")
+        self.assertEqual(sorted(self.compacted()), ["m1", "m2", "m3"])
+        self.assertEqual(len(manifest["sources"]), 3)
+    
+    def test_delete_and_resume(self):
+        self.put_index("m1", "m2")
+        compact.compact_day(DAY, "bucket")
+        self.assertEqual(len(self.objects), 4)
+        # Resume with deletion, then new objects merge with the compacted object
+        manifest = compact.compact_day(DAY, "bucket", delete=True)
+        self.assertTrue(manifest["deleted"])
+        self.assertEqual(sorted(k for k in self.objects if k.startswith("index/")),
+                         ["index/2024/01/02/compacted_20240102.ndjson.gz"])
+        self.put_index("m3")
+        compact.compact_day(DAY, "bucket", delete=True)
+        self.assertEqual(sorted(self.compacted()), ["m1", "m2", "m3"])
+        self.assertEqual(len(self.objects), 2)
+    
+    def test_empty_partition(self):
+        self.assertIsNone(compact.compact_day(DAY, "bucket"))
+        self.assertEqual(self.objects, {})
+    
+    def test_recent_days(self):
+        days = compact.recent_days(3, 2, today=datetime(2024, 1, 10, 5))
+        self.assertEqual(days, [datetime(2024, 1, 7), datetime(2024, 1, 8)])
+    
+    def test_key_layout_matches_writers(self):
+        self.assertEqual(index.partition(DAY, app.S3_PREFIX_IDX), "index/2024/01/02/")
+        self.assertTrue(compact.output_key(DAY).startswith(index.partition(DAY, compact.S3_PREFIX_IDX)))
+
+
+if __name__ == '__main__':
+    unittest.main()
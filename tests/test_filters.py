@@ -0,0 +1,59 @@
+import json
+import os
+import unittest
+from unittest import mock
+from handle_email import filters
+
+EVENTS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'events')
+
+
+def load_notification():
+    with open(os.path.join(EVENTS_DIR, 'ses_event.json')) as f:
+        notification = json.load(f)['Records'][0]['ses']
+    notification['receipt']['recipients'] = ["a@example.com", "b@example.com"]
+    return notification
+
+
+class TestFilterPipeline(unittest.TestCase):
+
+    def assertRejected(self, pipeline, notification, rule):
+        with self.assertRaises(filters.Rejected) as cm:
+            pipeline.evaluate(notification)
+        self.assertEqual(cm.exception.rule, rule)
+
+    def test_default_verdicts(self):
+        pipeline = filters.FilterPipeline()
+        notification = load_notification()
+        notification['receipt']['dkimVerdict']['status'] = 'PASS'
+        self.assertEqual(pipeline.evaluate(notification), ["a@example.com", "b@example.com"])
+        notification['receipt']['spamVerdict']['status'] = 'FAIL'
+        self.assertRejected(pipeline, notification, "spamVerdict")
+        notification['receipt']['spamVerdict']['status'] = 'PASS'
+        notification['receipt']['dmarcPolicy'] = {"status": "reject"}
+        self.assertRejected(pipeline, notification, "dmarcPolicy")
+
+    def test_senders_and_recipients(self):
+        notification = load_notification()
+        pipeline = filters.FilterPipeline({"verdicts": {}, "deny_senders": ["EXAMPLE.com"]})
+        self.assertRejected(pipeline, notification, "deny_senders")
+        pipeline = filters.FilterPipeline({"verdicts": {}, "allow_senders": ["friend@example.org"]})
+        self.assertRejected(pipeline, notification, "allow_senders")
+        pipeline = filters.FilterPipeline({"verdicts": {}, "allow_senders": ["sender@example.com"],
+                                           "deny_recipients": ["b@example.com"]})
+        self.assertEqual(pipeline.evaluate(notification), ["a@example.com"])
+        pipeline = filters.FilterPipeline({"verdicts": {}, "allow_recipients": ["c@example.com"]})
+        self.assertRejected(pipeline, notification, "recipients")
+
+    def test_max_size_and_sampling(self):
+        pipeline = filters.FilterPipeline({"max_size": 100, "reject_index_sample": 0.5})
+        pipeline.check_size(100)
+        with self.assertRaises(filters.Rejected) as cm:
+            pipeline.check_size(101)
+        self.assertEqual(cm.exception.rule, "max_size")
+        with mock.patch.object(filters.random, 'random', return_value=0.4):
+            self.assertTrue(pipeline.sample_rejected())
+        self.assertFalse(filters.FilterPipeline().sample_rejected())
+
+    def test_unknown_config(self):
+        with self.assertRaises(ValueError):
+            filters.FilterPipeline({"deny_sender": []})
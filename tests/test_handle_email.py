@@ -1,5 +1,77 @@
+import io
+import gzip
+import json
+import os
+import email
+import email.policy
+import threading
 import unittest
-from handle_email import app
+from unittest import mock
+from handle_email import app, clients, filters, index, ledger, metrics, rewrite, routing, sender
+from benchmarks import corpus, standins
+
+EVENTS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'events')
+RAW_MESSAGE = (
+    b"From: Sender <sender@example.com>\r\n"
+    b"To: recipient@example.com\r\n"
+    b"Subject: Test\r\n"
+    b"\r\n"
+    b"Hello\r\n"
+)
+
+# (address, transformed into source.com, user only)
+TRANSFORM_CASES = [
+    ("Name One <name1@example.com>", "Name One <name1_example.com@source.com>", "name1_example.com"),
+    ("Name Two <name2.extra@example.com>", "Name Two <name2.extra_example.com@source.com>", "name2.extra_example.com"),
+    ("<name3a@example.com>", "name3a_example.com@source.com", "name3a_example.com"),
+    ("name3@example.com", "name3_example.com@source.com", "name3_example.com"),
+]
+
+
+class FakeS3:
+    
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+    
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self.lock:
+            self.objects[Key] = Body
+        return {}
+    
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(RAW_MESSAGE), 'ContentLength': len(RAW_MESSAGE)}
+
+
+class FakeSES:
+    
+    def __init__(self, fail_for=(), error=None):
+        self.sent = []
+        self.destinations = []
+        self.fail_for = fail_for
+        self.error = error
+    
+    def send_email(self, Content, **kwargs):
+        self.destinations.append(kwargs.get('Destination'))
+        data = Content['Raw']['Data']
+        if isinstance(data, str):
+            data = data.encode()
+        for marker in self.fail_for:
+            if marker in data:
+                raise self.error or RuntimeError("send failed")
+        self.sent.append(data)
+        return {'MessageId': "out-%d" % len(self.sent)}
+    
+    def get_account(self):
+        return {'SendQuota': {'MaxSendRate': 1000.0}}
+
+
+def load_notification(message_id):
+    with open(os.path.join(EVENTS_DIR, 'ses_event.json')) as f:
+        notification = json.load(f)['Records'][0]['ses']
+    notification['mail']['messageId'] = message_id
+    notification['receipt']['dkimVerdict']['status'] = 'PASS'
+    return notification
 
 
 class TestHandleEmailApp(unittest.TestCase):
@@ -8,12 +80,425 @@ class TestHandleEmailApp(unittest.TestCase):
         app.EMAIL_DOM = "source.com"
     
     def test_transform_address(self):
-        test_cases = [
-            ("Name One <name1@example.com>", "Name One <name1_example.com@source.com>", "name1_example.com"),
-            ("Name Two <name2.extra@example.com>", "Name Two <name2.extra_example.com@source.com>", "name2.extra_example.com"),
-            ("<name3a@example.com>", "name3a_example.com@source.com", "name3a_example.com"),
-            ("name3@example.com", "name3_example.com@source.com", "name3_example.com"),
-        ]
-        for case in test_cases:
+        for case in TRANSFORM_CASES:
             self.assertEqual(app.transform_address(case[0]), case[1])
             self.assertEqual(app.transform_address(case[0], user_only=True), case[2])
+
+
+class TestHandleSesNotice(unittest.TestCase):
+    
+    def setUp(self):
+        app.EMAIL_DOM = "source.com"
+        app.DEST_DOM = "dest.com"
+        app.S3_BUCKET = "bucket"
+        self.s3 = FakeS3()
+        self.ses = FakeSES()
+        clients.set_client('s3', self.s3)
+        clients.set_client('sesv2', self.ses)
+        sender.reset_scheduler()
+        filters.set_pipeline(None)
+        self.ledger = ledger.Ledger(ledger.MemoryBackend())
+        ledger.set_ledger(self.ledger)
+        self.concurrency = app.RECORD_CONCURRENCY
+        self.index_format = index.INDEX_FORMAT
+    
+    def tearDown(self):
+        app.RECORD_CONCURRENCY = self.concurrency
+        index.INDEX_FORMAT = self.index_format
+        clients.reset_clients()
+        sender.reset_scheduler()
+        filters.set_pipeline(None)
+        ledger.set_ledger(None)
+    
+    def event(self, *message_ids):
+        return {"Records": [
+            {"eventSource": "aws:ses", "ses": load_notification(mid)} for mid in message_ids
+        ]}
+    
+    def test_sequential(self):
+        app.RECORD_CONCURRENCY = 1
+        app.handle_ses_notice(self.event("m1", "m2"), None)
+        self.assertEqual(len(self.ses.sent), 2)
+        self.assertEqual(len(self.s3.objects), 2)
+        self.assertIn(b"To: recipient@dest.com", self.ses.sent[0])
+        self.assertIn(b"From: Sender <sender_example.com@source.com>", self.ses.sent[0])
+        self.assertIn(b"Reply-To: Sender <sender@example.com>", self.ses.sent[0])
+    
+    def test_concurrent(self):
+        app.RECORD_CONCURRENCY = 4
+        app.handle_ses_notice(self.event(*["m%d" % i for i in range(10)]), None)
+        self.assertEqual(len(self.ses.sent), 10)
+        self.assertEqual(len(self.s3.objects), 10)
+    
+    def test_concurrent_errors_reraised(self):
+        app.RECORD_CONCURRENCY = 4
+        self.ses.fail_for = [b"recipient"]
+        with self.assertRaises(app.RecordProcessingError) as cm:
+            app.handle_ses_notice(self.event("m1", "m2", "m3"), None)
+        self.assertEqual(len(cm.exception.errors), 3)
+        # Index is still saved for every record
+        self.assertEqual(len(self.s3.objects), 3)
+    
+    def test_concurrent_single_error_reraised(self):
+        app.RECORD_CONCURRENCY = 4
+        self.ses.fail_for = [b"recipient"]
+        with self.assertRaises(RuntimeError):
+            app.handle_ses_notice(self.event("m1"), None)
+    
+    def test_message_too_large(self):
+        app.RECORD_CONCURRENCY = 1
+        self.s3.get_object = lambda Bucket, Key: {'Body': io.BytesIO(b""), 'ContentLength': 50 * 2**20}
+        with self.assertRaises(app.spool.MessageTooLarge):
+            app.handle_ses_notice(self.event("m1"), None)
+        self.assertEqual(self.ses.sent, [])
+    
+    def test_metrics_emitted(self):
+        app.RECORD_CONCURRENCY = 2
+        captured = []
+        metrics.add_hook(captured.append)
+        try:
+            app.handle_ses_notice(self.event("m1", "m2"), None)
+        finally:
+            metrics.remove_hook(captured.append)
+        self.assertEqual(sorted(r["MessageId"] for r in captured), ["m1", "m2"])
+        for record in captured:
+            self.assertEqual(record["Outcome"], "Forwarded")
+            self.assertEqual(record["MessageBytes"], len(RAW_MESSAGE))
+            self.assertEqual(record["RecipientCount"], 1)
+            for stage in ["IndexPut", "S3Get", "Rewrite", "Transform", "Send"]:
+                self.assertIn(stage + "Time", record)
+    
+    def test_rejected_before_io(self):
+        event = self.event("m1", "m2")
+        event['Records'][0]['ses']['receipt']['virusVerdict']['status'] = 'FAIL'
+        filters.set_pipeline(filters.FilterPipeline({"max_size": 10}))
+        captured = []
+        metrics.add_hook(captured.append)
+        try:
+            app.handle_ses_notice(event, None)
+        finally:
+            metrics.remove_hook(captured.append)
+        # m1 rejected without I/O, m2 rejected by size after the GET, before reading
+        self.assertEqual(len(self.s3.objects), 1)
+        self.assertTrue(list(self.s3.objects)[0].endswith("_m2.json"))
+        self.assertEqual(self.ses.sent, [])
+        rules = {r["MessageId"]: (r["FilterRule"], r["SavedRequests"]) for r in captured}
+        self.assertEqual(rules, {"m1": ("virusVerdict", 3), "m2": ("max_size", 1)})
+        for record in captured:
+            self.assertEqual(record["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Outcome"], ["Outcome", "FilterRule"]])
+    
+    def test_recipients_batched(self):
+        event = self.event("m1")
+        event['Records'][0]['ses']['receipt']['recipients'] = ["user%d@example.com" % i for i in range(60)]
+        app.handle_ses_notice(event, None)
+        self.assertEqual(len(self.ses.sent), 2)
+        self.assertEqual([len(d['ToAddresses']) for d in self.ses.destinations], [50, 10])
+        self.assertEqual(self.ses.destinations[1]['ToAddresses'][0], "user50@dest.com")
+    
+    def test_retry_sends_remaining_batches(self):
+        event = self.event("m1")
+        recipients = ["user%d@example.com" % i for i in range(60)]
+        event['Records'][0]['ses']['receipt']['recipients'] = recipients
+        send_email = self.ses.send_email
+        def fail_second(**kwargs):
+            if len(self.ses.destinations) == 1:
+                self.ses.destinations.append(kwargs.get('Destination'))
+                raise RuntimeError("send failed")
+            return send_email(**kwargs)
+        with mock.patch.object(self.ses, 'send_email', side_effect=fail_second):
+            with self.assertRaises(RuntimeError):
+                app.handle_ses_notice(event, None)
+        self.assertEqual(len(self.ses.sent), 1)
+        self.assertIsNone(self.ledger.lookup("m1", recipients))
+        app.handle_ses_notice(event, None)
+        self.assertEqual(len(self.ses.sent), 2)
+        self.assertEqual(self.ses.destinations[2]['ToAddresses'][0], "user50@dest.com")
+        self.assertEqual(self.ledger.lookup("m1", recipients)['outgoing'], ["out-1", "out-2"])
+    
+    def test_buffered_index(self):
+        index.INDEX_FORMAT = "ndjson"
+        for concurrency in [1, 4]:
+            app.RECORD_CONCURRENCY = concurrency
+            self.s3.objects.clear()
+            self.ses.sent.clear()
+            ledger.set_ledger(ledger.Ledger(ledger.MemoryBackend()))
+            app.handle_ses_notice(self.event("m1", "m2", "m3"), None)
+            self.assertEqual(len(self.ses.sent), 3)
+            (key, body), = self.s3.objects.items()
+            self.assertTrue(key.endswith(".ndjson.gz"))
+            self.assertEqual(len(gzip.decompress(body).splitlines()), 3)
+    
+    def test_buffered_index_saved_on_failure(self):
+        index.INDEX_FORMAT = "ndjson"
+        self.ses.fail_for = [b"recipient"]
+        with self.assertRaises(RuntimeError):
+            app.handle_ses_notice(self.event("m1"), None)
+        (key, body), = self.s3.objects.items()
+        self.assertEqual(json.loads(gzip.decompress(body))['mail']['messageId'], "m1")
+    
+    def test_index_error_does_not_mask_failure(self):
+        index.INDEX_FORMAT = "ndjson"
+        app.RECORD_CONCURRENCY = 1
+        self.ses.fail_for = [b"recipient"]
+        with mock.patch.object(index.IndexWriter, 'flush', side_effect=OSError("index put failed")):
+            with self.assertRaisesRegex(RuntimeError, "send failed"):
+                app.handle_ses_notice(self.event("m1"), None)
+            self.ses.fail_for = []
+            with self.assertRaisesRegex(OSError, "index put failed"):
+                app.handle_ses_notice(self.event("m2"), None)
+    
+    def test_retry_not_forwarded_again(self):
+        event = self.event("m1")
+        app.handle_ses_notice(event, None)
+        self.s3.objects.clear()
+        records = []
+        metrics.add_hook(records.append)
+        try:
+            outgoing = app.process_ses_notification(event['Records'][0]['ses'])
+        finally:
+            metrics.remove_hook(records.append)
+        self.assertEqual(outgoing, "out-1")
+        self.assertEqual(len(self.ses.sent), 1)
+        self.assertEqual(self.s3.objects, {})
+        self.assertEqual(records[0]["SavedRequests"], 3)
+        self.assertEqual(records[0]["Outcome"], "Duplicate")
+    
+    def test_failed_send_not_recorded(self):
+        self.ses.fail_for = [b"recipient"]
+        with self.assertRaises(RuntimeError):
+            app.handle_ses_notice(self.event("m1"), None)
+        self.assertIsNone(self.ledger.lookup("m1", ["recipient@example.com"]))
+    
+    def test_send_error_saved(self):
+        self.ses.fail_for = [b"recipient"]
+        self.ses.error = standins.client_error('MessageRejected', 'Email address is not verified.', 'SendEmail')
+        event = self.event("m1")
+        with self.assertRaises(app.ClientError):
+            app.handle_ses_notice(event, None)
+        message_key, details_key = app.error_keys("m1", event['Records'][0]['ses']['mail']['timestamp'])
+        self.assertTrue(message_key.startswith(app.S3_PREFIX_ERR) and message_key.endswith("/m1.eml"))
+        self.assertIn(b"To: recipient@dest.com", self.s3.objects[message_key])
+        details = json.loads(self.s3.objects[details_key])
+        self.assertEqual(details['errorCode'], 'MessageRejected')
+        self.assertEqual(details['attempts'], 1)
+        self.assertEqual(details['size'], len(self.s3.objects[message_key]))
+        self.assertEqual(details['message'], message_key)
+
+    
+    def test_forward_modes(self):
+        routes = {"routes": {"*": {"forward": "attachment"}}}
+        with mock.patch.object(routing, 'ROUTES_CONFIG', json.dumps(routes)):
+            routing.reset_router()
+            try:
+                app.handle_ses_notice(self.event("m1"), None)
+            finally:
+                routing.reset_router()
+        sent = email.message_from_bytes(self.ses.sent[0], policy=email.policy.default)
+        self.assertEqual(sent['From'], "Sender <sender_example.com@source.com>")
+        self.assertEqual(sent['Reply-To'], "Sender <sender@example.com>")
+        self.assertEqual(sent['To'], "recipient@dest.com")
+        self.assertEqual(sent['Subject'], "[FWD] Test")
+        self.assertEqual(sent.get_payload()[1].get_payload(decode=True), RAW_MESSAGE)
+        self.assertIsNotNone(self.ledger.lookup("m1", ["recipient@example.com"]))
+    
+    def test_forward_groups_downloaded_once(self):
+        routes = {"routes": {"reports@example.com": {"to": "reports@dest.com", "forward": "attachment"}}}
+        event = self.event("m1")
+        event['Records'][0]['ses']['receipt']['recipients'] = ["recipient@example.com", "reports@example.com"]
+        self.ses.fail_for = [b"original.eml"]
+        self.ses.error = standins.client_error('MessageRejected', 'Email address is not verified.', 'SendEmail')
+        with mock.patch.object(routing, 'ROUTES_CONFIG', json.dumps(routes)), \
+                mock.patch.object(self.s3, 'get_object', wraps=self.s3.get_object) as get_object:
+            routing.reset_router()
+            try:
+                with self.assertRaises(app.ClientError):
+                    app.handle_ses_notice(event, None)
+            finally:
+                routing.reset_router()
+        self.assertEqual(get_object.call_count, 1)
+        self.assertEqual(len(self.ses.sent), 1)
+        self.assertIn(b"To: recipient@dest.com", self.ses.sent[0])
+        message_key, details_key = app.error_keys("m1", event['Records'][0]['ses']['mail']['timestamp'], "attachment")
+        self.assertTrue(message_key.endswith("/m1.attachment.eml"))
+        self.assertIn(b"To: reports@dest.com", self.s3.objects[message_key])
+        details = json.loads(self.s3.objects[details_key])
+        self.assertEqual((details['mode'], details['message']), ("attachment", message_key))
+    
+    def test_wrap_long_subject_folded(self):
+        subject = "Les nouvelles de l'équipe, semaine %02d. " * 20
+        raw = RAW_MESSAGE.replace(b"Subject: Test", email.policy.SMTP.fold("Subject", subject % tuple(range(20))).encode().rstrip())
+        data = app.wrap_message("m1", io.BytesIO(raw), len(raw), ["recipient@dest.com"], "rfc822")
+        header_block = rewrite.split_message(data)[0]
+        self.assertTrue(all(len(line) <= 998 for line in header_block.splitlines()))
+        sent = email.message_from_bytes(data, policy=email.policy.default)
+        self.assertEqual(sent['Subject'], "[FWD] " + (subject % tuple(range(20))).strip())
+    
+    def test_wrap_long_to_folded(self):
+        recipients = ["recipient%02d_with_a_long_name@destination.example.com" % (i,) for i in range(50)]
+        for mode in ("rfc822", "attachment"):
+            data = app.wrap_message("m1", io.BytesIO(RAW_MESSAGE), len(RAW_MESSAGE), recipients, mode)
+            header_block = rewrite.split_message(data)[0]
+            self.assertTrue(all(len(line) <= 998 for line in header_block.splitlines()))
+            sent = email.message_from_bytes(data, policy=email.policy.default)
+            self.assertEqual([a.addr_spec for a in sent['To'].addresses], recipients)
+    
+    def test_sns_event(self):
+        with open(os.path.join(EVENTS_DIR, 'sns_ses_event.json')) as f:
+            record = json.load(f)['Records'][0]
+        notification, = app.record_notifications(record)
+        self.assertEqual(notification['mail']['messageId'], "12345678901example")
+        self.assertNotIn('notificationType', notification)
+        
+        app.handle_ses_notice(corpus.sns_event([load_notification("m1")]), None)
+        self.assertEqual(len(self.ses.sent), 1)
+    
+    def test_batch(self):
+        index.INDEX_FORMAT = "ndjson"
+        ses_event = self.event("m3")
+        event = corpus.sqs_event([load_notification("m1")])
+        event['Records'] += [
+            {"eventSource": "aws:sqs", "messageId": "q2", "body": json.dumps(
+                {"Type": "Notification", "Message": json.dumps(load_notification("m2"))})},
+            {"eventSource": "aws:sqs", "messageId": "q3", "body": json.dumps(ses_event)},
+            {"eventSource": "aws:sqs", "messageId": "q4", "body": "not json"},
+            {"eventSource": "aws:sqs", "messageId": "q5", "body": json.dumps({"notificationType": "AmazonSnsSubscriptionSucceeded"})},
+            {"eventSource": "aws:sqs", "messageId": "q6", "body": json.dumps({"notificationType": "Received"})},
+            {"eventSource": "aws:sqs", "messageId": "q7", "body": json.dumps(
+                {"Type": "SubscriptionConfirmation", "TopicArn": "arn:aws:sns:us-east-1:123456789012:ingest"})},
+        ]
+        self.assertEqual(app.handle_ses_batch(event, None),
+                         {"batchItemFailures": [{"itemIdentifier": "q4"}, {"itemIdentifier": "q6"}]})
+        self.assertEqual(len(self.ses.sent), 3)
+        (key, body), = self.s3.objects.items()
+        self.assertEqual(len(gzip.decompress(body).splitlines()), 3)
+    
+    def test_batch_failures(self):
+        self.ses.fail_for = [b"recipient"]
+        event = corpus.sqs_event([load_notification("m1"), load_notification("m2")])
+        response = app.handle_ses_batch(event, None)
+        self.assertEqual(sorted(f['itemIdentifier'] for f in response['batchItemFailures']), ["sqs-m1", "sqs-m2"])
+        # Records of direct SES events have no item identifier to report
+        with self.assertRaises(RuntimeError):
+            app.handle_ses_batch(self.event("m1"), None)
+
+class FailingSNS(standins.InMemorySNS):
+    
+    def __init__(self, failures=0):
+        super().__init__()
+        self.failures = failures
+    
+    def publish(self, **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise standins.client_error('InternalError', 'Publish failed', 'Publish', 500)
+        return super().publish(**kwargs)
+
+
+class TestHandleDeadLetter(unittest.TestCase):
+    
+    def setUp(self):
+        app.EMAIL_DOM = "source.com"
+        app.S3_BUCKET = "bucket"
+        self.sns = FailingSNS()
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('sns', self.sns)
+        clients.set_client('s3', self.s3)
+        self.digest = app.DLQ_DIGEST
+    
+    def tearDown(self):
+        app.DLQ_DIGEST = self.digest
+        clients.reset_clients()
+    
+    def sqs_record(self, sqs_id, message_id, source="sender@example.com", error="Task timed out"):
+        notification = load_notification(message_id)
+        notification['mail']['source'] = source
+        return {
+            "eventSource": "aws:sqs",
+            "messageId": sqs_id,
+            "body": json.dumps({"Records": [{"eventSource": "aws:ses", "ses": notification}]}),
+            "messageAttributes": {
+                "RequestID": {"stringValue": "req-" + sqs_id, "dataType": "String"},
+                "ErrorCode": {"stringValue": "200", "dataType": "Number"},
+                "ErrorMessage": {"stringValue": error, "dataType": "String"},
+            },
+        }
+    
+    def test_notice_per_record(self):
+        app.DLQ_DIGEST = False
+        event = {"Records": [self.sqs_record("q1", "m1"), self.sqs_record("q2", "m2")]}
+        self.assertEqual(app.handle_dead_letter(event, None), {"batchItemFailures": []})
+        self.assertEqual([p['Subject'] for p in self.sns.published],
+                         ["Failed Message Delivery: m1", "Failed Message Delivery: m2"])
+        self.assertIn("(200) Task timed out", self.sns.published[0]['Message'])
+    
+    def test_notice_includes_send_error(self):
+        app.DLQ_DIGEST = False
+        record = self.sqs_record("q1", "m1")
+        timestamp = json.loads(record['body'])['Records'][0]['ses']['mail']['timestamp']
+        app.save_message_error("m1", b"outgoing", timestamp, {"errorCode": "MessageRejected", "attempts": 2})
+        self.s3.calls.clear()
+        app.handle_dead_letter({"Records": [record]}, None)
+        message = self.sns.published[0]['Message']
+        self.assertIn("after 2 attempt(s)", message)
+        self.assertIn("s3://bucket/" + app.error_keys("m1", timestamp)[0], message)
+        self.assertEqual(self.s3.calls, {'GetObject': 1})
+    
+    def test_ingest_queue_message(self):
+        app.DLQ_DIGEST = False
+        # Messages of the batch ingest queue are SES notifications, without attributes
+        record = {"eventSource": "aws:sqs", "messageId": "q1", "body": json.dumps(load_notification("m1"))}
+        self.assertEqual(app.handle_dead_letter({"Records": [record]}, None), {"batchItemFailures": []})
+        self.assertEqual(self.sns.published[0]['Subject'], "Failed Message Delivery: m1")
+    
+    def test_partial_batch_failure(self):
+        app.DLQ_DIGEST = False
+        self.sns.failures = 1
+        event = {"Records": [self.sqs_record("q1", "m1"), self.sqs_record("q2", "m2")]}
+        self.assertEqual(app.handle_dead_letter(event, None), {"batchItemFailures": [{"itemIdentifier": "q1"}]})
+        self.assertEqual(len(self.sns.published), 1)
+    
+    def test_unreadable_record_not_redelivered(self):
+        app.DLQ_DIGEST = False
+        record = dict(self.sqs_record("q1", "m1"), body="not json")
+        self.assertEqual(app.handle_dead_letter({"Records": [record]}, None), {"batchItemFailures": []})
+        self.assertIn("unable to read", self.sns.published[0]['Message'])
+    
+    def test_digest(self):
+        app.DLQ_DIGEST = True
+        event = {"Records": [
+            self.sqs_record("q1", "m1", "a@example.com"),
+            self.sqs_record("q2", "m2", "b@example.com"),
+            self.sqs_record("q3", "m3", "c@example.org", error="Throttling"),
+            dict(self.sqs_record("q4", "m4"), body="{}"),
+        ]}
+        for record in event['Records'][:2]:
+            timestamp = json.loads(record['body'])['Records'][0]['ses']['mail']['timestamp']
+            mid = json.loads(record['body'])['Records'][0]['ses']['mail']['messageId']
+            app.save_message_error(mid, b"outgoing", timestamp,
+                                   {"errorCode": "MessageRejected", "errorMessage": "Email address is not verified."})
+        self.assertEqual(app.handle_dead_letter(event, None), {"batchItemFailures": []})
+        self.assertEqual(len(self.sns.published), 1)
+        notice = self.sns.published[0]
+        self.assertEqual(notice['Subject'], "Failed Message Delivery: 4 messages")
+        # Grouped by the send error saved for m1 and m2, and by the invocation status for m3
+        self.assertIn("  Error Code MessageRejected: 2\n    example.com: 2\n", notice['Message'])
+        self.assertIn("  Error Code 200: 1\n    example.org: 1\n", notice['Message'])
+        self.assertIn("Email address is not verified.", notice['Message'])
+        self.assertIn("  Error Code Unreadable: 1\n", notice['Message'])
+        for mid in ["m1", "m2", "m3"]:
+            self.assertIn(mid, notice['Message'])
+    
+    def test_digest_truncated(self):
+        failures = [{"messageId": "m%d" % i, "timestamp": None, "source": "a@example.com", "destination": [],
+                     "errorCode": "200", "errorMessage": "x" * 200} for i in range(5000)]
+        subject, body = app.failure_digest(failures)
+        self.assertLessEqual(len(subject), 100)
+        self.assertLessEqual(len(body), app.DIGEST_MAX_BYTES)
+        self.assertIn("(list truncated)", body)
+    
+    def test_digest_failure_redelivers_batch(self):
+        app.DLQ_DIGEST = True
+        self.sns.failures = 1
+        event = {"Records": [self.sqs_record("q1", "m1"), self.sqs_record("q2", "m2")]}
+        self.assertEqual(app.handle_dead_letter(event, None),
+                         {"batchItemFailures": [{"itemIdentifier": "q1"}, {"itemIdentifier": "q2"}]})
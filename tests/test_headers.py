@@ -0,0 +1,110 @@
+import json
+import unittest
+from handle_email import app, clients, filters, headers, index, ledger, metrics, sender
+from benchmarks import standins
+from tests.test_handle_email import load_notification
+
+HEADER_BLOCK = b"".join(b"X-Header-%03d: value %d\r\n" % (i, i) for i in range(100))
+RAW_MESSAGE = (
+    b"From: Sender <sender@example.com>\r\n"
+    b"To: recipient@example.com\r\n"
+    b"List-Id: Example List\r\n <list.example.com>\r\n"
+    b"Auto-Submitted: auto-replied\r\n"
+    + HEADER_BLOCK +
+    b"Subject: Test\r\n"
+    b"\r\n" + b"x" * 100000
+)
+
+
+class TestFetchHeaders(unittest.TestCase):
+    
+    def setUp(self):
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('s3', self.s3)
+        self.s3.put_object(Bucket="bucket", Key="messages/m1", Body=RAW_MESSAGE)
+    
+    def tearDown(self):
+        clients.reset_clients()
+    
+    def test_widens_range_until_header_block_ends(self):
+        fields, size = headers.fetch_headers("bucket", "messages/m1", range_bytes=512)
+        self.assertEqual(self.s3.calls['GetObject'], 4)  # 512, 1024, 2048 and 4096 bytes
+        self.assertEqual(size, 4096)
+        self.assertEqual(fields[2], ("List-Id", "Example List <list.example.com>"))
+        self.assertEqual(fields[-1], ("Subject", "Test"))
+        self.assertEqual(len(fields), 105)
+    
+    def test_limited_to_max_bytes(self):
+        fields, size = headers.fetch_headers("bucket", "messages/m1", range_bytes=512, max_bytes=1000)
+        self.assertEqual(size, 1000)
+        self.assertTrue(fields and all(value.startswith("value") for name, value in fields[4:]))
+    
+    def test_short_and_empty_messages(self):
+        self.s3.put_object(Bucket="bucket", Key="messages/short", Body=b"Subject: Only headers\r\n")
+        self.assertEqual(headers.fetch_headers("bucket", "messages/short"), ([("Subject", "Only headers")], 23))
+        self.s3.put_object(Bucket="bucket", Key="messages/empty", Body=b"")
+        self.assertEqual(headers.fetch_headers("bucket", "messages/empty"), ([], 0))
+    
+    def test_notification_headers_used_unless_truncated(self):
+        notification = load_notification("m1")
+        message_headers = headers.MessageHeaders(notification, "bucket", "messages/m1")
+        self.assertEqual(message_headers.get("subject"), "This is a test")
+        self.assertFalse(message_headers.fetched)
+        self.assertNotIn('GetObject', self.s3.calls)
+        
+        notification['mail']['headersTruncated'] = True
+        stats = metrics.Metrics()
+        message_headers = headers.MessageHeaders(notification, "bucket", "messages/m1", stats)
+        self.assertEqual(message_headers.select(["List-Id", "X-Mailer"]), {"List-Id": "Example List <list.example.com>"})
+        self.assertEqual(message_headers.get_all("AUTO-SUBMITTED"), ["auto-replied"])
+        self.assertEqual(self.s3.calls['GetObject'], 1)
+        self.assertEqual(stats.metrics["HeaderBytes"], (headers.HEADER_RANGE_BYTES, "Bytes"))
+
+
+class TestHeaderRules(unittest.TestCase):
+    
+    def setUp(self):
+        app.S3_BUCKET, app.EMAIL_DOM, app.DEST_DOM = "bucket", "source.com", "dest.com"
+        self.services = standins.install()
+        self.s3 = self.services['s3']
+        self.s3.put_object(Bucket="bucket", Key="messages/m1", Body=RAW_MESSAGE)
+        sender.set_scheduler(sender.SendScheduler(None))
+        ledger.set_ledger(ledger.Ledger(ledger.MemoryBackend()))
+        self.extra_headers = index.INDEX_EXTRA_HEADERS
+        self.notification = load_notification("m1")
+        self.notification['mail']['headersTruncated'] = True
+    
+    def tearDown(self):
+        index.INDEX_EXTRA_HEADERS = self.extra_headers
+        clients.reset_clients()
+        sender.reset_scheduler()
+        filters.set_pipeline(None)
+        ledger.set_ledger(None)
+    
+    def test_rejected_by_header_after_ranged_read(self):
+        filters.set_pipeline(filters.FilterPipeline({"deny_headers": {"Auto-Submitted": ["Auto-Replied"]}}))
+        captured = []
+        metrics.add_hook(captured.append)
+        try:
+            self.assertIsNone(app.process_ses_notification(self.notification))
+        finally:
+            metrics.remove_hook(captured.append)
+        self.assertEqual(captured[0]["FilterRule"], "deny_headers")
+        self.assertEqual(self.s3.calls, {'PutObject': 1, 'GetObject': 1})
+        self.assertEqual(self.services['sesv2'].sent, [])
+    
+    def test_index_enriched(self):
+        filters.set_pipeline(filters.FilterPipeline({"deny_headers": {"Precedence": ["bulk"]}}))
+        index.INDEX_EXTRA_HEADERS = ["List-Id", "X-Mailer"]
+        app.process_ses_notification(self.notification)
+        objects = self.s3.buckets["bucket"]
+        entry, = [json.loads(o['Body']) for key, o in objects.items() if key.startswith(app.S3_PREFIX_IDX)]
+        self.assertEqual(entry['extraHeaders'], {"List-Id": "Example List <list.example.com>"})
+        self.assertNotIn('extraHeaders', self.notification)
+        # One ranged read for the filter and the index, one full read to forward
+        self.assertEqual(self.s3.calls['GetObject'], 2)
+        self.assertEqual(len(self.services['sesv2'].sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import gzip
+import json
+import unittest
+from handle_email import clients, index
+from benchmarks import standins
+
+
+def notification(message_id, timestamp="2019-08-05T21:30:02.028Z"):
+    return {"mail": {"messageId": message_id, "timestamp": timestamp, "source": "a@example.com"}}
+
+
+class TestIndexWriter(unittest.TestCase):
+    
+    def setUp(self):
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('s3', self.s3)
+        self.now = 0.0
+    
+    def tearDown(self):
+        clients.reset_clients()
+    
+    def writer(self, **kwargs):
+        return index.IndexWriter("bucket", "index/", clock=lambda: self.now, **kwargs)
+    
+    def read(self, key):
+        lines = gzip.decompress(self.s3.buckets["bucket"][key]['Body']).decode().splitlines()
+        return [json.loads(line) for line in lines]
+    
+    def test_one_object_per_day(self):
+        writer = self.writer()
+        writer.add(notification("m1"))
+        writer.add(notification("m2", "2019-08-06T00:00:01.000Z"))
+        writer.add(notification("m3"))
+        self.assertEqual(self.s3.calls, {})
+        keys = writer.flush()
+        self.assertEqual(len(keys), 2)
+        self.assertTrue(keys[0].startswith("index/2019/08/05/20190805T213002_"))
+        self.assertTrue(keys[0].endswith(".ndjson.gz"))
+        self.assertTrue(keys[1].startswith("index/2019/08/06/"))
+        self.assertEqual([r["mail"]["messageId"] for r in self.read(keys[0])], ["m1", "m3"])
+        self.assertEqual(writer.flush(), [])
+    
+    def test_flush_limits(self):
+        writer = self.writer(max_records=2)
+        writer.add(notification("m1"))
+        writer.add(notification("m2"))
+        self.assertEqual(len(writer.keys), 1)
+        writer = self.writer(max_age=5)
+        writer.add(notification("m1"))
+        self.now = 6
+        writer.add(notification("m2"))
+        self.assertEqual(len(writer.keys), 1)
+        self.assertEqual(len(self.read(writer.keys[0])), 2)
+    
+    def test_failed_flush_keeps_records(self):
+        writer = self.writer()
+        writer.add(notification("m1"))
+        put_object = self.s3.put_object
+        self.s3.put_object = None  # Calls raise TypeError
+        with self.assertRaises(TypeError):
+            writer.flush()
+        self.s3.put_object = put_object
+        keys = writer.flush()
+        self.assertEqual([r["mail"]["messageId"] for r in self.read(keys[0])], ["m1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
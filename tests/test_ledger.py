@@ -0,0 +1,66 @@
+import unittest
+from handle_email import clients, ledger
+from benchmarks import standins
+
+
+class TestLedger(unittest.TestCase):
+    
+    def test_key_ignores_recipient_order_and_case(self):
+        self.assertEqual(ledger.ledger_key("m1", ["a@example.com", "B@example.com"]),
+                         ledger.ledger_key("m1", ["b@example.com", "a@example.com"]))
+        self.assertNotEqual(ledger.ledger_key("m1", ["a@example.com"]),
+                            ledger.ledger_key("m1", ["a@example.com", "b@example.com"]))
+        self.assertTrue(ledger.ledger_key("m1", ["a@example.com"]).startswith("m1/"))
+    
+    def test_lookup_and_record(self):
+        backend = ledger.MemoryBackend()
+        entries = ledger.Ledger(backend)
+        self.assertIsNone(entries.lookup("m1", ["a@example.com"]))
+        entries.record("m1", ["a@example.com"], "out-1")
+        self.assertEqual(entries.lookup("m1", ["a@example.com"])['outgoing'], "out-1")
+        # A new container reads the entry from the backend
+        self.assertEqual(ledger.Ledger(backend).lookup("m1", ["a@example.com"])['outgoing'], "out-1")
+    
+    def test_first_writer_wins(self):
+        backend = ledger.MemoryBackend()
+        ledger.Ledger(backend).record("m1", ["a@example.com"], "out-1")
+        ledger.Ledger(backend).record("m1", ["a@example.com"], "out-2")
+        self.assertEqual(ledger.Ledger(backend).lookup("m1", ["a@example.com"])['outgoing'], "out-1")
+    
+    def test_lru_evicts_oldest(self):
+        entries = ledger.Ledger(ledger.MemoryBackend(), cache_size=2)
+        for mid in ["m1", "m2", "m3"]:
+            entries.record(mid, ["a@example.com"], "out")
+        self.assertEqual(len(entries.cache), 2)
+        self.assertNotIn(ledger.ledger_key("m1", ["a@example.com"]), entries.cache)
+
+
+class TestS3Backend(unittest.TestCase):
+    
+    def setUp(self):
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('s3', self.s3)
+    
+    def tearDown(self):
+        clients.reset_clients()
+    
+    def test_conditional_put(self):
+        entries = ledger.Ledger(ledger.S3Backend("bucket"))
+        self.assertIsNone(entries.lookup("m1", ["a@example.com"]))
+        entries.record("m1", ["a@example.com"], ["out-1", "out-2"])
+        key = "ledger/%s.json" % (ledger.ledger_key("m1", ["a@example.com"]),)
+        self.assertIn(key, self.s3.buckets["bucket"])
+        self.assertFalse(ledger.S3Backend("bucket").put(ledger.ledger_key("m1", ["a@example.com"]), {}))
+        self.assertEqual(ledger.Ledger(ledger.S3Backend("bucket")).lookup("m1", ["a@example.com"])['outgoing'],
+                         ["out-1", "out-2"])
+    
+    def test_backend_errors_ignored(self):
+        entries = ledger.Ledger(ledger.S3Backend("bucket"))
+        self.s3.get_object = self.s3.put_object = None  # Calls raise TypeError
+        self.assertIsNone(entries.lookup("m1", ["a@example.com"]))
+        entries.record("m1", ["a@example.com"], "out-1")
+        self.assertEqual(entries.lookup("m1", ["a@example.com"])['outgoing'], "out-1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import io
+import json
+import unittest
+from unittest import mock
+from handle_email import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_emf_record(self):
+        stats = metrics.Metrics(MessageId="m1")
+        with stats.stage("Send"):
+            pass
+        stats.put("MessageBytes", 100, "Bytes")
+        stats.add("RecipientCount", 1, "Count")
+        stats.add("RecipientCount", 2, "Count")
+        stats.set_outcome("Forwarded")
+        captured = []
+        metrics.add_hook(captured.append)
+        try:
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                record = stats.flush()
+        finally:
+            metrics.remove_hook(captured.append)
+        self.assertEqual(captured, [record])
+        self.assertEqual(json.loads(stdout.getvalue()), record)
+        self.assertEqual(record["MessageId"], "m1")
+        self.assertEqual(record["Outcome"], "Forwarded")
+        self.assertEqual(record["RecipientCount"], 3)
+        self.assertGreaterEqual(record["SendTime"], 0)
+        definition = record["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(definition["Dimensions"], [["Outcome"]])
+        self.assertIn({"Name": "MessageBytes", "Unit": "Bytes"}, definition["Metrics"])
+        self.assertIn({"Name": "SendTime", "Unit": "Milliseconds"}, definition["Metrics"])
+
+    def test_timed(self):
+        stats = metrics.Metrics()
+        double = stats.timed("Double", lambda x: x * 2)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(3), 6)
+        self.assertIn("DoubleTime", stats.metrics)
+
+    def test_extra_dimension(self):
+        stats = metrics.Metrics()
+        stats.set_outcome("Rejected")
+        stats.set_dimension("FilterRule", "spamVerdict")
+        stats.put("SavedRequests", 3, "Count")
+        record = stats.record()
+        self.assertEqual(record["FilterRule"], "spamVerdict")
+        self.assertEqual(record["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Outcome"], ["Outcome", "FilterRule"]])
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from handle_email import app, clients, compact, index
+from benchmarks import standins
+import query_index
+
+DAY = datetime(2024, 1, 2)
+
+
+def notification(message_id, source, destination, timestamp="2024-01-02T10:00:00.000Z"):
+    return {"mail": {"messageId": message_id, "timestamp": timestamp, "source": source,
+                     "destination": destination, "commonHeaders": {"subject": "Subject " + message_id}}}
+
+
+class TestQueryIndex(unittest.TestCase):
+    
+    def setUp(self):
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('s3', self.s3)
+        self.cache_dir = tempfile.mkdtemp()
+        app.S3_BUCKET = "bucket"
+        for n in [
+            notification("m1", "a@example.com", ["x@source.com"]),
+            notification("m2", "B@Example.com", ["x@source.com", "y@source.com"], "2024-01-02T11:00:00.000Z"),
+            notification("m3", "Other <c@example.org>", ["y@source.com"], "2024-01-03T09:00:00.000Z"),
+        ]:
+            app.save_message_index(n)
+        writer = index.IndexWriter("bucket", "index/")
+        writer.add(notification("m1", "a@example.com", ["x@source.com"]))  # Duplicate from a retry
+        writer.flush()
+    
+    def tearDown(self):
+        clients.reset_clients()
+        shutil.rmtree(self.cache_dir)
+    
+    def cache(self):
+        return query_index.IndexCache("bucket", self.cache_dir, workers=4)
+    
+    def days(self):
+        return [DAY, DAY + timedelta(days=1)]
+    
+    def test_aggregations(self):
+        cache = self.cache()
+        self.assertEqual(cache.sync(self.days()), 4)
+        self.assertEqual(query_index.top_sources(cache.records(self.days())),
+                         [("a@example.com", 1), ("b@example.com", 1), ("other <c@example.org>", 1)])
+        self.assertEqual(query_index.top_source_domains(cache.records(self.days())),
+                         [("example.com", 2), ("example.org", 1)])
+        self.assertEqual(query_index.top_destinations(cache.records(self.days())),
+                         [("x@source.com", 2), ("y@source.com", 2)])
+        self.assertEqual([r[-1] for r in query_index.recent(cache.records(self.days()), 2)], ["m3", "m2"])
+    
+    def test_cache_only_fetches_changes(self):
+        settled_days = query_index.SETTLED_DAYS
+        self.addCleanup(setattr, query_index, "SETTLED_DAYS", settled_days)
+        query_index.SETTLED_DAYS = 100000
+        self.cache().sync(self.days())
+        gets = self.s3.calls['GetObject']
+        cache = self.cache()
+        self.assertEqual(cache.sync(self.days()), 0)
+        self.assertEqual(self.s3.calls['GetObject'], gets)
+        # Compaction replaces the objects of a day
+        compact.compact_day(DAY, "bucket", delete=True)
+        self.assertEqual(cache.sync(self.days()), 1)
+        self.assertEqual(sorted(r['mail']['messageId'] for r in cache.records(self.days())), ["m1", "m2", "m3"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cache_dir, "bucket", "index", "2024", "01", "02"))),
+                         ["compacted_20240102.ndjson.gz"])
+    
+    def test_settled_partitions_not_listed(self):
+        self.cache().sync(self.days())
+        lists = self.s3.calls['ListObjectsV2']
+        self.cache().sync(self.days())
+        self.assertEqual(self.s3.calls['ListObjectsV2'], lists)
+    
+    def test_find_message(self):
+        self.s3.put_object(Bucket="bucket", Key="messages/m2", Body=b"raw")
+        self.s3.buckets["bucket"]["messages/m2"]['LastModified'] = datetime(2024, 1, 2, 11, 0, 1, tzinfo=timezone.utc)
+        found, head = query_index.find_message(self.cache(), "m2")
+        self.assertEqual(found['mail']['source'], "B@Example.com")
+        self.assertEqual(head['ContentLength'], 3)
+        # Without the raw message, the given days are searched
+        found, head = query_index.find_message(self.cache(), "m3", self.days())
+        self.assertIsNone(head)
+        self.assertEqual(found['mail']['messageId'], "m3")
+    
+    def test_main(self):
+        self.assertEqual(query_index.main(["top-sources", "--bucket", "bucket", "--cache-dir", self.cache_dir,
+                                           "--since", "2024/01/02", "--until", "2024/01/03"]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
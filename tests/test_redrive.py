@@ -0,0 +1,120 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from handle_email import app, clients, filters, ledger, redrive, sender
+from benchmarks import standins
+
+EVENTS_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'events')
+RAW_MESSAGE = b"From: Sender <sender@example.com>\r\nTo: recipient@example.com\r\nSubject: Test\r\n\r\nHello\r\n"
+QUEUE = "https://sqs.us-east-1.amazonaws.com/123456789012/dlq"
+
+
+def load_notification(message_id, timestamp="2019-08-05T21:30:02.028Z"):
+    with open(os.path.join(EVENTS_DIR, 'ses_event.json')) as f:
+        notification = json.load(f)['Records'][0]['ses']
+    notification['mail']['messageId'] = message_id
+    notification['mail']['timestamp'] = timestamp
+    notification['receipt']['dkimVerdict']['status'] = 'PASS'
+    return notification
+
+
+class TestRedrive(unittest.TestCase):
+
+    def setUp(self):
+        self.services = standins.install()
+        self.s3, self.ses, self.sqs = self.services['s3'], self.services['sesv2'], self.services['sqs']
+        self.settings = app.S3_BUCKET, app.EMAIL_DOM, app.DEST_DOM
+        app.S3_BUCKET, app.EMAIL_DOM, app.DEST_DOM = "bucket", "source.com", "dest.com"
+        sender.set_scheduler(sender.SendScheduler(None))
+        filters.set_pipeline(None)
+        ledger.set_ledger(ledger.Ledger(ledger.MemoryBackend()))
+        self.tmp = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmp, "redrive.jsonl")
+
+    def tearDown(self):
+        app.S3_BUCKET, app.EMAIL_DOM, app.DEST_DOM = self.settings
+        clients.reset_clients()
+        sender.reset_scheduler()
+        filters.set_pipeline(None)
+        ledger.set_ledger(None)
+        shutil.rmtree(self.tmp)
+
+    def receive(self, message_id, failed=True, raw=True, **kwargs):
+        """Store and index a message as the handler does, with its send error if `failed`."""
+        notification = load_notification(message_id, **kwargs)
+        if raw:
+            self.s3.put_object(Bucket="bucket", Key=app.S3_PREFIX_MSG + message_id, Body=RAW_MESSAGE)
+        app.save_message_index(notification)
+        if failed:
+            app.save_message_error(message_id, b"outgoing", notification['mail']['timestamp'],
+                                   {"errorCode": "Throttling"})
+        return notification
+
+    def run_main(self, *args):
+        return redrive.main(["--bucket", "bucket", "--checkpoint", self.checkpoint] + list(args))
+
+    def test_by_days_resumes_from_checkpoint(self):
+        self.receive("m1")
+        self.receive("m2", raw=False)
+        self.receive("m3", failed=False)
+        self.assertEqual(self.run_main("--since", "2019/08/05", "--until", "2019/08/05"), 1)
+        self.assertEqual(len(self.ses.sent), 1)
+        with open(self.checkpoint) as f:
+            results = {r['messageId']: r for r in map(json.loads, f)}
+        self.assertEqual(results['m1']['outcome'], "Forwarded")
+        self.assertEqual(results['m2']['errorCode'], "NoSuchKey")
+
+        self.s3.put_object(Bucket="bucket", Key=app.S3_PREFIX_MSG + "m2", Body=RAW_MESSAGE)
+        get_objects = self.s3.calls['GetObject']
+        self.assertEqual(self.run_main("--since", "2019/08/05", "--until", "2019/08/05"), 0)
+        self.assertEqual(len(self.ses.sent), 2)
+        # Only the index of the day (3 objects) and m2 are read again
+        self.assertEqual(self.s3.calls['GetObject'] - get_objects, 4)
+
+    def test_ledger_prevents_second_send(self):
+        notification = self.receive("m1")
+        summary = redrive.redrive([notification, load_notification("m1")], workers=1)
+        self.assertEqual(len(self.ses.sent), 1)
+        self.assertEqual(summary['outcomes'], {"Forwarded": 1, "Duplicate": 1})
+
+    def test_by_ids(self):
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        self.receive("m1", failed=False, timestamp=now)
+        self.receive("m2", failed=False, timestamp=now)
+        notifications = redrive.by_ids("bucket", ["m2", "missing", "m1"])
+        self.assertEqual([n['mail']['messageId'] for n in notifications], ["m2", "m1"])
+
+    def test_drain_queue(self):
+        for message_id in ["m1", "m2"]:
+            event = {"Records": [{"eventSource": "aws:ses", "ses": self.receive(message_id)}]}
+            self.sqs.send_message(QueueUrl=QUEUE, MessageBody=json.dumps(event))
+        self.sqs.send_message(QueueUrl=QUEUE, MessageBody="not json")
+        self.assertEqual(self.run_main("--queue", QUEUE, "--rate", "100", "--workers", "4"), 0)
+        self.assertEqual(len(self.ses.sent), 2)
+        self.assertEqual([m['Body'] for m in self.sqs.queues[QUEUE]], ["not json"])
+
+    def test_drain_deletes_by_queue_message(self):
+        event = {"Records": [{"eventSource": "aws:ses", "ses": load_notification(m)} for m in ["m1", "m2"]]}
+        self.sqs.send_message(QueueUrl=QUEUE, MessageBody=json.dumps(event))
+        drain = redrive.QueueDrain(QUEUE)
+        notifications = list(drain)
+        queue_message_id = notifications[0].queue_message_id
+        self.assertEqual([n.queue_message_id for n in notifications], [queue_message_id] * 2)
+        # Deleted once every notification is complete, whichever objects carry them
+        for notification in notifications:
+            drain.delete(redrive.QueuedNotification(notification, queue_message_id))
+        self.assertEqual((drain.deleted, self.sqs.queues[QUEUE]), (1, []))
+
+    def test_summary(self):
+        summary = {"messages": 4, "seconds": 2.0, "outcomes": {"Forwarded": 3, "Failed": 1},
+                   "errors": redrive.Counter({"MessageRejected": 1})}
+        self.assertEqual(redrive.format_summary(summary),
+                         "4 messages in 2.0 s, 2.0 messages/sec\n  Failed: 1\n  Forwarded: 3\n"
+                         "Errors by code:\n  MessageRejected: 1")
+
+
+if __name__ == '__main__':
+    unittest.main()
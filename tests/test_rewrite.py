@@ -0,0 +1,107 @@
+import io
+import os
+import unittest
+from email.message import EmailMessage
+from handle_email import rewrite
+
+
+def build_message(eol=b"\r\n"):
+    msg = EmailMessage()
+    msg['From'] = '"Doe, John" <john@example.com>'
+    msg['To'] = 'someone@example.com'
+    msg['Cc'] = 'other@example.com'
+    msg['Subject'] = 'A folded subject ' + 'word ' * 30
+    msg.set_content("Hello\nWorld\n")
+    msg.add_attachment(os.urandom(5000), maintype='application', subtype='octet-stream', filename='x.bin')
+    raw = msg.as_bytes()
+    if eol == b"\r\n":
+        raw = raw.replace(b"\n", b"\r\n")
+    return raw
+
+
+class TestRewrite(unittest.TestCase):
+
+    def rewrite(self, raw):
+        return rewrite.rewrite_message(
+            raw,
+            transform={"From": lambda v: "relay@source.com"},
+            replace={"To": "a@dest.com,b@dest.com"},
+            delete=["CC", "BCC"],
+        )
+
+    def test_body_identical(self):
+        for eol in (b"\r\n", b"\n"):
+            raw = build_message(eol)
+            new = self.rewrite(raw)
+            body_old = rewrite.split_message(raw)[2]
+            header_new, sep, body_new = rewrite.split_message(new)
+            self.assertEqual(sep, eol)
+            self.assertEqual(bytes(body_new), bytes(body_old))
+            self.assertIn(b"From: relay@source.com" + eol, header_new)
+            self.assertIn(b"To: a@dest.com,b@dest.com" + eol, header_new)
+            self.assertNotIn(b"Cc:", header_new)
+            # Untouched folded headers are kept byte for byte
+            subject = [f for n, f in rewrite.parse_header_block(header_new) if n == 'Subject'][0]
+            self.assertIn(subject, raw)
+            self.assertIn(eol + b" ", subject)
+
+    def test_missing_header_added(self):
+        raw = b"From: a@example.com\r\nSubject: x\r\n\r\nbody"
+        new = rewrite.rewrite_message(raw, replace={"To": "b@dest.com"})
+        self.assertEqual(new, b"From: a@example.com\r\nSubject: x\r\nTo: b@dest.com\r\n\r\nbody")
+
+    def test_copy_when_missing(self):
+        raw = b"From: A <a@example.com>\r\nSubject: x\r\n\r\nbody"
+        transform = {"From": lambda v: "relay@source.com"}
+        new = rewrite.rewrite_message(raw, transform=transform, copy={"Reply-To": "From"})
+        self.assertEqual(new, b"From: relay@source.com\r\nSubject: x\r\nReply-To: A <a@example.com>\r\n\r\nbody")
+        raw = b"Reply-To: b@example.com\r\n" + raw
+        self.assertEqual(rewrite.rewrite_message(raw, copy={"Reply-To": "From"}), raw)
+
+    def test_duplicate_replaced_once(self):
+        raw = b"To: a@example.com\nTo: b@example.com\nSubject: x\n\nbody\n\n"
+        new = rewrite.rewrite_message(raw, replace={"To": "c@dest.com"})
+        self.assertEqual(new, b"To: c@dest.com\nSubject: x\n\nbody\n\n")
+
+    def test_transform_unfolds_and_keeps_8bit(self):
+        raw = "From: José\r\n <jose@example.com>\r\n\r\nbody".encode('utf-8')
+        values = []
+        def transform(value):
+            values.append(value)
+            return value
+        new = rewrite.rewrite_message(raw, transform={"from": transform})
+        self.assertEqual(values, ["Jos\udcc3\udca9 <jose@example.com>"])
+        self.assertEqual(new, "From: José <jose@example.com>\r\n\r\nbody".encode('utf-8'))
+
+    def test_long_to_folded(self):
+        recipients = ["recipient%02d_with_a_long_name@destination.example.com" % (i,) for i in range(50)]
+        for eol in (b"\r\n", b"\n"):
+            raw = b"From: a@example.com" + eol + b"Subject: x" + eol + eol + b"body"
+            new = rewrite.rewrite_message(raw, replace={"To": ", ".join(recipients)})
+            header_block = rewrite.split_message(new)[0]
+            self.assertTrue(all(len(line) <= 998 for line in header_block.splitlines()))
+            self.assertTrue(all(len(line) <= rewrite.FOLD_LENGTH for line in header_block.splitlines()))
+            to = [f for n, f in rewrite.parse_header_block(header_block) if n == 'To'][0]
+            self.assertEqual(to.count(eol), 50)  # One address per line
+            self.assertEqual(rewrite.field_value(to), ", ".join(recipients))
+
+    def test_long_subject_folded(self):
+        words = ["=?utf-8?q?Bonjour_=C3=A0_tous_les_coll=C3=A8gues_num=C3=A9ro_%02d?=" % (i,) for i in range(20)]
+        field = rewrite.format_field("Subject", "[FWD] " + " ".join(words))
+        lines = field.splitlines()
+        self.assertEqual(len(lines), 21)  # "Subject: [FWD]", then one encoded word per line
+        self.assertTrue(all(len(line) <= rewrite.FOLD_LENGTH for line in lines))
+        self.assertEqual(rewrite.field_value(field), "[FWD] " + " ".join(words))
+
+    def test_read_header_block(self):
+        for eol in (b"\r\n", b"\n"):
+            raw = build_message(eol)
+            header_block, separator, _ = rewrite.split_message(raw)
+            for chunk_size in (1, 2, 3, 5, 64 * 1024):
+                self.assertEqual(rewrite.read_header_block(io.BytesIO(raw), chunk_size),
+                                 (header_block, separator, len(header_block) + len(separator)))
+        self.assertEqual(rewrite.read_header_block(io.BytesIO(b"Subject: x"), 4), (b"Subject: x", b"", 10))
+
+    def test_headers_only(self):
+        self.assertEqual(rewrite.rewrite_message(b"Subject: x", replace={"To": "a@b.c"}),
+                         b"Subject: x\r\nTo: a@b.c\r\n")
@@ -0,0 +1,73 @@
+import json
+import unittest
+from unittest import mock
+from handle_email import clients, routing
+from benchmarks import standins
+
+ROUTES = {
+    "alice@example.com": ["alice@dest.com", "alice@backup.example.net"],
+    "sales-*@example.com": "sales@dest.com",
+    "sales-eu-*@example.com": "sales-eu@dest.com",
+    "*@example.org": "{local}.org@dest.com",
+}
+
+
+class TestRouter(unittest.TestCase):
+
+    def test_lookup(self):
+        router = routing.Router(ROUTES)
+        self.assertEqual(router.route(["Alice@Example.com"], "dest.com"), ["alice@dest.com", "alice@backup.example.net"])
+        self.assertEqual(router.route(["sales-us@example.com"], "dest.com"), ["sales@dest.com"])
+        self.assertEqual(router.route(["sales-eu-1@example.com"], "dest.com"), ["sales-eu@dest.com"])
+        self.assertEqual(router.route(["bob@example.org"], "dest.com"), ["bob.org@dest.com"])
+        self.assertEqual(router.route(["Bob@example.com"], "dest.com"), ["Bob@dest.com"])
+
+    def test_catch_all_and_dedupe(self):
+        router = routing.Router(dict(ROUTES, **{"*": "inbox@dest.com"}))
+        self.assertEqual(router.route(["x@example.com", "sales-a@example.com", "y@example.net", "sales-b@example.com"]),
+                         ["inbox@dest.com", "sales@dest.com"])
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(ValueError):
+            routing.Router({"a*b@example.com": "x@dest.com"})
+
+    def test_forward_modes(self):
+        router = routing.Router(dict(ROUTES, **{"reports@example.com": {"to": "reports@dest.com", "forward": "attachment"},
+                                                "*@example.net": {"forward": "rfc822"}}))
+        self.assertEqual(router.route_modes(["alice@example.com", "reports@example.com", "bob@example.net"], "dest.com"),
+                         {"inline": ["alice@dest.com", "alice@backup.example.net"],
+                          "attachment": ["reports@dest.com"], "rfc822": ["bob@dest.com"]})
+        with self.assertRaises(ValueError):
+            routing.Router({"x@example.com": {"forward": "zip"}})
+
+    def test_chunked(self):
+        self.assertEqual([len(c) for c in routing.chunked(list(range(120)))], [50, 50, 20])
+
+
+class TestCachedRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = standins.InMemoryS3()
+        clients.set_client('s3', self.s3)
+        self.s3.put_object(Bucket="config", Key="routes.json", Body=json.dumps({"routes": ROUTES}))
+
+    def tearDown(self):
+        clients.reset_clients()
+        routing.reset_router()
+
+    def test_refresh_from_s3(self):
+        now = [0]
+        with mock.patch.object(routing, 'ROUTES_CONFIG_S3', "s3://config/routes.json"):
+            cached = routing.CachedRouter(ttl=60, clock=lambda: now[0])
+            router = cached.get()
+            self.assertEqual(router.route(["bob@example.org"]), ["bob.org@dest.com"])
+            now[0] = 30
+            self.assertIs(cached.get(), router)
+            self.assertEqual(self.s3.calls['GetObject'], 1)
+            # Unchanged: conditional GET keeps the same table
+            now[0] = 61
+            self.assertIs(cached.get(), router)
+            self.assertEqual(self.s3.calls['GetObject'], 2)
+            self.s3.put_object(Bucket="config", Key="routes.json", Body=json.dumps({"routes": {"*": "all@dest.com"}}))
+            now[0] = 122
+            self.assertEqual(cached.get().route(["bob@example.org"]), ["all@dest.com"])
@@ -0,0 +1,96 @@
+import json
+import unittest
+from unittest import mock
+from handle_email import clients, sender
+from benchmarks import standins
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_reserve(self):
+        clock = FakeClock()
+        bucket = sender.TokenBucket(2, clock=clock)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        # Not enough time left: no token is taken
+        self.assertIsNone(bucket.reserve(max_wait=0.5))
+        clock.now = 1.5
+        self.assertEqual(bucket.reserve(), 0)
+
+
+class TestSendScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.ses = standins.InMemorySESv2()
+        clients.set_client('sesv2', self.ses)
+        sender.reset_scheduler()
+        self.sleeps = []
+
+    def tearDown(self):
+        clients.reset_clients()
+        sender.reset_scheduler()
+
+    def send(self, scheduler, remaining_ms=None):
+        return scheduler.send_email(Content={'Raw': {'Data': b"x"}}, remaining_ms=remaining_ms)
+
+    def test_retry_throttles(self):
+        self.ses.throttle = 3
+        scheduler = sender.SendScheduler(sleep=self.sleeps.append)
+        self.assertIn('MessageId', self.send(scheduler, remaining_ms=lambda: 60000))
+        self.assertEqual(len(self.sleeps), 3)
+        self.assertEqual(len(self.ses.sent), 1)
+
+    def test_throttles_retried_by_scheduler_only(self):
+        # A real sesv2 client from the registry, answering every request with a throttle
+        from botocore.awsrequest import AWSResponse
+        class Raw:
+            def stream(self, **kwargs):
+                yield json.dumps({"message": "Maximum sending rate exceeded."}).encode()
+        requests = []
+        def throttle(request, **kwargs):
+            requests.append(request)
+            return AWSResponse(request.url, 429, {"x-amzn-ErrorType": "TooManyRequestsException"}, Raw())
+        environ = {"AWS_DEFAULT_REGION": "us-east-1", "AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test"}
+        clients.reset_clients()
+        with mock.patch.dict('os.environ', environ), mock.patch.object(sender, 'SEND_MAX_ATTEMPTS', 3):
+            clients.get_client('sesv2').meta.events.register('before-send.sesv2.SendEmail', throttle)
+            with self.assertRaises(standins.ClientError) as cm:
+                self.send(sender.SendScheduler(sleep=self.sleeps.append))
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(cm.exception.attempts, 3)
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_budget_exhausted(self):
+        self.ses.throttle = 100
+        scheduler = sender.SendScheduler(sleep=self.sleeps.append)
+        with self.assertRaises(standins.ClientError):
+            self.send(scheduler, remaining_ms=lambda: sender.SEND_TIME_RESERVE_MS)
+        self.assertEqual(self.sleeps, [])
+        with self.assertRaises(standins.ClientError):
+            self.send(scheduler)
+        self.assertEqual(len(self.sleeps), sender.SEND_MAX_ATTEMPTS - 1)
+
+    def test_other_errors_not_retried(self):
+        def reject(**kwargs):
+            raise standins.client_error('MessageRejected', 'Email address is not verified.', 'SendEmail')
+        self.ses.send_email = reject
+        with self.assertRaises(standins.ClientError):
+            self.send(sender.SendScheduler(sleep=self.sleeps.append))
+        self.assertEqual(self.sleeps, [])
+
+    def test_quota_read_once(self):
+        self.ses.max_send_rate = 5.0
+        scheduler = sender.get_scheduler()
+        self.assertIs(sender.get_scheduler(), scheduler)
+        self.assertEqual(scheduler.bucket.rate, 5.0 * sender.SEND_RATE_FRACTION)
+        self.assertEqual(self.ses.calls['GetAccount'], 1)
@@ -0,0 +1,33 @@
+import io
+import os
+import unittest
+from handle_email import rewrite, spool
+
+
+class TestSpool(unittest.TestCase):
+
+    def test_spool_in_memory_and_on_disk(self):
+        data = os.urandom(10000)
+        for max_memory, rolled in ((100000, False), (1000, True)):
+            buffer, size = spool.spool_body(io.BytesIO(data), chunk_size=1024, max_memory=max_memory)
+            with buffer:
+                self.assertEqual(size, len(data))
+                self.assertEqual(buffer._rolled, rolled)
+                self.assertEqual(buffer.read(), data)
+
+    def test_spool_limit(self):
+        with self.assertRaises(spool.MessageTooLarge) as cm:
+            spool.spool_body(io.BytesIO(b"x" * 5000), limit=4096, chunk_size=1024)
+        self.assertEqual(cm.exception.size, 5000)
+        spool.check_size(4096, limit=4096)
+        with self.assertRaises(spool.MessageTooLarge):
+            spool.check_size(4097, limit=4096)
+
+    def test_rewrite_file_matches_rewrite_message(self):
+        raw = b"From: a@example.com\r\nCc: c@example.com\r\n\r\n" + os.urandom(300000)
+        options = dict(transform={"From": str.upper}, replace={"To": "b@dest.com"}, delete=["CC"])
+        buffer, size = spool.spool_body(io.BytesIO(raw), max_memory=1000)
+        with buffer:
+            out = rewrite.rewrite_file(buffer, size, chunk_size=4096, **options)
+        self.assertIsInstance(out, bytearray)
+        self.assertEqual(out, rewrite.rewrite_message(raw, **options))
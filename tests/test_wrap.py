@@ -0,0 +1,51 @@
+import io
+import email
+import unittest
+from email import policy
+from handle_email import wrap
+from tests.test_rewrite import build_message
+
+HEADERS = [("From", "john_at_example.com@source.com"), ("To", "a@dest.com"), ("Subject", "[FWD] Hello")]
+
+
+class TestWrap(unittest.TestCase):
+
+    def wrap(self, raw, mode, **kwargs):
+        data = wrap.wrap_file(io.BytesIO(raw), len(raw), mode, HEADERS, "Forwarded message", **kwargs)
+        return data, email.message_from_bytes(bytes(data), policy=policy.default)
+
+    def test_rfc822(self):
+        raw = build_message()
+        data, msg = self.wrap(raw, "rfc822", chunk_size=1000)
+        self.assertEqual(msg['Subject'], "[FWD] Hello")
+        note, original = msg.get_payload()
+        self.assertEqual(note.get_content(), "Forwarded message")
+        self.assertEqual(original.get_content_type(), "message/rfc822")
+        self.assertEqual(original['Content-Transfer-Encoding'], "7bit")
+        # The original bytes are copied unchanged
+        self.assertIn(raw, data)
+
+    def test_rfc822_8bit(self):
+        raw = build_message().replace(b"Hello", "Héllo".encode())
+        data, msg = self.wrap(raw, "rfc822", chunk_size=1000)
+        self.assertEqual(msg.get_payload()[1]['Content-Transfer-Encoding'], "8bit")
+        self.assertIn(raw, data)
+
+    def test_attachment(self):
+        raw = build_message()
+        for size in [0, 1, 56, 57, 58, len(raw)]:
+            data, msg = self.wrap(raw[:size], "attachment", chunk_size=100)
+            attachment = msg.get_payload()[1]
+            self.assertEqual(attachment.get_filename(), wrap.ATTACHMENT_NAME)
+            self.assertEqual(attachment.get_payload(decode=True), raw[:size])
+            self.assertEqual(len(attachment.get_payload().replace("\r\n", "").replace("\n", "")) % 4, 0)
+            for line in bytes(data).split(b"\r\n"):
+                self.assertLessEqual(len(line), 998)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self.wrap(build_message(), "zip")
+
+
+if __name__ == '__main__':
+    unittest.main()